@@ -0,0 +1,94 @@
+import asyncio
+import pathlib
+
+from server_hebergement import Constantes as ConstantesHebergement
+
+
+def valider_nom(nom: str) -> str:
+    """ Valide une composante de path recue dans l'URL (uuid_backup, domaine, nomfichier). """
+    if nom in ['', '.', '..'] or '/' in nom or '\\' in nom or '\x00' in nom:
+        raise ValueError('Nom invalide : %s' % nom)
+    return nom
+
+
+def get_path_backup(dir_staging: str, idmg: str, uuid_backup: str, domaine: str, nomfichier: str) -> pathlib.Path:
+    return pathlib.Path(dir_staging, ConstantesHebergement.DIR_STAGING_BACKUP, valider_nom(idmg),
+                        valider_nom(uuid_backup), valider_nom(domaine), valider_nom(nomfichier))
+
+
+FICHIER_INDEX = 'index.txt'
+
+
+class IndexBackup:
+    """
+    Index d'appartenance des fichiers de backup par idmg, cle (uuid_backup, domaine, nomfichier).
+
+    Sur disque : staging/backup/{idmg}/index.txt, une cle par ligne. Les ajouts sont faits a la fin du fichier
+    et le fichier est recompacte (trie, sans doublons) au chargement. En memoire : un set par idmg, charge
+    au premier acces.
+    """
+
+    def __init__(self, dir_staging: str):
+        self.__path_backup = pathlib.Path(dir_staging, ConstantesHebergement.DIR_STAGING_BACKUP)
+        self.__index: dict[str, set] = dict()
+        self.__verrous: dict[str, asyncio.Lock] = dict()
+
+    @staticmethod
+    def cle(uuid_backup: str, domaine: str, nomfichier: str) -> str:
+        return '/'.join([uuid_backup, domaine, nomfichier])
+
+    async def get_index(self, idmg: str, executer) -> set:
+        """ executer : fonction async pour les operations disque. """
+        try:
+            return self.__index[idmg]
+        except KeyError:
+            pass
+
+        verrou = self.__verrous.setdefault(idmg, asyncio.Lock())
+        async with verrou:
+            index = self.__index.get(idmg)
+            if index is None:
+                index = await executer(charger_index, pathlib.Path(self.__path_backup, valider_nom(idmg)))
+                self.__index[idmg] = index
+        return index
+
+    async def ajouter(self, idmg: str, uuid_backup: str, domaine: str, nomfichier: str, executer):
+        index = await self.get_index(idmg, executer)
+        cle = IndexBackup.cle(uuid_backup, domaine, nomfichier)
+        if cle not in index:
+            index.add(cle)
+            await executer(ajouter_index, pathlib.Path(self.__path_backup, idmg), cle)
+
+    async def verifier(self, idmg: str, cles: list[str], executer) -> list[bool]:
+        index = await self.get_index(idmg, executer)
+        return [c in index for c in cles]
+
+
+def charger_index(path_idmg: pathlib.Path) -> set:
+    """ Charge et compacte l'index. Reconstruit a partir des fichiers sur disque s'il est absent. Bloquant. """
+    path_index = pathlib.Path(path_idmg, FICHIER_INDEX)
+    try:
+        with open(path_index, 'rt') as fichier:
+            index = set(ligne.rstrip('\n') for ligne in fichier if ligne.strip() != '')
+    except FileNotFoundError:
+        index = set()
+        if path_idmg.exists():
+            for path_fichier in path_idmg.glob('*/*/*'):
+                if path_fichier.is_file() and path_fichier.name.endswith('.work') is False:
+                    index.add(IndexBackup.cle(*path_fichier.relative_to(path_idmg).parts))
+        else:
+            return index  # Aucun backup pour ce idmg
+
+    path_work = pathlib.Path(path_idmg, FICHIER_INDEX + '.work')
+    with open(path_work, 'wt') as fichier:
+        for cle in sorted(index):
+            fichier.write(cle + '\n')
+    path_work.rename(path_index)
+
+    return index
+
+
+def ajouter_index(path_idmg: pathlib.Path, cle: str):
+    path_idmg.mkdir(parents=True, exist_ok=True)
+    with open(pathlib.Path(path_idmg, FICHIER_INDEX), 'at') as fichier:
+        fichier.write(cle + '\n')
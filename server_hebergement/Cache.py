@@ -0,0 +1,123 @@
+import hashlib
+import time
+
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+
+class CacheExpiration:
+    """
+    Cache LRU borne ou chaque entree a sa propre date d'expiration (epoch, secondes).
+    """
+
+    def __init__(self, taille_max: int = 1000):
+        self.__taille_max = taille_max
+        self.__entrees: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, cle) -> Optional[Any]:
+        try:
+            valeur, expiration = self.__entrees[cle]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expiration <= time.time():
+            del self.__entrees[cle]
+            self.misses += 1
+            return None
+
+        self.__entrees.move_to_end(cle)
+        self.hits += 1
+        return valeur
+
+    def put(self, cle, valeur, expiration: float):
+        if expiration <= time.time():
+            return  # Deja expire, rien a conserver
+
+        self.__entrees[cle] = (valeur, expiration)
+        self.__entrees.move_to_end(cle)
+
+        if len(self.__entrees) > self.__taille_max:
+            # Retirer les entrees expirees avant d'evincer les plus anciennes (LRU)
+            self.purger()
+            while len(self.__entrees) > self.__taille_max:
+                self.__entrees.popitem(last=False)
+                self.evictions += 1
+
+    def get_expiration(self, cle) -> Optional[float]:
+        """ Expiration d'une entree, sans effet sur l'ordre LRU ni les statistiques. """
+        try:
+            return self.__entrees[cle][1]
+        except KeyError:
+            return None
+
+    def cles(self) -> list:
+        return list(self.__entrees.keys())
+
+    def retirer(self, cle):
+        self.__entrees.pop(cle, None)
+
+    def retirer_si(self, condition: Callable[[Any, Any], bool]) -> int:
+        cles = [c for c, (v, _) in self.__entrees.items() if condition(c, v)]
+        for cle in cles:
+            del self.__entrees[cle]
+        return len(cles)
+
+    def purger(self) -> int:
+        maintenant = time.time()
+        return self.retirer_si(lambda c, v: self.__entrees[c][1] <= maintenant)
+
+    def clear(self):
+        self.__entrees.clear()
+
+    def __len__(self):
+        return len(self.__entrees)
+
+    def get_stats(self) -> dict:
+        return {
+            'taille': len(self.__entrees),
+            'taille_max': self.__taille_max,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class CacheJwt:
+    """
+    Cache des JWT deja verifies (signature et certificat), cle : digest du token.
+    Une entree expire au champ exp du JWT ou sur revocation du certificat (kid).
+    """
+
+    def __init__(self, taille_max: int = 5000):
+        self.__cache = CacheExpiration(taille_max)
+
+    @staticmethod
+    def digest(jwt: str) -> bytes:
+        return hashlib.sha256(jwt.encode('utf-8')).digest()
+
+    def get(self, jwt: str) -> Optional[dict]:
+        entree = self.__cache.get(CacheJwt.digest(jwt))
+        if entree is not None:
+            return entree[1]
+        return None
+
+    def put(self, jwt: str, kid: str, jwt_contenu: dict):
+        try:
+            expiration = float(jwt_contenu['exp'])
+        except (KeyError, TypeError, ValueError):
+            return  # Aucune expiration, ne pas conserver le token
+        self.__cache.put(CacheJwt.digest(jwt), (kid, jwt_contenu), expiration)
+
+    def retirer_certificat(self, fingerprint: str) -> int:
+        """ Retire tous les tokens signes par ce certificat (e.g. revocation). """
+        return self.__cache.retirer_si(lambda c, v: v[0] == fingerprint)
+
+    def purger(self) -> int:
+        return self.__cache.purger()
+
+    def get_stats(self) -> dict:
+        return self.__cache.get_stats()
@@ -0,0 +1,244 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+import pathlib
+import time
+
+from typing import Optional
+
+from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
+from millegrilles_messages.messages.ValidateurCertificats import CertificatInconnu, valider_certificat_tiers
+
+from server_hebergement.Cache import CacheExpiration
+
+TTL_CERTIFICAT = 1800  # Secondes avant de recharger un certificat connu
+TTL_NEGATIF = 30  # Secondes pendant lesquelles un kid inconnu n'est pas redemande
+INTERVALLE_RAFRAICHISSEMENT = 300
+MAX_CHARGEMENTS_CONCURRENTS = 10
+TTL_CHAINE = 3600  # Secondes maximum avant de revalider une chaine (meme si le certificat est encore valide)
+
+
+class CacheCertificats:
+    """
+    Cache local devant etat.charger_certificat(kid) (requete MQ si le certificat n'est pas connu de l'etat).
+
+    - Un seul chargement a la fois par kid : les requetes concurrentes attendent le meme resultat.
+    - Cache negatif de courte duree pour les kid inconnus (rafale de tokens invalides).
+    - Les certificats utilises sont recharges en arriere-plan a chaque intervalle. Un certificat qui n'est plus
+      connu (e.g. revoque) est retire et les callbacks de retrait invalident les caches qui en dependent (JWT).
+    - Les kid connus sont conserves sur disque et precharges au demarrage.
+    """
+
+    def __init__(self, etat, path_fichier: Optional[pathlib.Path] = None, taille_max=1000,
+                 ttl=TTL_CERTIFICAT, ttl_negatif=TTL_NEGATIF):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__etat = etat
+        self.__path_fichier = path_fichier
+        self.__ttl = ttl
+        self.__ttl_negatif = ttl_negatif
+        self.__cache = CacheExpiration(taille_max)
+        self.__negatif = CacheExpiration(taille_max * 10)
+        self.__en_cours: dict[str, asyncio.Task] = dict()
+        self.__utilises: set[str] = set()  # kid utilises depuis le dernier rafraichissement
+        self.__callbacks_retrait: list = list()
+        self.chargements = 0
+        self.coalesces = 0
+        self.negatifs = 0
+
+    async def charger_certificat(self, fingerprint: str) -> EnveloppeCertificat:
+        """ Meme interface que etat.charger_certificat. """
+        enveloppe = self.__cache.get(fingerprint)
+        if enveloppe is not None:
+            self.__utilises.add(fingerprint)
+            return enveloppe
+
+        erreur = self.__negatif.get(fingerprint)
+        if erreur is not None:
+            self.negatifs += 1
+            # Nouvelle instance : l'exception conservee accumulerait le traceback (et les frames) de chaque raise
+            classe, args = erreur
+            raise classe(*args)
+
+        tache = self.__en_cours.get(fingerprint)
+        if tache is None:
+            # Chargement dans une tache independante : l'annulation d'un appelant n'affecte pas les autres
+            tache = asyncio.create_task(self.__charger(fingerprint))
+            tache.add_done_callback(lambda t: self.__terminer_chargement(fingerprint, t))
+            self.__en_cours[fingerprint] = tache
+        else:
+            self.coalesces += 1
+
+        enveloppe = await asyncio.shield(tache)
+        self.__utilises.add(fingerprint)
+        return enveloppe
+
+    def __terminer_chargement(self, fingerprint: str, tache: asyncio.Task):
+        self.__en_cours.pop(fingerprint, None)
+        if tache.cancelled() is False:
+            tache.exception()  # Exception recuperee par les appelants
+
+    async def __charger(self, fingerprint: str) -> EnveloppeCertificat:
+        self.chargements += 1
+        try:
+            enveloppe = await self.__etat.charger_certificat(fingerprint)
+        except CertificatInconnu as e:
+            self.__negatif.put(fingerprint, (e.__class__, e.args), time.time() + self.__ttl_negatif)
+            raise
+        self.__cache.put(fingerprint, enveloppe, min(time.time() + self.__ttl, get_expiration(enveloppe)))
+        return enveloppe
+
+    def ajouter_callback_retrait(self, callback):
+        """ callback(fingerprint) appele lorsqu'un certificat est retire (revocation). """
+        self.__callbacks_retrait.append(callback)
+
+    def retirer_certificat(self, fingerprint: str):
+        self.__cache.retirer(fingerprint)
+        self.__utilises.discard(fingerprint)
+        for callback in self.__callbacks_retrait:
+            try:
+                callback(fingerprint)
+            except Exception:
+                self.__logger.exception("retirer_certificat Erreur callback de retrait %s" % fingerprint)
+
+    async def precharger(self):
+        """ Charge les certificats connus lors de la derniere execution. """
+        if self.__path_fichier is None:
+            return
+        try:
+            fingerprints = await asyncio.to_thread(lire_fingerprints, self.__path_fichier)
+        except FileNotFoundError:
+            return
+        nombre = await self.__charger_lot(fingerprints)
+        self.__logger.info("precharger %d/%d certificats charges" % (nombre, len(fingerprints)))
+
+    async def rafraichir(self):
+        """
+        Recharge les certificats utilises depuis le dernier rafraichissement. Ceux qui ne sont plus connus
+        (CertificatInconnu, e.g. revocation) sont retires du cache et des caches dependants.
+        """
+        utilises = [f for f in self.__utilises if self.__cache.get_expiration(f) is not None]
+        self.__utilises = set()
+        if len(utilises) > 0:
+            await self.__charger_lot(utilises, retirer_inconnus=True)
+
+        self.__cache.purger()
+        self.__negatif.purger()
+        if self.__path_fichier is not None:
+            await asyncio.to_thread(ecrire_fingerprints, self.__path_fichier, self.__cache.cles())
+
+    async def __charger_lot(self, fingerprints: list[str], retirer_inconnus=False) -> int:
+        semaphore = asyncio.BoundedSemaphore(MAX_CHARGEMENTS_CONCURRENTS)
+
+        async def charger(fingerprint: str) -> bool:
+            async with semaphore:
+                try:
+                    await self.__charger(fingerprint)
+                    return True
+                except CertificatInconnu:
+                    if retirer_inconnus:
+                        self.__logger.info("charger_lot Certificat %s n'est plus connu, retire" % fingerprint)
+                        self.retirer_certificat(fingerprint)
+                    return False
+                except Exception as e:
+                    self.__logger.debug("charger_lot Erreur chargement certificat %s : %s" % (fingerprint, e))
+                    return False
+
+        resultats = await asyncio.gather(*[charger(f) for f in fingerprints])
+        return sum(1 for r in resultats if r)
+
+    async def run(self, stop_event: asyncio.Event):
+        await self.precharger()
+        while stop_event.is_set() is False:
+            try:
+                await asyncio.wait_for(stop_event.wait(), timeout=INTERVALLE_RAFRAICHISSEMENT)
+            except asyncio.TimeoutError:
+                pass  # OK
+            try:
+                await self.rafraichir()
+                self.__logger.info("run Cache certificats : %s" % self.get_stats())
+            except Exception:
+                self.__logger.exception("run Erreur rafraichissement des certificats")
+
+    def get_stats(self) -> dict:
+        return {
+            'certificats': self.__cache.get_stats(),
+            'negatifs': len(self.__negatif),
+            'chargements': self.chargements,
+            'coalesces': self.coalesces,
+            'rejets_negatifs': self.negatifs,
+        }
+
+
+class CacheChaines:
+    """
+    Cache des certificats tiers (handle_get_jwt) :
+    - EnveloppeCertificat deja parsees, cle : digest du PEM ;
+    - chaines deja validees par valider_certificat_tiers, cle : (fingerprint CA, digest du PEM du certificat).
+    Une entree expire au notAfter du certificat (ou de la CA), au plus tard apres TTL_CHAINE.
+    Une validation en echec n'est pas conservee.
+    """
+
+    def __init__(self, taille_max=2000):
+        self.__enveloppes = CacheExpiration(taille_max)
+        self.__chaines = CacheExpiration(taille_max)
+
+    def charger_enveloppe(self, pem: str) -> EnveloppeCertificat:
+        cle = digest_pem(pem)
+        enveloppe = self.__enveloppes.get(cle)
+        if enveloppe is None:
+            enveloppe = EnveloppeCertificat.from_pem(pem)
+            self.__enveloppes.put(cle, enveloppe, min(time.time() + TTL_CHAINE, get_expiration(enveloppe)))
+        return enveloppe
+
+    def valider(self, pem_millegrille: str, pem_certificat) -> tuple[EnveloppeCertificat, EnveloppeCertificat]:
+        """
+        :return: (enveloppe de la millegrille tierce, enveloppe du certificat valide)
+        :raises Exception: Chaine invalide (exception de valider_certificat_tiers).
+        """
+        enveloppe_millegrille = self.charger_enveloppe(pem_millegrille)
+        cle = (enveloppe_millegrille.fingerprint, digest_pem(pem_certificat))
+        enveloppe_certificat = self.__chaines.get(cle)
+        if enveloppe_certificat is None:
+            enveloppe_certificat = valider_certificat_tiers(enveloppe_millegrille, pem_certificat)
+            expiration = min(time.time() + TTL_CHAINE, get_expiration(enveloppe_millegrille),
+                             get_expiration(enveloppe_certificat))
+            self.__chaines.put(cle, enveloppe_certificat, expiration)
+        return enveloppe_millegrille, enveloppe_certificat
+
+    def purger(self):
+        self.__enveloppes.purger()
+        self.__chaines.purger()
+
+    def get_stats(self) -> dict:
+        return {'enveloppes': self.__enveloppes.get_stats(), 'chaines': self.__chaines.get_stats()}
+
+
+def digest_pem(pem) -> bytes:
+    """ Digest d'un PEM ou d'une liste de PEM (chaine). """
+    if isinstance(pem, list):
+        pem = '\n'.join(pem)
+    return hashlib.sha256(pem.encode('utf-8')).digest()
+
+
+def get_expiration(enveloppe: EnveloppeCertificat) -> float:
+    """ notAfter du certificat (epoch). """
+    try:
+        not_valid_after = enveloppe.certificat.not_valid_after
+    except AttributeError:
+        return time.time() + TTL_CHAINE
+    if not_valid_after.tzinfo is None:
+        not_valid_after = not_valid_after.replace(tzinfo=datetime.timezone.utc)
+    return not_valid_after.timestamp()
+
+
+def lire_fingerprints(path_fichier: pathlib.Path) -> list[str]:
+    with open(path_fichier, 'rt') as fichier:
+        return [l.strip() for l in fichier if l.strip() != '']
+
+
+def ecrire_fingerprints(path_fichier: pathlib.Path, fingerprints: list[str]):
+    path_work = pathlib.Path(str(path_fichier) + '.work')
+    with open(path_work, 'wt') as fichier:
+        fichier.write(''.join('%s\n' % f for f in fingerprints))
+    path_work.rename(path_fichier)
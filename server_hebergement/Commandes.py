@@ -1,3 +1,4 @@
+import datetime
 import logging
 
 from cryptography.x509.extensions import ExtensionNotFound
@@ -14,6 +15,7 @@ class CommandHebergementHandler(CommandHandler):
     def __init__(self, web_app):
         super().__init__(web_app)
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__web_app = web_app
 
     def configurer_consumers(self, messages_thread: MessagesThread):
         super().configurer_consumers(messages_thread)
@@ -65,6 +67,16 @@ class CommandHebergementHandler(CommandHandler):
     async def traiter_cedule(self, producer: MessageProducerFormatteur, message: MessageWrapper):
         await super().traiter_cedule(producer, message)
 
+        contenu = message.parsed
+        date_cedule = datetime.datetime.fromtimestamp(contenu['estampille'], tz=datetime.timezone.utc)
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        if now - datetime.timedelta(minutes=2) > date_cedule:
+            return  # Vieux message de cedule
+
+        if date_cedule.minute % 15 == 0:
+            # Nettoyage du staging d'upload, execute en arriere-plan par la consignation
+            self.__web_app.web_server.consignation.declencher_nettoyage_staging()
+
         # contenu = message.parsed
         # date_cedule = datetime.datetime.fromtimestamp(contenu['estampille'], tz=pytz.UTC)
         #
@@ -10,7 +10,23 @@ HEADER_JWT = 'X-jwt'
 
 DIR_STAGING_UPLOAD = 'staging/upload'
 DIR_STAGING_INTAKE = 'staging/intake'
+DIR_STAGING_BACKUP = 'staging/backup'
 
 FICHIER_ETAT = 'etat.json'
 FICHIER_TRANSACTION = 'transaction.json'
+FICHIER_UPLOAD_DONNEES = 'fichier.work'
+FICHIER_UPLOAD_RECU = 'recu.json'
+FICHIER_REFERENCES = 'references_fuuids.txt'
+FICHIER_CERTIFICATS = 'certificats_connus.txt'
+FICHIER_JOURNAL_SESSIONS = 'journal_sessions.jsonl'
 
+MODE_UPLOAD_PARTS = 'parts'  # Un fichier {position}.part par PUT
+MODE_UPLOAD_FICHIER = 'fichier'  # Un seul fichier, ecritures positionnelles et intervalles recus
+
+ENV_VERIFIER_WORKERS = 'HEBERGEMENT_VERIFIER_WORKERS'
+ENV_MODE_UPLOAD = 'HEBERGEMENT_MODE_UPLOAD'
+ENV_STAGING_EXPIRATION = 'HEBERGEMENT_STAGING_EXPIRATION'
+ENV_STAGING_BUDGET = 'HEBERGEMENT_STAGING_BUDGET'
+ENV_STAGING_BUDGET_IDMG = 'HEBERGEMENT_STAGING_BUDGET_IDMG'
+ENV_JWT_CACHE_TTL = 'HEBERGEMENT_JWT_CACHE_TTL'
+ENV_METRICS_TOKEN = 'HEBERGEMENT_METRICS_TOKEN'  # /metrics avec Authorization: Bearer, desactive sans jeton
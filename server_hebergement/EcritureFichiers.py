@@ -0,0 +1,333 @@
+import asyncio
+import errno
+import os
+import pathlib
+import shutil
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+TAILLE_TAMPON_ECRITURE = 1024 * 1024  # Regrouper les chunks recus en ecritures d'au moins 1 MiB
+MAX_TAMPONS_EN_VOL = 4  # Tampons en attente d'ecriture par fichier avant de ralentir la reception
+MAX_BUFFERS_IOV = 256
+TAILLE_TAMPON_COPIE = 8 * 1024 * 1024
+FICHIER_ASSEMBLAGE = 'assemblage.%s.work'  # Nom unique par assemblage
+ERRNO_COPIE_NON_SUPPORTEE = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+class PoolEcriture:
+    """
+    Pool de threads dedie aux operations disque (ecriture, stat, rename, rmtree) pour ne pas bloquer la loop.
+    """
+
+    def __init__(self, nombre_threads: int = 8):
+        self.__executor = ThreadPoolExecutor(max_workers=nombre_threads, thread_name_prefix='ecriture')
+
+    async def executer(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.__executor, fn, *args)
+
+    def fermer(self):
+        self.__executor.shutdown(wait=True)
+
+
+class EcrivainFichier:
+    """
+    Ecriture sequentielle d'un fichier via le PoolEcriture.
+
+    Les chunks sont regroupes en tampons (os.writev, sans copie) et le nombre de tampons en vol est borne :
+    write() bloque la reception (backpressure) lorsque le disque ne suit pas. Les hacheurs sont mis a jour
+    dans le thread d'ecriture, dans l'ordre du fichier.
+    """
+
+    def __init__(self, pool: PoolEcriture, path_fichier: pathlib.Path, hacheurs: Optional[list] = None,
+                 taille_tampon=TAILLE_TAMPON_ECRITURE, max_en_vol=MAX_TAMPONS_EN_VOL,
+                 offset: Optional[int] = None, preallocation: Optional[int] = None):
+        """
+        :param offset: Ecriture positionnelle a partir de offset dans un fichier existant (sans troncature).
+        :param preallocation: Nombre d'octets a reserver sur disque (fallocate) a partir de offset.
+        """
+        self.__pool = pool
+        self.__path_fichier = path_fichier
+        self.__offset = offset
+        self.__preallocation = preallocation
+        self.__hacheurs = [h for h in hacheurs or list() if h is not None]
+        self.__taille_tampon = taille_tampon
+        self.__fd: Optional[int] = None
+        self.__tampon: list = list()
+        self.__taille_courante = 0
+        self.__queue: asyncio.Queue = asyncio.Queue(maxsize=max_en_vol)
+        self.__task_ecriture: Optional[asyncio.Task] = None
+        self.__abandonne = False
+        self.taille = 0
+
+    async def ouvrir(self):
+        if self.__offset is None:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        else:
+            flags = os.O_WRONLY | os.O_CREAT
+        self.__fd = await self.__pool.executer(os.open, str(self.__path_fichier), flags, 0o644)
+        if self.__preallocation:
+            await self.__pool.executer(preallouer, self.__fd, self.__offset or 0, self.__preallocation)
+        self.__task_ecriture = asyncio.create_task(self.__thread_ecriture())
+
+    async def write(self, chunk: bytes):
+        self.__tampon.append(chunk)
+        self.__taille_courante += len(chunk)
+        self.taille += len(chunk)
+        if self.__taille_courante >= self.__taille_tampon or len(self.__tampon) >= MAX_BUFFERS_IOV:
+            await self.__soumettre()
+
+    async def fermer(self):
+        """ Ecrit le dernier tampon et ferme le fichier. Lance l'exception d'ecriture s'il y a lieu. """
+        try:
+            if len(self.__tampon) > 0:
+                await self.__soumettre()
+            await self.__put(None)
+            await self.__task_ecriture
+        finally:
+            await self.__fermer_fd()
+
+    async def abandonner(self):
+        # Ne pas annuler une ecriture en cours dans le pool (le fd serait ferme pendant l'ecriture)
+        self.__abandonne = True
+        if self.__task_ecriture is not None:
+            try:
+                if self.__task_ecriture.done() is False:
+                    await self.__put(None)
+                await self.__task_ecriture
+            except Exception:
+                pass  # Fichier abandonne
+        await self.__fermer_fd()
+
+    async def __soumettre(self):
+        tampon = self.__tampon
+        self.__tampon = list()
+        self.__taille_courante = 0
+        await self.__put(tampon)
+
+    async def __put(self, item):
+        if self.__queue.full() is False:
+            self.__queue.put_nowait(item)
+            return
+
+        # Queue pleine, attendre la thread d'ecriture (backpressure) ou son arret sur erreur
+        put = asyncio.ensure_future(self.__queue.put(item))
+        await asyncio.wait([put, self.__task_ecriture], return_when=asyncio.FIRST_COMPLETED)
+        if put.done() is False:
+            put.cancel()
+            self.__task_ecriture.result()  # Lance l'exception de la thread d'ecriture
+            raise Exception('EcrivainFichier thread ecriture arretee')
+
+    async def __thread_ecriture(self):
+        while True:
+            tampon = await self.__queue.get()
+            if tampon is None:
+                return
+            if self.__abandonne is False:
+                await self.__pool.executer(self.__ecrire, tampon)
+
+    def __ecrire(self, tampon: list):
+        for hacheur in self.__hacheurs:
+            for chunk in tampon:
+                hacheur.update(chunk)
+        if self.__offset is None:
+            ecrire_buffers(self.__fd, tampon)
+        else:
+            self.__offset += ecrire_buffers(self.__fd, tampon, self.__offset)
+
+    async def __fermer_fd(self):
+        fd = self.__fd
+        self.__fd = None
+        if fd is not None:
+            await self.__pool.executer(os.close, fd)
+
+
+def ecrire_buffers(fd: int, buffers: list, offset: Optional[int] = None) -> int:
+    """ Ecrit tous les buffers (writev ou pwritev si offset est fourni). :return: Nombre d'octets ecrits. """
+    total = sum(len(b) for b in buffers)
+    if offset is None:
+        ecrit = os.writev(fd, buffers)
+    else:
+        ecrit = os.pwritev(fd, buffers, offset)
+    if ecrit < total:
+        # Ecriture partielle, completer le reste
+        restant = memoryview(b''.join(buffers))[ecrit:]
+        while len(restant) > 0:
+            if offset is None:
+                n = os.write(fd, restant)
+            else:
+                n = os.pwrite(fd, restant, offset + ecrit)
+            ecrit += n
+            restant = restant[n:]
+    return total
+
+
+def preallouer(fd: int, offset: int, taille: int):
+    try:
+        os.posix_fallocate(fd, offset, taille)
+    except (AttributeError, OSError):
+        pass  # Non supporte par le systeme de fichiers, l'espace sera alloue a l'ecriture
+
+
+def preallouer_fichier(path_fichier: pathlib.Path, taille: int):
+    """
+    Cree le fichier et reserve taille octets sur disque.
+    :raises OSError: ENOSPC si l'espace disque est insuffisant.
+    """
+    fd = os.open(str(path_fichier), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        os.posix_fallocate(fd, 0, taille)
+    except AttributeError:
+        pass  # posix_fallocate non disponible sur cette plateforme
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        # Non supporte par le systeme de fichiers, l'espace sera alloue a l'ecriture
+    finally:
+        os.close(fd)
+
+
+def lister_parts(path_upload: pathlib.Path) -> \
+        tuple[list[tuple[int, pathlib.Path, os.stat_result]], list[pathlib.Path]]:
+    """
+    Liste les parts {position}.part d'un upload dans l'ordre des positions. Bloquant, utiliser le pool.
+
+    Une part entierement couverte par la part precedente est le reste d'un assemblage interrompu (apres le
+    rename vers 0.part, avant le retrait des autres parts). Elle est ignoree, assembler_parts la retire.
+    :return: (parts [(position, path, stat)], paths des parts couvertes)
+    """
+    parts = list()
+    with os.scandir(path_upload) as entrees:
+        for entree in entrees:
+            if entree.name.endswith('.part') and entree.is_file():
+                parts.append((int(entree.name.split('.')[0]), pathlib.Path(entree.path), entree.stat()))
+    parts.sort(key=lambda p: p[0])
+
+    retenues = list()
+    couvertes = list()
+    fin = 0
+    for part in parts:
+        position, path_part, stat_part = part
+        if len(retenues) > 0 and position + stat_part.st_size <= fin:
+            couvertes.append(path_part)
+            continue
+        retenues.append(part)
+        fin = max(fin, position + stat_part.st_size)
+    return retenues, couvertes
+
+
+def assembler_parts(path_upload: pathlib.Path) -> Optional[tuple[int, str]]:
+    """
+    Assemble les parts {position}.part d'un upload en un seul fichier 0.part. Bloquant, utiliser le pool.
+
+    La copie est faite dans le noyau (copy_file_range, qui partage les blocs / reflink sur btrfs et XFS,
+    puis sendfile), sinon par un tampon de 8 MiB. Le fichier assemble remplace 0.part par rename.
+    :return: (taille, methode) ou None s'il y a une seule part.
+    """
+    parts, couvertes = lister_parts(path_upload)
+    for path_part in couvertes:
+        path_part.unlink(missing_ok=True)  # Terminer un assemblage interrompu
+    if len(parts) <= 1:
+        return None
+
+    # O_EXCL sous un nom unique : un autre assemblage du meme repertoire ne peut pas ecrire dans ce fichier
+    path_assemblage = pathlib.Path(path_upload, FICHIER_ASSEMBLAGE % uuid.uuid4().hex)
+    methode = None
+    taille = 0
+    fd_destination = os.open(str(path_assemblage), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        for position, path_part, _stat in parts:
+            if position != taille:
+                raise ValueError('Upload incomplet, part %d attendue a la position %d' % (position, taille))
+            with open(path_part, 'rb', buffering=0) as fichier_part:
+                copie, methode_part = copier_fichier(fichier_part.fileno(), fd_destination, taille, methode)
+            methode = methode_part  # Une methode non supportee n'est pas reessayee pour les parts suivantes
+            taille += copie
+    except BaseException:
+        os.close(fd_destination)
+        path_assemblage.unlink(missing_ok=True)
+        raise
+    os.close(fd_destination)
+
+    # Point de bascule : le fichier assemble remplace la premiere part, les autres parts sont retirees.
+    # Une interruption ici laisse des parts couvertes par 0.part, ignorees par lister_parts et retirees
+    # au prochain assemblage.
+    path_assemblage.rename(pathlib.Path(path_upload, '0.part'))
+    for position, path_part, _stat in parts:
+        if position != 0:
+            path_part.unlink(missing_ok=True)
+
+    return taille, methode
+
+
+def copier_fichier(fd_source: int, fd_destination: int, offset_destination: int,
+                   methode: Optional[str] = None) -> tuple[int, str]:
+    """
+    Copie tout le fichier source a offset_destination.
+    :param methode: Methode a utiliser (None : essayer copy_file_range, puis sendfile, puis le tampon).
+    :return: (octets copies, methode utilisee)
+    """
+    taille = os.fstat(fd_source).st_size
+    if methode in [None, 'copy_file_range']:
+        try:
+            copie = 0
+            while copie < taille:
+                n = os.copy_file_range(fd_source, fd_destination, taille - copie, copie, offset_destination + copie)
+                if n == 0:
+                    break
+                copie += n
+            return copie, 'copy_file_range'
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in ERRNO_COPIE_NON_SUPPORTEE:
+                raise
+            # Non supporte, la destination est reecrite au complet par la methode suivante
+
+    if methode in [None, 'copy_file_range', 'sendfile']:
+        try:
+            os.lseek(fd_destination, offset_destination, os.SEEK_SET)
+            copie = 0
+            while copie < taille:
+                n = os.sendfile(fd_destination, fd_source, copie, taille - copie)
+                if n == 0:
+                    break
+                copie += n
+            return copie, 'sendfile'
+        except (AttributeError, OSError) as e:
+            if isinstance(e, OSError) and e.errno not in ERRNO_COPIE_NON_SUPPORTEE:
+                raise
+
+    tampon = memoryview(bytearray(min(TAILLE_TAMPON_COPIE, max(taille, 1))))
+    copie = 0
+    while copie < taille:
+        n = os.preadv(fd_source, [tampon], copie)
+        if n == 0:
+            break
+        ecrire_buffers(fd_destination, [tampon[:n]], offset_destination + copie)
+        copie += n
+    return copie, 'tampon'
+
+
+def creer_repertoire(path_repertoire: pathlib.Path) -> bool:
+    """ :return: True si le repertoire a ete cree, False s'il existait deja. """
+    try:
+        path_repertoire.mkdir(parents=True)
+        return True
+    except FileExistsError:
+        return False
+
+
+def get_taille_fichier(path_fichier: pathlib.Path) -> Optional[int]:
+    try:
+        return path_fichier.stat().st_size
+    except FileNotFoundError:
+        return None
+
+
+def supprimer_fichier(path_fichier: pathlib.Path):
+    path_fichier.unlink(missing_ok=True)
+
+
+def supprimer_repertoire(path_repertoire: pathlib.Path):
+    shutil.rmtree(path_repertoire, ignore_errors=True)
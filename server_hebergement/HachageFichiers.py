@@ -0,0 +1,152 @@
+import mmap
+import os
+import pathlib
+import threading
+import time
+
+from typing import Optional
+
+from millegrilles_messages.messages.Hachage import VerificateurHachage
+
+from server_hebergement.EcritureFichiers import lister_parts
+
+TAILLE_TAMPON = 4 * 1024 * 1024  # Lecture par blocs de 4 MiB (un tampon reutilise par thread)
+SEUIL_MMAP = 64 * 1024 * 1024  # Fichiers (ou segments) plus gros : lecture via mmap
+
+STRATEGIE_LECTURE = 'readinto'
+STRATEGIE_MMAP = 'mmap'
+
+
+class ResultatHachage:
+
+    def __init__(self):
+        self.octets = 0
+        self.duree = 0.0
+        self.fichiers = 0
+        self.strategies: set[str] = set()
+
+    @property
+    def debit(self) -> float:
+        """ Mo/s """
+        if self.duree <= 0:
+            return 0.0
+        return self.octets / (1024 * 1024) / self.duree
+
+    def __str__(self):
+        return '%d octets, %d fichiers en %.3fs (%.1f Mo/s, %s)' % (
+            self.octets, self.fichiers, self.duree, self.debit, ','.join(sorted(self.strategies)))
+
+
+class MoteurHachage:
+    """
+    Lecture de fichiers pour le hachage sans allocation par bloc : readinto dans un tampon preallou
+    (un par thread) ou mmap pour les gros fichiers. Les lectures sont annoncees sequentielles au noyau
+    (posix_fadvise / madvise) pour maximiser le read-ahead.
+    """
+
+    def __init__(self, taille_tampon=TAILLE_TAMPON, seuil_mmap=SEUIL_MMAP):
+        self.__taille_tampon = taille_tampon
+        self.__seuil_mmap = seuil_mmap
+        self.__local = threading.local()
+
+    def __get_tampon(self) -> memoryview:
+        tampon = getattr(self.__local, 'tampon', None)
+        if tampon is None:
+            tampon = memoryview(bytearray(self.__taille_tampon))
+            self.__local.tampon = tampon
+        return tampon
+
+    def choisir_strategie(self, taille: int) -> str:
+        if taille >= self.__seuil_mmap:
+            return STRATEGIE_MMAP
+        return STRATEGIE_LECTURE
+
+    def hacher_fichier(self, hacheur, path_fichier: pathlib.Path, offset: int = 0,
+                       taille_max: Optional[int] = None, resultat: Optional[ResultatHachage] = None) -> int:
+        """
+        Met a jour hacheur avec le contenu du fichier a partir de offset. Bloquant, utiliser un thread.
+        :return: Nombre d'octets lus.
+        """
+        with open(path_fichier, 'rb', buffering=0) as fichier:
+            fd = fichier.fileno()
+            taille = os.fstat(fd).st_size - offset
+            if taille_max is not None:
+                taille = min(taille, taille_max)
+            if taille <= 0:
+                return 0
+
+            strategie = self.choisir_strategie(taille)
+            if strategie == STRATEGIE_MMAP:
+                lu = self.__hacher_mmap(hacheur, fd, offset, taille)
+            else:
+                conseiller_lecture_sequentielle(fd, offset, taille)
+                lu = self.__hacher_readinto(hacheur, fichier, offset, taille)
+
+        if resultat is not None:
+            resultat.octets += lu
+            resultat.fichiers += 1
+            resultat.strategies.add(strategie)
+        return lu
+
+    def __hacher_readinto(self, hacheur, fichier, offset: int, taille: int) -> int:
+        tampon = self.__get_tampon()
+        if offset > 0:
+            fichier.seek(offset)
+        lu = 0
+        while lu < taille:
+            vue = tampon[:min(len(tampon), taille - lu)]
+            n = fichier.readinto(vue)
+            if not n:
+                break
+            hacheur.update(vue[:n])
+            lu += n
+        return lu
+
+    def __hacher_mmap(self, hacheur, fd: int, offset: int, taille: int) -> int:
+        # L'offset d'un mmap doit etre aligne sur ALLOCATIONGRANULARITY
+        debut_map = offset - offset % mmap.ALLOCATIONGRANULARITY
+        decalage = offset - debut_map
+        with mmap.mmap(fd, decalage + taille, access=mmap.ACCESS_READ, offset=debut_map) as carte:
+            try:
+                carte.madvise(mmap.MADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                pass  # madvise non disponible
+            vue = memoryview(carte)
+            try:
+                position = decalage
+                fin = decalage + taille
+                while position < fin:
+                    suivant = min(position + self.__taille_tampon, fin)
+                    hacheur.update(vue[position:suivant])
+                    position = suivant
+            finally:
+                vue.release()  # Requis avant la fermeture du mmap
+        return taille
+
+    def verifier_upload_parts(self, path_upload: pathlib.Path, hachage: str) -> ResultatHachage:
+        """
+        Verifie le hachage des parts {position}.part concatenees dans l'ordre. Bloquant, utiliser un thread.
+        :raises ErreurHachage: Hachage incorrect.
+        """
+        debut = time.monotonic()
+        resultat = ResultatHachage()
+
+        parts, _couvertes = lister_parts(path_upload)  # Ignorer les restes d'un assemblage interrompu
+
+        verificateur = VerificateurHachage(hachage)
+        for _position, path_part, _stat in parts:
+            self.hacher_fichier(verificateur, path_part, resultat=resultat)
+
+        resultat.duree = time.monotonic() - debut
+        verificateur.verify()  # Lance une exception si le hachage est incorrect
+        return resultat
+
+
+def conseiller_lecture_sequentielle(fd: int, offset: int, taille: int):
+    try:
+        os.posix_fadvise(fd, offset, taille, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError):
+        pass  # Non supporte sur cette plateforme
+
+
+MOTEUR_HACHAGE = MoteurHachage()
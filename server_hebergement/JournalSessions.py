@@ -0,0 +1,243 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+
+from typing import Optional
+
+from server_hebergement import Constantes as ConstantesHebergement
+
+OP_OUVRIR = 'ouvrir'  # Nouvelle session (mode, taille declaree)
+OP_PART = 'part'  # Part (ou intervalle en mode fichier) recue et conservee sur disque
+OP_POST = 'post'  # Upload termine par POST, en attente de verification
+OP_VERIFIE = 'verifie'  # Hachage du fichier complet verifie
+OP_INTAKE = 'intake'  # Remis a l'intake, fin de la session
+OP_RETIRER = 'retirer'  # Session abandonnee (erreur, nettoyage)
+
+SEUIL_COMPACTION = 10_000  # Lignes ecrites depuis la derniere compaction
+FACTEUR_COMPACTION = 4  # Compacter seulement si le journal est plus gros que FACTEUR x les lignes d'un instantane
+
+
+class EtatSessionJournal:
+    """ Etat d'une session d'upload reconstruit a partir du journal. """
+
+    def __init__(self, idmg: str, fuuid: str, mode: str, taille_declaree: Optional[int], date: float):
+        self.idmg = idmg
+        self.fuuid = fuuid
+        self.mode = mode
+        self.taille_declaree = taille_declaree
+        self.parts: dict[int, int] = dict()  # position: taille
+        self.hachage: Optional[str] = None  # Hachage recu par POST
+        self.verifie = False
+        self.date = date  # Dernier evenement (epoch secondes)
+
+    def instantane(self) -> list[dict]:
+        """ Evenements minimaux pour reconstruire cet etat. """
+        cle = {'idmg': self.idmg, 'fuuid': self.fuuid}
+        evenements = [dict(cle, op=OP_OUVRIR, mode=self.mode, taille=self.taille_declaree, date=self.date)]
+        for position, taille in sorted(self.parts.items()):
+            evenements.append(dict(cle, op=OP_PART, position=position, taille=taille, date=self.date))
+        if self.hachage is not None:
+            evenements.append(dict(cle, op=OP_POST, hachage=self.hachage, date=self.date))
+        if self.verifie:
+            evenements.append(dict(cle, op=OP_VERIFIE, date=self.date))
+        return evenements
+
+
+class JournalSessions:
+    """
+    Journal append-only des evenements des sessions d'upload (une ligne json par evenement).
+
+    Les evenements sont ajoutes en memoire sans bloquer la loop et ecrits par lot par run() : une seule
+    ecriture et un seul fsync pour tous les evenements accumules pendant l'ecriture precedente.
+    Le journal est compacte (instantane des sessions actives) lorsqu'il devient trop gros, le redemarrage
+    est donc proportionnel au nombre de sessions actives plutot qu'au nombre de fichiers du staging.
+    """
+
+    def __init__(self, path_fichier: pathlib.Path):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__path_fichier = path_fichier
+        self.__etats: dict[tuple, EtatSessionJournal] = dict()
+        self.__fd: Optional[int] = None
+        self.__tampon: list[str] = list()
+        self.__attentes: list[asyncio.Future] = list()
+        self.__event_ecriture = asyncio.Event()
+        self.__lignes_ecrites = 0
+        self.ecritures = 0
+        self.evenements = 0
+        self.compactions = 0
+
+    def charger(self) -> Optional[list[EtatSessionJournal]]:
+        """
+        Rejoue et compacte le journal. Bloquant, utiliser un thread.
+        :return: Sessions actives, None si le journal n'existe pas (premier demarrage).
+        """
+        etats = dict()
+        try:
+            with open(self.__path_fichier, 'rt') as fichier:
+                for ligne in fichier:
+                    try:
+                        appliquer_evenement(etats, json.loads(ligne))
+                    except (ValueError, KeyError, TypeError):
+                        continue  # Ligne incomplete (arret pendant une ecriture)
+        except FileNotFoundError:
+            etats = None
+
+        self.__etats = etats or dict()
+        self.compacter()
+        if etats is None:
+            return None
+        self.__logger.info("charger %d sessions actives dans le journal" % len(self.__etats))
+        return list(self.__etats.values())
+
+    def initialiser(self, etats: list[EtatSessionJournal]):
+        """ Remplace le contenu du journal (sessions reconstruites a partir du disque). Bloquant. """
+        self.__etats = dict(((e.idmg, e.fuuid), e) for e in etats)
+        self.compacter()
+
+    def compacter(self, lignes: Optional[list[str]] = None):
+        """ Reecrit le journal avec un instantane des sessions actives. Bloquant, utiliser un thread. """
+        if lignes is None:
+            lignes = self.__instantane()
+        path_work = pathlib.Path(str(self.__path_fichier) + '.work')
+        path_work.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(str(path_work), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, ''.join(lignes).encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        path_work.rename(self.__path_fichier)
+        synchroniser_repertoire(self.__path_fichier.parent)
+
+        if self.__fd is not None:
+            os.close(self.__fd)
+        self.__fd = os.open(str(self.__path_fichier), os.O_WRONLY | os.O_APPEND)
+        self.__lignes_ecrites = len(lignes)
+        self.compactions += 1
+
+    def __instantane(self) -> list[str]:
+        return [json.dumps(e) + '\n' for etat in self.__etats.values() for e in etat.instantane()]
+
+    def ajouter(self, op: str, idmg: str, fuuid: str, **donnees):
+        """ Ajoute un evenement. Non bloquant, l'ecriture est faite par run(). """
+        evenement = dict(donnees, op=op, idmg=idmg, fuuid=fuuid, date=time.time())
+        appliquer_evenement(self.__etats, evenement)
+        self.__tampon.append(json.dumps(evenement) + '\n')
+        self.evenements += 1
+        self.__event_ecriture.set()
+
+    async def synchroniser(self):
+        """ Attend que tous les evenements deja ajoutes soient sur disque (fsync). """
+        if len(self.__tampon) == 0 and len(self.__attentes) == 0:
+            return
+        attente = asyncio.get_running_loop().create_future()
+        self.__attentes.append(attente)
+        self.__event_ecriture.set()
+        await attente
+
+    async def run(self, stop_event: asyncio.Event, executer):
+        """ :param executer: Fonction async pour les operations disque (PoolEcriture.executer). """
+        while stop_event.is_set() is False:
+            wait_stop = asyncio.create_task(stop_event.wait())
+            wait_ecriture = asyncio.create_task(self.__event_ecriture.wait())
+            await asyncio.wait([wait_stop, wait_ecriture], return_when=asyncio.FIRST_COMPLETED)
+            wait_stop.cancel()
+            wait_ecriture.cancel()
+            self.__event_ecriture.clear()
+            try:
+                await self.__vider(executer)
+            except Exception:
+                self.__logger.exception("run Erreur ecriture du journal des sessions")
+
+        await self.__vider(executer)  # Derniers evenements avant l'arret
+
+    async def __vider(self, executer):
+        # Les evenements ajoutes pendant l'ecriture sont conserves pour le prochain lot
+        lignes, self.__tampon = self.__tampon, list()
+        attentes, self.__attentes = self.__attentes, list()
+        try:
+            if len(lignes) > 0:
+                await executer(self.__ecrire, lignes)
+                self.__lignes_ecrites += len(lignes)
+                self.ecritures += 1
+        except Exception as e:
+            for attente in attentes:
+                if attente.done() is False:
+                    attente.set_exception(e)
+            raise
+        for attente in attentes:
+            if attente.done() is False:
+                attente.set_result(None)
+
+        nombre_instantane = sum(1 + len(e.parts) for e in self.__etats.values())
+        if self.__lignes_ecrites > SEUIL_COMPACTION and \
+                self.__lignes_ecrites > FACTEUR_COMPACTION * nombre_instantane:
+            # Les evenements ajoutes pendant la compaction sont deja inclus dans l'instantane. Ils sont
+            # quand meme ajoutes a la suite : rejouer un evenement sur son propre resultat ne change pas l'etat.
+            await executer(self.compacter, self.__instantane())
+            self.__logger.info("vider Journal des sessions compacte (%d sessions)" % len(self.__etats))
+
+    def __ecrire(self, lignes: list[str]):
+        os.write(self.__fd, ''.join(lignes).encode('utf-8'))
+        os.fsync(self.__fd)
+
+    def fermer(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def get_stats(self) -> dict:
+        return {
+            'sessions': len(self.__etats),
+            'evenements': self.evenements,
+            'ecritures': self.ecritures,
+            'compactions': self.compactions,
+        }
+
+    def __len__(self):
+        return len(self.__etats)
+
+
+def appliquer_evenement(etats: dict[tuple, EtatSessionJournal], evenement: dict):
+    """ Applique un evenement a l'index des sessions. Rejouer un evenement deja applique est sans effet. """
+    op = evenement['op']
+    cle = (evenement['idmg'], evenement['fuuid'])
+    if op == OP_OUVRIR:
+        etats[cle] = EtatSessionJournal(cle[0], cle[1], evenement['mode'], evenement.get('taille'), evenement['date'])
+        return
+    if op in [OP_INTAKE, OP_RETIRER]:
+        etats.pop(cle, None)
+        return
+
+    etat = etats.get(cle)
+    if etat is None:
+        return  # Session deja terminee
+    etat.date = evenement['date']
+    if op == OP_PART:
+        etat.parts[evenement['position']] = evenement['taille']
+    elif op == OP_POST:
+        etat.hachage = evenement['hachage']
+        taille = evenement.get('taille')
+        if taille is not None:
+            # Mode fichier finalise : le repertoire contient maintenant une seule part
+            etat.mode = ConstantesHebergement.MODE_UPLOAD_PARTS
+            etat.parts = {0: taille}
+    elif op == OP_VERIFIE:
+        etat.verifie = True
+
+
+def synchroniser_repertoire(path_repertoire: pathlib.Path):
+    """ fsync d'un repertoire (rename durable). """
+    try:
+        fd = os.open(str(path_repertoire), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # Non supporte sur ce systeme de fichiers
+    finally:
+        os.close(fd)
@@ -0,0 +1,194 @@
+import bisect
+import hmac
+import time
+
+from typing import Optional
+
+from aiohttp import web
+from aiohttp.web_request import Request
+
+BUCKETS_DUREE = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Metrique:
+    """
+    Valeurs par combinaison de labels, en memoire. Mise a jour O(1) sans verrou (loop asyncio),
+    le formattage est fait seulement lors de la lecture de /metrics.
+    """
+
+    type_metrique = 'untyped'
+
+    def __init__(self, nom: str, description: str, labels: tuple = ()):
+        self.nom = nom
+        self.description = description
+        self.labels = labels
+        self._valeurs: dict[tuple, float] = dict()
+
+    def formatter(self) -> list[str]:
+        lignes = ['# HELP %s %s' % (self.nom, self.description), '# TYPE %s %s' % (self.nom, self.type_metrique)]
+        for labels, valeur in self._valeurs.items():
+            lignes.append('%s%s %s' % (self.nom, formatter_labels(self.labels, labels), formatter_valeur(valeur)))
+        return lignes
+
+
+class Compteur(Metrique):
+
+    type_metrique = 'counter'
+
+    def inc(self, *labels, valeur: float = 1.0):
+        self._valeurs[labels] = self._valeurs.get(labels, 0.0) + valeur
+
+    def set(self, *labels, valeur: float):
+        """ Copie d'un total maintenu ailleurs (e.g. statistiques de l'ordonnanceur). """
+        self._valeurs[labels] = valeur
+
+
+class Jauge(Metrique):
+
+    type_metrique = 'gauge'
+
+    def set(self, *labels, valeur: float):
+        self._valeurs[labels] = valeur
+
+    def inc(self, *labels, valeur: float = 1.0):
+        self._valeurs[labels] = self._valeurs.get(labels, 0.0) + valeur
+
+    def dec(self, *labels, valeur: float = 1.0):
+        self._valeurs[labels] = self._valeurs.get(labels, 0.0) - valeur
+
+
+class Histogramme(Metrique):
+
+    type_metrique = 'histogram'
+
+    def __init__(self, nom: str, description: str, labels: tuple = (), buckets=BUCKETS_DUREE):
+        super().__init__(nom, description, labels)
+        self.buckets = tuple(buckets)
+        self.__series: dict[tuple, list] = dict()  # labels: [compte par bucket (+Inf a la fin), somme]
+
+    def observe(self, valeur: float, *labels):
+        serie = self.__series.get(labels)
+        if serie is None:
+            serie = [[0] * (len(self.buckets) + 1), 0.0]
+            self.__series[labels] = serie
+        serie[0][bisect.bisect_left(self.buckets, valeur)] += 1
+        serie[1] += valeur
+
+    def formatter(self) -> list[str]:
+        lignes = ['# HELP %s %s' % (self.nom, self.description), '# TYPE %s histogram' % self.nom]
+        noms_labels = self.labels + ('le',)
+        for labels, (comptes, somme) in self.__series.items():
+            cumul = 0
+            for borne, compte in zip(self.buckets + (float('inf'),), comptes):
+                cumul += compte
+                lignes.append('%s_bucket%s %d' % (
+                    self.nom, formatter_labels(noms_labels, labels + (formatter_valeur(borne),)), cumul))
+            lignes.append('%s_sum%s %s' % (self.nom, formatter_labels(self.labels, labels), formatter_valeur(somme)))
+            lignes.append('%s_count%s %d' % (self.nom, formatter_labels(self.labels, labels), cumul))
+        return lignes
+
+
+class RegistreMetriques:
+
+    def __init__(self, jeton: Optional[str] = None):
+        """ :param jeton: Jeton requis pour lire /metrics (Authorization: Bearer). None : /metrics desactive. """
+        self.__jeton = jeton
+        self.__metriques: list[Metrique] = list()
+        self.__collecteurs: list = list()
+
+    def ajouter(self, metrique: Metrique) -> Metrique:
+        self.__metriques.append(metrique)
+        return metrique
+
+    def ajouter_collecteur(self, collecteur):
+        """ Fonction appelee avant chaque lecture pour copier les valeurs maintenues ailleurs (jauges). """
+        self.__collecteurs.append(collecteur)
+
+    def formatter(self) -> str:
+        for collecteur in self.__collecteurs:
+            collecteur()
+        lignes = list()
+        for metrique in self.__metriques:
+            lignes.extend(metrique.formatter())
+        return '\n'.join(lignes) + '\n'
+
+    async def handle_metrics(self, request: Request):
+        if not self.__jeton:
+            return web.HTTPNotFound()
+        authorization = request.headers.get('Authorization') or ''
+        if hmac.compare_digest(authorization.encode('utf-8'), ('Bearer %s' % self.__jeton).encode('utf-8')) is False:
+            return web.HTTPUnauthorized(headers={'WWW-Authenticate': 'Bearer'})
+        return web.Response(text=self.formatter(), content_type='text/plain', charset='utf-8',
+                            headers={'Cache-Control': 'no-store'})
+
+
+class MetriquesHebergement(RegistreMetriques):
+    """
+    Metriques du serveur. Certaines series sont etiquetees par idmg : /metrics exige un jeton.
+    """
+
+    def __init__(self, jeton: Optional[str] = None):
+        super().__init__(jeton)
+        self.upload_octets: Compteur = self.ajouter(Compteur(
+            'hebergement_upload_octets_total', 'Octets recus par PUT', ('idmg', 'type')))
+        self.duree_requetes: Histogramme = self.ajouter(Histogramme(
+            'hebergement_requete_duree_secondes', 'Duree de traitement des requetes', ('handler',)))
+        self.jwt_verifications: Compteur = self.ajouter(Compteur(
+            'hebergement_jwt_verifications_total', 'Verifications de JWT', ('resultat',)))
+
+        self.slots_capacite: Jauge = self.ajouter(Jauge(
+            'hebergement_slots_capacite', 'Slots de traitement concurrents', ('pool',)))
+        self.slots_actifs: Jauge = self.ajouter(Jauge(
+            'hebergement_slots_actifs', 'Slots de traitement occupes', ('pool',)))
+        self.slots_en_attente: Jauge = self.ajouter(Jauge(
+            'hebergement_slots_en_attente', 'Requetes en attente d\'un slot', ('pool',)))
+        self.slots_acquisitions: Compteur = self.ajouter(Compteur(
+            'hebergement_slots_acquisitions_total', 'Slots obtenus', ('pool',)))
+        self.slots_attente: Compteur = self.ajouter(Compteur(
+            'hebergement_slots_attente_secondes_total', 'Temps total d\'attente pour un slot', ('pool',)))
+
+        self.verification_queue: Jauge = self.ajouter(Jauge(
+            'hebergement_verification_queue_profondeur', 'Jobs de verification de hachage en attente'))
+        self.verification_octets: Compteur = self.ajouter(Compteur(
+            'hebergement_verification_octets_total', 'Octets relus pour verifier le hachage des fichiers'))
+        self.verification_secondes: Compteur = self.ajouter(Compteur(
+            'hebergement_verification_secondes_total', 'Temps de relecture pour verifier le hachage des fichiers'))
+        self.intake_remise: Histogramme = self.ajouter(Histogramme(
+            'hebergement_intake_remise_secondes', 'Delai entre le POST et la remise du fichier a l\'intake'))
+
+    def collecter_pool(self, nom: str, stats: dict):
+        """ Copie les statistiques d'un PoolEquitable (get_stats). """
+        self.slots_capacite.set(nom, valeur=stats['capacite'])
+        self.slots_actifs.set(nom, valeur=stats['actifs'])
+        self.slots_en_attente.set(nom, valeur=stats['en_attente'])
+        self.slots_acquisitions.set(nom, valeur=stats['acquisitions'])
+        self.slots_attente.set(nom, valeur=stats['attente_totale'])
+
+
+def mesurer_handler(histogramme: Histogramme, nom: str, handler):
+    """ Enveloppe un handler aiohttp pour mesurer sa duree. """
+    async def handler_mesure(request: Request):
+        debut = time.monotonic()
+        try:
+            return await handler(request)
+        finally:
+            histogramme.observe(time.monotonic() - debut, nom)
+    return handler_mesure
+
+
+def formatter_labels(noms: tuple, valeurs: tuple) -> str:
+    if len(noms) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, echapper(v)) for n, v in zip(noms, valeurs))
+
+
+def echapper(valeur) -> str:
+    return str(valeur).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def formatter_valeur(valeur: Optional[float]) -> str:
+    if valeur == float('inf'):
+        return '+Inf'
+    if isinstance(valeur, int) or (isinstance(valeur, float) and valeur.is_integer()):
+        return '%d' % valeur
+    return repr(valeur)
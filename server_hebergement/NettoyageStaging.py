@@ -0,0 +1,207 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+
+from typing import Optional
+
+from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.EcritureFichiers import PoolEcriture, supprimer_fichier, supprimer_repertoire
+from server_hebergement.SessionsUpload import SessionsUpload, ETAT_VERIFICATION
+
+EXPIRATION_STAGING = 3 * 24 * 3600  # Secondes avant de retirer un upload abandonne
+EXPIRATION_WORK = 3600  # Secondes sans modification avant de retirer un .part.work orphelin
+PROTECTION_ACTIVITE = 600  # Un upload actif depuis moins de 10 minutes n'est jamais retire
+PAUSE_IO = 0.05  # Secondes entre chaque operation disque du nettoyage (throttle)
+
+
+class UploadStaging:
+    """ Repertoire staging/upload/{idmg}/{fuuid} tel que lu sur disque. """
+
+    def __init__(self, idmg: str, fuuid: str, path_upload: pathlib.Path):
+        self.idmg = idmg
+        self.fuuid = fuuid
+        self.path_upload = path_upload
+        self.taille = 0
+        self.created: Optional[float] = None  # Epoch secondes, etat.json (upload termine par POST)
+        self.derniere_activite = 0.0
+        self.orphelins: list[tuple[pathlib.Path, int]] = list()
+
+    @property
+    def reference(self) -> float:
+        """ Date utilisee pour l'expiration. """
+        return self.created or self.derniere_activite
+
+
+class NettoyageStaging:
+    """
+    Nettoyage du staging d'upload : uploads abandonnes (expiration), fichiers .part.work orphelins (connexion
+    coupee) et budgets d'espace (global et par idmg) avec eviction des uploads les moins recemment actifs.
+
+    Les operations disque passent par le PoolEcriture avec une pause entre chacune pour ne pas nuire aux uploads.
+    """
+
+    def __init__(self, path_staging_upload: pathlib.Path, sessions: SessionsUpload, pool: PoolEcriture,
+                 expiration=EXPIRATION_STAGING, budget_global: Optional[int] = None,
+                 budget_idmg: Optional[int] = None, pause=PAUSE_IO):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__path_staging_upload = path_staging_upload
+        self.__sessions = sessions
+        self.__pool = pool
+        self.__expiration = expiration
+        self.__budget_global = budget_global
+        self.__budget_idmg = budget_idmg
+        self.__pause = pause
+
+    async def executer(self) -> dict:
+        debut = time.monotonic()
+        uploads = await self.__scanner()
+        maintenant = time.time()
+
+        rapport = {'expires': 0, 'evinces': 0, 'orphelins': 0, 'octets_recuperes': 0}
+
+        # Fichiers .part.work orphelins
+        for upload in uploads:
+            for path_work, taille in upload.orphelins:
+                if self.__est_protege(upload, maintenant):
+                    break
+                await self.__pool.executer(supprimer_fichier, path_work)
+                upload.taille -= taille
+                rapport['orphelins'] += 1
+                rapport['octets_recuperes'] += taille
+                await asyncio.sleep(self.__pause)
+
+        # Uploads expires
+        restants = list()
+        limite = maintenant - self.__expiration
+        for upload in uploads:
+            if upload.reference < limite and self.__est_protege(upload, maintenant) is False:
+                await self.__retirer(upload)
+                rapport['expires'] += 1
+                rapport['octets_recuperes'] += upload.taille
+            else:
+                restants.append(upload)
+
+        # Budgets : retirer les uploads les moins recemment actifs (LRU)
+        restants.sort(key=lambda u: u.derniere_activite)
+        if self.__budget_idmg is not None:
+            tailles_idmg = dict()
+            for upload in restants:
+                tailles_idmg[upload.idmg] = tailles_idmg.get(upload.idmg, 0) + upload.taille
+            conserves = list()
+            for upload in restants:
+                if tailles_idmg[upload.idmg] > self.__budget_idmg and self.__est_protege(upload, maintenant) is False:
+                    await self.__retirer(upload)
+                    tailles_idmg[upload.idmg] -= upload.taille
+                    rapport['evinces'] += 1
+                    rapport['octets_recuperes'] += upload.taille
+                else:
+                    conserves.append(upload)
+            restants = conserves
+
+        taille_totale = sum(u.taille for u in restants)
+        if self.__budget_global is not None and taille_totale > self.__budget_global:
+            conserves = list()
+            for upload in restants:
+                if taille_totale > self.__budget_global and self.__est_protege(upload, maintenant) is False:
+                    await self.__retirer(upload)
+                    taille_totale -= upload.taille
+                    rapport['evinces'] += 1
+                    rapport['octets_recuperes'] += upload.taille
+                else:
+                    conserves.append(upload)
+            restants = conserves
+
+        rapport['octets_staging'] = taille_totale
+        rapport['uploads'] = len(restants)
+        rapport['duree'] = time.monotonic() - debut
+        self.__logger.info("executer Nettoyage staging : %s" % rapport)
+        return rapport
+
+    def __est_protege(self, upload: UploadStaging, maintenant: float) -> bool:
+        session = self.__sessions.get_session(upload.idmg, upload.fuuid)
+        if session is None:
+            return upload.derniere_activite > maintenant - PROTECTION_ACTIVITE
+        if session.etat == ETAT_VERIFICATION or session.hachage_en_cours:
+            return True  # Job de verification en cours
+        return max(session.derniere_activite, upload.derniere_activite) > maintenant - PROTECTION_ACTIVITE
+
+    async def __retirer(self, upload: UploadStaging):
+        # Retirer de l'index avant le disque : un PUT concurrent recree une nouvelle session
+        self.__sessions.retirer_session(upload.idmg, upload.fuuid)
+        await self.__pool.executer(supprimer_repertoire, upload.path_upload)
+        self.__logger.info("retirer Upload staging %s/%s (%d octets)" % (upload.idmg, upload.fuuid, upload.taille))
+        await asyncio.sleep(self.__pause)
+
+    async def __scanner(self) -> list[UploadStaging]:
+        try:
+            repertoires_idmg = await self.__pool.executer(lister_repertoires, self.__path_staging_upload)
+        except FileNotFoundError:
+            return list()
+
+        uploads = list()
+        for path_idmg in repertoires_idmg:
+            try:
+                uploads.extend(await self.__pool.executer(scanner_idmg, path_idmg))
+            except FileNotFoundError:
+                pass  # Retire pendant le scan
+            await asyncio.sleep(self.__pause)
+        return uploads
+
+
+def lister_repertoires(path_repertoire: pathlib.Path) -> list[pathlib.Path]:
+    return [p for p in path_repertoire.iterdir() if p.is_dir()]
+
+
+def scanner_idmg(path_idmg: pathlib.Path) -> list[UploadStaging]:
+    """ Lit les uploads d'un idmg. Bloquant, utiliser un thread. """
+    limite_work = time.time() - EXPIRATION_WORK
+    uploads = list()
+    for path_fuuid in path_idmg.iterdir():
+        if path_fuuid.is_dir() is False:
+            continue
+        upload = UploadStaging(path_idmg.name, path_fuuid.name, path_fuuid)
+        try:
+            with os.scandir(path_fuuid) as entrees:
+                for entree in entrees:
+                    stat_entree = entree.stat()
+                    upload.taille += stat_entree.st_size
+                    upload.derniere_activite = max(upload.derniere_activite, stat_entree.st_mtime)
+                    if entree.name.endswith('.part.work') and stat_entree.st_mtime < limite_work:
+                        upload.orphelins.append((pathlib.Path(entree.path), stat_entree.st_size))
+                    elif entree.name == ConstantesHebergement.FICHIER_ETAT:
+                        try:
+                            with open(entree.path, 'rt') as fichier:
+                                upload.created = json.load(fichier)['created'] / 1000
+                        except (KeyError, ValueError, TypeError):
+                            pass  # Fichier etat incomplet, utiliser la derniere activite
+            if upload.derniere_activite == 0.0:
+                upload.derniere_activite = path_fuuid.stat().st_mtime
+        except FileNotFoundError:
+            continue  # Retire pendant le scan
+        uploads.append(upload)
+    return uploads
+
+
+def get_budget(nom_env: str) -> Optional[int]:
+    """ Budget en octets (suffixes K, M, G, T acceptes). None si non configure. """
+    try:
+        valeur = os.environ[nom_env].strip().upper()
+    except KeyError:
+        return None
+    multiplicateurs = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    try:
+        if valeur[-1:] in multiplicateurs:
+            return int(float(valeur[:-1]) * multiplicateurs[valeur[-1]])
+        return int(valeur)
+    except ValueError:
+        return None
+
+
+def get_expiration_staging() -> int:
+    try:
+        return int(os.environ[ConstantesHebergement.ENV_STAGING_EXPIRATION])
+    except (KeyError, ValueError):
+        return EXPIRATION_STAGING
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+
+class PoolEquitable:
+    """
+    Slots de concurrence partages entre les millegrilles (idmg).
+
+    Chaque idmg est limite a limite_idmg slots. Lorsqu'un slot se libere, il est attribue au idmg en attente
+    qui a le plus petit temps virtuel (weighted fair queuing) : un idmg avec beaucoup de requetes ne peut pas
+    affamer les autres.
+    """
+
+    def __init__(self, nom: str, capacite: int, limite_idmg: int):
+        self.nom = nom
+        self.capacite = capacite
+        self.limite_idmg = limite_idmg
+        self.__actifs: dict[str, int] = dict()
+        self.__attente: dict[str, deque] = dict()
+        self.__temps_virtuel: dict[str, float] = dict()
+        self.__poids: dict[str, float] = dict()
+        self.__horloge_virtuelle = 0.0
+        self.actifs_total = 0
+
+        # Statistiques
+        self.acquisitions = 0
+        self.attente_totale = 0.0
+
+    def set_poids(self, idmg: str, poids: float):
+        self.__poids[idmg] = poids
+
+    @property
+    def en_attente(self) -> int:
+        return sum(len(d) for d in self.__attente.values())
+
+    def __peut_demarrer(self, idmg: str) -> bool:
+        return self.actifs_total < self.capacite and self.__actifs.get(idmg, 0) < self.limite_idmg
+
+    def __attribuer(self, idmg: str):
+        self.actifs_total += 1
+        self.__actifs[idmg] = self.__actifs.get(idmg, 0) + 1
+        temps_virtuel = max(self.__temps_virtuel.get(idmg, 0.0), self.__horloge_virtuelle)
+        self.__horloge_virtuelle = temps_virtuel
+        self.__temps_virtuel[idmg] = temps_virtuel + 1.0 / self.__poids.get(idmg, 1.0)
+
+    async def acquerir(self, idmg: str):
+        debut = time.monotonic()
+        if len(self.__attente) == 0 and self.__peut_demarrer(idmg):
+            self.__attribuer(idmg)
+            self.acquisitions += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.__attente.setdefault(idmg, deque()).append(future)
+        self.__reveiller()  # Des slots peuvent etre libres si les idmg en attente sont a leur limite
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.liberer(idmg)  # Le slot avait deja ete attribue
+            else:
+                self.__retirer_attente(idmg, future)
+            raise
+
+        self.acquisitions += 1
+        self.attente_totale += time.monotonic() - debut
+
+    def liberer(self, idmg: str):
+        self.actifs_total -= 1
+        actifs = self.__actifs[idmg] - 1
+        if actifs > 0:
+            self.__actifs[idmg] = actifs
+        else:
+            del self.__actifs[idmg]
+        self.__reveiller()
+
+    def __retirer_attente(self, idmg: str, future):
+        try:
+            file_attente = self.__attente[idmg]
+            file_attente.remove(future)
+            if len(file_attente) == 0:
+                del self.__attente[idmg]
+        except (KeyError, ValueError):
+            pass
+
+    def __reveiller(self):
+        while self.actifs_total < self.capacite:
+            eligibles = [i for i in self.__attente.keys() if self.__actifs.get(i, 0) < self.limite_idmg]
+            if len(eligibles) == 0:
+                return
+            idmg = min(eligibles, key=lambda i: max(self.__temps_virtuel.get(i, 0.0), self.__horloge_virtuelle))
+            file_attente = self.__attente[idmg]
+            future = file_attente.popleft()
+            if len(file_attente) == 0:
+                del self.__attente[idmg]
+            if future.done():
+                continue  # Annulee
+            self.__attribuer(idmg)
+            future.set_result(True)
+
+    @asynccontextmanager
+    async def slot(self, idmg: str):
+        await self.acquerir(idmg)
+        try:
+            yield
+        finally:
+            self.liberer(idmg)
+
+    def get_stats(self) -> dict:
+        return {
+            'capacite': self.capacite,
+            'actifs': self.actifs_total,
+            'en_attente': self.en_attente,
+            'acquisitions': self.acquisitions,
+            'attente_totale': self.attente_totale,
+        }
+
+
+class Ordonnanceur:
+    """
+    Pools separes pour les requetes de metadonnees (rapides) et les requetes qui transferent un body.
+    """
+
+    def __init__(self, capacite_transfert=10, limite_idmg_transfert=3,
+                 capacite_metadata=50, limite_idmg_metadata=10):
+        self.transfert = PoolEquitable('transfert', capacite_transfert, limite_idmg_transfert)
+        self.metadata = PoolEquitable('metadata', capacite_metadata, limite_idmg_metadata)
+
+    def set_poids(self, idmg: str, poids: float, pool: Optional[str] = None):
+        for p in [self.transfert, self.metadata]:
+            if pool is None or pool == p.nom:
+                p.set_poids(idmg, poids)
+
+    def get_stats(self) -> dict:
+        return {'transfert': self.transfert.get_stats(), 'metadata': self.metadata.get_stats()}
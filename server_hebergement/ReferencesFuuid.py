@@ -0,0 +1,92 @@
+import logging
+import pathlib
+
+from typing import Optional
+
+
+class ReferencesFuuid:
+    """
+    Registre des fuuids deja recus et verifies, avec les idmg qui les referencent (compte de references).
+
+    Un fuuid deja detenu par un idmg n'a pas a etre recu de nouveau pour ce idmg. Un autre idmg doit transmettre
+    le contenu (connaitre le fuuid ne prouve pas la possession du fichier).
+    Sur disque : journal append-only (+/- fuuid idmg), compacte au chargement.
+    """
+
+    def __init__(self, path_fichier: pathlib.Path):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__path_fichier = path_fichier
+        self.__references: dict[str, set] = dict()
+
+    def charger(self):
+        """ Charge et compacte le journal. Bloquant, utiliser un thread. """
+        references = dict()
+        try:
+            with open(self.__path_fichier, 'rt') as fichier:
+                for ligne in fichier:
+                    try:
+                        operation, fuuid, idmg = ligne.split()
+                    except ValueError:
+                        continue  # Ligne incomplete (arret pendant une ecriture)
+                    if operation == '+':
+                        references.setdefault(fuuid, set()).add(idmg)
+                    elif operation == '-':
+                        idmgs = references.get(fuuid)
+                        if idmgs is not None:
+                            idmgs.discard(idmg)
+                            if len(idmgs) == 0:
+                                del references[fuuid]
+        except FileNotFoundError:
+            pass
+
+        path_work = pathlib.Path(str(self.__path_fichier) + '.work')
+        path_work.parent.mkdir(parents=True, exist_ok=True)
+        with open(path_work, 'wt') as fichier:
+            for fuuid in sorted(references.keys()):
+                for idmg in sorted(references[fuuid]):
+                    fichier.write('+ %s %s\n' % (fuuid, idmg))
+        path_work.rename(self.__path_fichier)
+
+        self.__references = references
+        self.__logger.info("charger %d fuuids references" % len(references))
+
+    def contient(self, fuuid: str) -> bool:
+        return fuuid in self.__references
+
+    def get_idmgs(self, fuuid: str) -> Optional[set]:
+        return self.__references.get(fuuid)
+
+    def refcount(self, fuuid: str) -> int:
+        return len(self.__references.get(fuuid) or [])
+
+    def ajouter(self, fuuid: str, idmg: str) -> bool:
+        """ :return: True si la reference est nouvelle. L'ecriture disque est faite par sauvegarder(). """
+        idmgs = self.__references.setdefault(fuuid, set())
+        if idmg in idmgs:
+            return False
+        idmgs.add(idmg)
+        return True
+
+    def retirer(self, fuuid: str, idmg: str) -> int:
+        """ :return: Nombre de references restantes pour le fuuid. """
+        idmgs = self.__references.get(fuuid)
+        if idmgs is None:
+            return 0
+        idmgs.discard(idmg)
+        if len(idmgs) == 0:
+            del self.__references[fuuid]
+            return 0
+        return len(idmgs)
+
+    def sauvegarder(self, operation: str, fuuid: str, idmg: str):
+        """ Ajoute une operation (+ ou -) au journal. Bloquant, utiliser un thread. """
+        with open(self.__path_fichier, 'at') as fichier:
+            fichier.write('%s %s %s\n' % (operation, fuuid, idmg))
+
+    def sauvegarder_lot(self, operations: list[tuple[str, str, str]]):
+        """ Ajoute plusieurs operations (operation, fuuid, idmg) en une seule ecriture. Bloquant. """
+        with open(self.__path_fichier, 'at') as fichier:
+            fichier.write(''.join('%s %s %s\n' % o for o in operations))
+
+    def __len__(self):
+        return len(self.__references)
@@ -0,0 +1,427 @@
+import asyncio
+import json
+import logging
+import os
+import pathlib
+import time
+
+from typing import Optional
+
+from millegrilles_messages.messages.Hachage import VerificateurHachage
+
+from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.EcritureFichiers import lister_parts
+from server_hebergement.HachageFichiers import MOTEUR_HACHAGE
+from server_hebergement.JournalSessions import JournalSessions, EtatSessionJournal, OP_OUVRIR, OP_PART, OP_POST, \
+    OP_VERIFIE, OP_INTAKE, OP_RETIRER
+
+ETAT_UPLOAD = 'upload'
+ETAT_VERIFICATION = 'verification'
+
+EXPIRATION_INTAKE = 3600  # Secondes pendant lesquelles un fuuid remis a l'intake est rapporte en traitement
+
+
+class SessionUpload:
+    """
+    Etat en memoire d'un upload de fuuid (par idmg) : parts recues, octets, etat.
+
+    Le hachage du fichier complet est calcule au fur et a mesure que les parts sont recues dans l'ordre.
+    Les parts recues hors ordre sont differees et hachees a partir du disque lorsque le trou est comble.
+    """
+
+    def __init__(self, idmg: str, fuuid: str, parts_connues: bool, parts: Optional[dict[int, int]] = None,
+                 mode=ConstantesHebergement.MODE_UPLOAD_PARTS, taille_declaree: Optional[int] = None):
+        self.idmg = idmg
+        self.fuuid = fuuid
+        self.derniere_activite = time.time()
+        self.etat = ETAT_UPLOAD
+        self.parts: dict[int, int] = parts or dict()  # Parts sur disque, position: taille
+        self.taille_declaree = taille_declaree  # Taille du fichier declaree a l'ouverture de session (preallouee)
+
+        # Mode fichier : un seul fichier preallouable, intervalles [debut, fin) recus persistes dans recu.json
+        self.mode = mode
+        self.recus: list[list[int]] = list()
+        if mode == ConstantesHebergement.MODE_UPLOAD_FICHIER:
+            for position, taille in self.parts.items():
+                self.recus = ajouter_intervalle(self.recus, position, position + taille)
+        self.verrou_recus = asyncio.Lock()
+
+        # Hachage incremental. Seulement possible si toutes les parts du repertoire passent par cette session.
+        self.verificateur: Optional[VerificateurHachage] = None
+        if parts_connues:
+            try:
+                self.verificateur = VerificateurHachage(fuuid)
+            except Exception:
+                pass  # fuuid n'est pas un hachage supporte, utiliser la verification complete
+        self.position_hachage = 0
+        self.parts_differees: dict[int, int] = dict()  # position: taille
+        self.hachage_en_cours = False
+
+    def touch(self):
+        self.derniere_activite = time.time()
+
+    @property
+    def octets_recus(self) -> int:
+        return sum(self.parts.values())
+
+    @property
+    def taille_staging(self) -> int:
+        """ Espace occupe ou reserve dans le staging. """
+        return max(self.taille_declaree or 0, self.octets_recus)
+
+    @property
+    def position(self) -> int:
+        """ Position de reprise : fin de la part avec la plus grande position (mode fichier : fin du debut contigu). """
+        if self.mode == ConstantesHebergement.MODE_UPLOAD_FICHIER:
+            if len(self.recus) > 0 and self.recus[0][0] == 0:
+                return self.recus[0][1]
+            return 0
+        if len(self.parts) == 0:
+            return 0
+        part_max = max(self.parts.keys())
+        return part_max + self.parts[part_max]
+
+    @property
+    def manquants(self) -> list[list[int]]:
+        """
+        Intervalles [debut, fin) manquants avant la fin du dernier intervalle recu (mode fichier).
+        Avec une taille declaree, la fin du fichier est aussi rapportee.
+        """
+        manquants = list()
+        fin_precedente = 0
+        for debut, fin in self.recus:
+            if debut > fin_precedente:
+                manquants.append([fin_precedente, debut])
+            fin_precedente = fin
+        if self.taille_declaree is not None and fin_precedente < self.taille_declaree:
+            manquants.append([fin_precedente, self.taille_declaree])
+        return manquants
+
+    def contient(self, position: int, taille: int) -> bool:
+        """ True si l'intervalle [position, position+taille) a deja ete recu (mode fichier). """
+        for debut, fin in self.recus:
+            if debut <= position and position + taille <= fin:
+                return True
+        return False
+
+    def ajouter_part(self, position: int, taille: int):
+        self.parts[position] = taille
+        if self.mode == ConstantesHebergement.MODE_UPLOAD_FICHIER:
+            self.recus = ajouter_intervalle(self.recus, position, position + taille)
+
+    def invalider_hachage(self):
+        self.verificateur = None
+        self.parts_differees.clear()
+
+    def debuter_part(self, position: int) -> bool:
+        """
+        :return: True si la part doit etre hachee pendant la reception (elle est la prochaine dans l'ordre).
+        """
+        self.touch()
+        if self.verificateur is None or self.hachage_en_cours or position != self.position_hachage:
+            return False
+        self.hachage_en_cours = True
+        return True
+
+    def terminer_part(self, position: int, taille: int, hachee: bool):
+        self.touch()
+        self.ajouter_part(position, taille)
+        if self.verificateur is None:
+            return
+
+        if hachee:
+            self.hachage_en_cours = False
+            self.position_hachage += taille
+        elif position < self.position_hachage:
+            # Remplacement d'une part deja hachee, le hachage en memoire n'est plus fiable
+            self.invalider_hachage()
+        else:
+            self.parts_differees[position] = taille
+
+    def abandonner_part(self, hachee: bool):
+        """ Part en erreur (hachage, taille, connexion interrompue). """
+        if hachee:
+            self.hachage_en_cours = False
+            self.invalider_hachage()
+
+    def hachage_complet(self, hachage: str) -> bool:
+        return self.verificateur is not None and \
+            self.hachage_en_cours is False and \
+            len(self.parts_differees) == 0 and \
+            hachage == self.fuuid
+
+
+class SessionsUpload:
+    """
+    Index en memoire des uploads (staging) et des fuuids remis a l'intake.
+    Permet de repondre aux requetes de statut de job sans acceder au disque.
+    Les evenements des sessions sont conserves dans le journal (optionnel) pour reconstruire l'index au demarrage.
+    """
+
+    def __init__(self, journal: Optional[JournalSessions] = None):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__journal = journal
+        self.__sessions: dict[tuple, SessionUpload] = dict()
+        self.__intake: dict[str, float] = dict()  # fuuid: date de remise a l'intake
+
+    def get_session(self, idmg: str, fuuid: str) -> Optional[SessionUpload]:
+        return self.__sessions.get((idmg, fuuid))
+
+    def ouvrir_session(self, idmg: str, fuuid: str, repertoire_cree: bool,
+                       mode=ConstantesHebergement.MODE_UPLOAD_PARTS) -> SessionUpload:
+        """
+        :param repertoire_cree: True si le repertoire d'upload vient d'etre cree (aucune part existante sur disque).
+        :param mode: Mode de stockage d'une nouvelle session. Une session existante conserve son mode.
+        """
+        session = self.__sessions.get((idmg, fuuid))
+        if session is None or repertoire_cree:
+            if repertoire_cree is False:
+                mode = ConstantesHebergement.MODE_UPLOAD_PARTS  # Repertoire inconnu, parts existantes
+            session = SessionUpload(idmg, fuuid, repertoire_cree, mode=mode)
+            self.__sessions[(idmg, fuuid)] = session
+            self.__journaliser(OP_OUVRIR, idmg, fuuid, mode=mode, taille=None)
+        return session
+
+    async def persister_recus(self, session: SessionUpload, path_upload: pathlib.Path, executer):
+        """ Sauvegarde les intervalles recus (mode fichier). executer : fonction async pour les operations disque. """
+        async with session.verrou_recus:
+            await executer(sauvegarder_recus, path_upload, [list(i) for i in session.recus], session.taille_declaree)
+
+    def declarer_session(self, idmg: str, fuuid: str, taille: int) -> SessionUpload:
+        """ Nouvelle session en mode fichier avec taille declaree (repertoire d'upload vide). """
+        session = SessionUpload(idmg, fuuid, True, mode=ConstantesHebergement.MODE_UPLOAD_FICHIER,
+                                taille_declaree=taille)
+        self.__sessions[(idmg, fuuid)] = session
+        self.__journaliser(OP_OUVRIR, idmg, fuuid, mode=session.mode, taille=taille)
+        return session
+
+    def enregistrer_part(self, session: SessionUpload, position: int, taille: int):
+        """ Part conservee sur disque. L'evenement n'est pas attendu : une part absente du journal est renvoyee. """
+        self.__journaliser(OP_PART, session.idmg, session.fuuid, position=position, taille=taille)
+
+    async def enregistrer_post(self, idmg: str, fuuid: str, hachage: str, taille: Optional[int] = None):
+        """
+        Upload termine par POST, attend l'ecriture du journal.
+        :param taille: Taille du fichier si un upload en mode fichier a ete finalise en une seule part.
+        """
+        self.__journaliser(OP_POST, idmg, fuuid, hachage=hachage, taille=taille)
+        if self.__journal is not None:
+            await self.__journal.synchroniser()
+
+    def enregistrer_verifie(self, idmg: str, fuuid: str):
+        self.__journaliser(OP_VERIFIE, idmg, fuuid)
+
+    def __journaliser(self, op: str, idmg: str, fuuid: str, **donnees):
+        if self.__journal is not None:
+            self.__journal.ajouter(op, idmg, fuuid, **donnees)
+
+    def get_taille_staging(self, idmg: Optional[str] = None) -> int:
+        """ Espace occupe ou reserve par les sessions (toutes ou celles d'un idmg). """
+        return sum(s.taille_staging for s in self.__sessions.values() if idmg is None or s.idmg == idmg)
+
+    def retirer_session(self, idmg: str, fuuid: str) -> Optional[SessionUpload]:
+        session = self.__sessions.pop((idmg, fuuid), None)
+        if session is not None:
+            self.__journaliser(OP_RETIRER, idmg, fuuid)
+        return session
+
+    def ajouter_intake(self, idmg: str, fuuid: str):
+        """ Le fichier a ete verifie et remis a l'intake, la session d'upload est terminee. """
+        if self.__sessions.pop((idmg, fuuid), None) is not None:
+            self.__journaliser(OP_INTAKE, idmg, fuuid)
+        self.__intake[fuuid] = time.time()
+
+    def est_intake(self, fuuid: str) -> bool:
+        return fuuid in self.__intake
+
+    def sessions(self):
+        return list(self.__sessions.values())
+
+    async def rattraper_hachage(self, session: SessionUpload, path_upload: pathlib.Path, executer):
+        """
+        Hache a partir du disque les parts differees qui suivent maintenant la position de hachage.
+        :param executer: Fonction async pour les operations disque (PoolEcriture.executer).
+        """
+        while session.verificateur is not None and session.hachage_en_cours is False:
+            if any(p < session.position_hachage for p in session.parts_differees.keys()):
+                session.invalider_hachage()  # Part remplacee, hachage en memoire non fiable
+                return
+
+            try:
+                taille = session.parts_differees.pop(session.position_hachage)
+            except KeyError:
+                return  # Il manque encore une part dans l'ordre
+
+            position = session.position_hachage
+            if session.mode == ConstantesHebergement.MODE_UPLOAD_FICHIER:
+                path_fichier = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_DONNEES)
+                offset = position
+            else:
+                path_fichier = pathlib.Path(path_upload, '%d.part' % position)
+                offset = 0
+            session.hachage_en_cours = True
+            try:
+                taille_lue = await executer(hacher_fichier, session.verificateur, path_fichier, offset, taille)
+            except Exception as e:
+                self.__logger.info("rattraper_hachage Erreur lecture %s : %s" % (path_fichier, e))
+                session.hachage_en_cours = False
+                session.invalider_hachage()
+                return
+
+            session.hachage_en_cours = False
+            if taille_lue != taille:
+                session.invalider_hachage()
+                return
+            session.position_hachage += taille
+
+    def purger(self, expiration: float) -> int:
+        """
+        Libere le hachage en memoire des sessions inactives depuis plus de expiration secondes et retire
+        les fuuids remis a l'intake depuis plus de EXPIRATION_INTAKE. Les sessions restent dans l'index tant
+        que leur repertoire existe (le POST fera une verification complete).
+        """
+        maintenant = time.time()
+        limite = maintenant - expiration
+        inactives = [s for s in self.__sessions.values() if s.derniere_activite < limite and s.verificateur is not None]
+        for session in inactives:
+            if session.hachage_en_cours is False:
+                session.invalider_hachage()
+
+        limite_intake = maintenant - EXPIRATION_INTAKE
+        for fuuid in [f for f, d in self.__intake.items() if d < limite_intake]:
+            del self.__intake[fuuid]
+
+        return len(inactives)
+
+    def charger(self, path_staging_upload: pathlib.Path, path_staging_intake: pathlib.Path):
+        """
+        Reconstruit l'index a partir du journal ou, s'il n'existe pas, du disque (demarrage).
+        Bloquant, utiliser un thread.
+        Structure : staging/upload/{idmg}/{fuuid}/{position}.part et staging/intake/{fuuid}.
+        """
+        etats = None
+        if self.__journal is not None:
+            etats = self.__journal.charger()
+
+        if etats is not None:
+            sessions = self.__charger_journal(etats, path_staging_upload)
+        else:
+            sessions = self.__charger_disque(path_staging_upload)
+            if self.__journal is not None:
+                self.__journal.initialiser([get_etat_journal(s) for s in sessions.values()])
+
+        intake = dict()
+        try:
+            maintenant = time.time()
+            for item in path_staging_intake.iterdir():
+                intake[item.name] = maintenant
+        except FileNotFoundError:
+            pass
+
+        # Conserver les sessions deja ouvertes depuis le demarrage
+        sessions.update(self.__sessions)
+        self.__sessions = sessions
+        intake.update(self.__intake)
+        self.__intake = intake
+
+        self.__logger.info("charger %d sessions d'upload, %d fuuids dans l'intake" % (len(sessions), len(intake)))
+
+    def __charger_journal(self, etats: list[EtatSessionJournal], path_staging_upload: pathlib.Path) -> dict:
+        sessions = dict()
+        for etat in etats:
+            session = SessionUpload(etat.idmg, etat.fuuid, False, dict(etat.parts), etat.mode, etat.taille_declaree)
+            session.derniere_activite = etat.date
+            sessions[(etat.idmg, etat.fuuid)] = session
+
+        # Retirer les sessions dont le repertoire n'existe plus (une verification par session active)
+        absentes = [s for s in sessions.values()
+                    if pathlib.Path(path_staging_upload, s.idmg, s.fuuid).is_dir() is False]
+        if len(absentes) > 0:
+            for session in absentes:
+                del sessions[(session.idmg, session.fuuid)]
+            self.__journal.initialiser([e for e in etats if (e.idmg, e.fuuid) in sessions])
+        return sessions
+
+    def __charger_disque(self, path_staging_upload: pathlib.Path) -> dict:
+        sessions = dict()
+        try:
+            repertoires_idmg = list(path_staging_upload.iterdir())
+        except FileNotFoundError:
+            repertoires_idmg = list()
+
+        for path_idmg in repertoires_idmg:
+            if path_idmg.is_dir() is False:
+                continue
+            for path_fuuid in path_idmg.iterdir():
+                if path_fuuid.is_dir() is False:
+                    continue
+                parts = dict()
+                derniere_activite = 0.0
+                mode = ConstantesHebergement.MODE_UPLOAD_PARTS
+                taille_declaree = None
+                parts_disque, _couvertes = lister_parts(path_fuuid)  # Sans les restes d'un assemblage
+                for position, _path, stat_part in parts_disque:
+                    parts[position] = stat_part.st_size
+                    derniere_activite = max(derniere_activite, stat_part.st_mtime)
+                path_recus = pathlib.Path(path_fuuid, ConstantesHebergement.FICHIER_UPLOAD_RECU)
+                if path_recus.is_file():
+                    mode = ConstantesHebergement.MODE_UPLOAD_FICHIER
+                    with open(path_recus, 'rt') as fichier:
+                        recus = json.load(fichier)
+                    parts = dict((d, f - d) for d, f in recus['recus'])
+                    taille_declaree = recus.get('taille')
+                    derniere_activite = max(derniere_activite, path_recus.stat().st_mtime)
+                session = SessionUpload(path_idmg.name, path_fuuid.name, False, parts, mode, taille_declaree)
+                session.derniere_activite = derniere_activite or path_fuuid.stat().st_mtime
+                sessions[(session.idmg, session.fuuid)] = session
+        return sessions
+
+    def __len__(self):
+        return len(self.__sessions)
+
+
+def get_etat_journal(session: SessionUpload) -> EtatSessionJournal:
+    etat = EtatSessionJournal(session.idmg, session.fuuid, session.mode, session.taille_declaree,
+                              session.derniere_activite)
+    etat.parts = dict(session.parts)
+    return etat
+
+
+def hacher_fichier(verificateur: VerificateurHachage, path_fichier: pathlib.Path,
+                   offset: int = 0, taille_max: Optional[int] = None) -> int:
+    return MOTEUR_HACHAGE.hacher_fichier(verificateur, path_fichier, offset, taille_max)
+
+
+def ajouter_intervalle(intervalles: list[list[int]], debut: int, fin: int) -> list[list[int]]:
+    """ Ajoute [debut, fin) a une liste triee d'intervalles disjoints, fusionne les intervalles qui se touchent. """
+    resultat = list()
+    for d, f in intervalles:
+        if f < debut or d > fin:
+            resultat.append([d, f])
+        else:
+            debut, fin = min(d, debut), max(f, fin)
+    resultat.append([debut, fin])
+    resultat.sort()
+    return resultat
+
+
+def sauvegarder_recus(path_upload: pathlib.Path, recus: list[list[int]], taille: Optional[int] = None):
+    path_recus = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_RECU)
+    path_work = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_RECU + '.work')
+    contenu = {'recus': recus}
+    if taille is not None:
+        contenu['taille'] = taille
+    with open(path_work, 'wt') as fichier:
+        json.dump(contenu, fichier)
+    path_work.rename(path_recus)
+
+
+def finaliser_fichier_upload(path_upload: pathlib.Path, taille: int):
+    """
+    Mode fichier : tronque le fichier a sa taille finale et le renomme 0.part. Le repertoire a alors la meme
+    structure qu'un upload en parts (une seule part) pour la verification et l'intake, sans concatenation.
+    """
+    path_donnees = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_DONNEES)
+    os.truncate(path_donnees, taille)
+    path_donnees.rename(pathlib.Path(path_upload, '0.part'))
+    pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_RECU).unlink(missing_ok=True)
@@ -0,0 +1,274 @@
+import asyncio
+import os
+import pathlib
+import secrets
+
+from typing import Optional
+
+from aiohttp import web
+from aiohttp.web_request import Request
+
+from server_hebergement.EcritureFichiers import lister_parts
+
+MAX_RANGES = 64  # Nombre maximal de ranges distincts dans une requete multi-range
+TAILLE_BLOC_ENVOI = 1024 * 1024  # Lectures disque (hors loop) de 1 MiB lorsque sendfile n'est pas utilise
+
+
+class RangeNonSatisfaisable(Exception):
+    pass
+
+
+class SourceFichier:
+    """
+    Contenu d'un fichier reparti sur un ou plusieurs fichiers sur disque (e.g. parts d'un upload), dans l'ordre.
+    """
+
+    def __init__(self, segments: list[tuple[pathlib.Path, int]]):
+        self.segments = segments
+        self.taille = sum(s[1] for s in segments)
+
+    @staticmethod
+    def charger(path_fichier: pathlib.Path) -> Optional['SourceFichier']:
+        """
+        Charge un fichier unique ou un repertoire de parts ({position}.part). Bloquant, utiliser un thread.
+        :return: None si le fichier n'existe pas.
+        """
+        try:
+            if path_fichier.is_file():
+                return SourceFichier([(path_fichier, path_fichier.stat().st_size)])
+
+            parts, _couvertes = lister_parts(path_fichier)
+        except FileNotFoundError:
+            return None
+
+        if len(parts) == 0:
+            return None
+
+        segments = list()
+        position_attendue = 0
+        for position, item, stat_part in parts:
+            if position != position_attendue:
+                return None  # Fichier incomplet
+            segments.append((item, stat_part.st_size))
+            position_attendue += stat_part.st_size
+
+        return SourceFichier(segments)
+
+    def decouper(self, debut: int, fin: int):
+        """ Generateur de (path, offset, count) pour les bytes [debut, fin). """
+        position = 0
+        for path_segment, taille in self.segments:
+            fin_segment = position + taille
+            if fin_segment > debut and position < fin:
+                offset = max(debut, position) - position
+                count = min(fin, fin_segment) - position - offset
+                yield path_segment, offset, count
+            position = fin_segment
+            if position >= fin:
+                return
+
+
+def parse_range(valeur: str, taille: int) -> Optional[list[tuple[int, int]]]:
+    """
+    Parse un header Range (bytes=...).
+    :return: Liste triee de ranges [debut, fin) fusionnes, None si le header est invalide (ignorer le header).
+    :raises RangeNonSatisfaisable: Aucun range ne touche le fichier.
+    """
+    try:
+        unite, specs = valeur.split('=', 1)
+    except ValueError:
+        return None
+    if unite.strip().lower() != 'bytes':
+        return None
+
+    ranges = list()
+    for spec in specs.split(','):
+        spec = spec.strip()
+        if spec == '':
+            continue
+        try:
+            debut, fin = spec.split('-', 1)
+            if debut == '':
+                # Suffixe : les n derniers bytes
+                n = int(fin)
+                if n < 0:
+                    return None
+                if n == 0:
+                    continue
+                ranges.append((max(0, taille - n), taille))
+            else:
+                debut = int(debut)
+                fin = int(fin) + 1 if fin != '' else None
+                if debut < 0 or (fin is not None and fin <= debut):
+                    return None
+                if debut >= taille:
+                    continue  # Non satisfaisable, peut-etre d'autres ranges valides
+                ranges.append((debut, min(fin or taille, taille)))
+        except ValueError:
+            return None
+
+    if len(ranges) == 0:
+        raise RangeNonSatisfaisable()
+
+    # Fusionner les ranges qui se chevauchent ou se touchent
+    ranges.sort()
+    fusionnes = [ranges[0]]
+    for debut, fin in ranges[1:]:
+        debut_prec, fin_prec = fusionnes[-1]
+        if debut <= fin_prec:
+            fusionnes[-1] = (debut_prec, max(fin, fin_prec))
+        else:
+            fusionnes.append((debut, fin))
+
+    if len(fusionnes) > MAX_RANGES:
+        return None  # Trop de ranges, retourner le fichier complet
+
+    return fusionnes
+
+
+def etag_correspond(valeur: str, etag: str) -> bool:
+    """ Comparaison faible (If-None-Match) : W/ est ignore. """
+    for item in valeur.split(','):
+        item = item.strip()
+        if item == '*':
+            return True
+        if item.startswith('W/'):
+            item = item[2:]
+        if item == etag:
+            return True
+    return False
+
+
+def etag_correspond_fort(valeur: str, etag: str) -> bool:
+    """ Comparaison forte (If-Match, RFC 9110) : un ETag faible (W/) ne correspond jamais. """
+    for item in valeur.split(','):
+        item = item.strip()
+        if item == '*' or (item.startswith('W/') is False and item == etag):
+            return True
+    return False
+
+
+async def preparer_reponse(request: Request, source: SourceFichier, etag: str,
+                           content_type='application/octet-stream', immuable=True) -> web.StreamResponse:
+    """
+    Repond a un GET/HEAD : ETag fort, requetes conditionnelles, Range et multi-range.
+    Le contenu est transmis avec sendfile (zero-copy) lorsque possible, les boundaries multi-range par response.write.
+    :param immuable: False si le fichier peut etre remplace (revalidation avec l'ETag a chaque utilisation).
+    """
+    headers = request.headers
+    headers_reponse = {
+        'ETag': etag,
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, max-age=31536000, immutable' if immuable else 'private, no-cache',
+    }
+
+    if_match = headers.get('If-Match')
+    if if_match is not None and etag_correspond_fort(if_match, etag) is False:
+        return web.Response(status=412, headers=headers_reponse)
+
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None and etag_correspond(if_none_match, etag):
+        return web.Response(status=304, headers=headers_reponse)
+
+    taille = source.taille
+    ranges = None
+    valeur_range = headers.get('Range')
+    if valeur_range is not None:
+        if_range = headers.get('If-Range')
+        if if_range is None or if_range.strip() == etag:
+            try:
+                ranges = parse_range(valeur_range, taille)
+            except RangeNonSatisfaisable:
+                headers_reponse['Content-Range'] = 'bytes */%d' % taille
+                return web.Response(status=416, headers=headers_reponse)
+
+    envoyer_body = request.method != 'HEAD'
+
+    if ranges is None:
+        response = web.StreamResponse(status=200, headers=headers_reponse)
+        response.content_type = content_type
+        response.content_length = taille
+        writer = await response.prepare(request)
+        if envoyer_body:
+            await envoyer_contenu(request, response, writer, source, 0, taille)
+    elif len(ranges) == 1:
+        debut, fin = ranges[0]
+        headers_reponse['Content-Range'] = 'bytes %d-%d/%d' % (debut, fin - 1, taille)
+        response = web.StreamResponse(status=206, headers=headers_reponse)
+        response.content_type = content_type
+        response.content_length = fin - debut
+        writer = await response.prepare(request)
+        if envoyer_body:
+            await envoyer_contenu(request, response, writer, source, debut, fin)
+    else:
+        boundary = secrets.token_hex(16)
+        entetes = [
+            ('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, content_type, debut, fin - 1, taille)).encode('utf-8')
+            for debut, fin in ranges
+        ]
+        fermeture = ('--%s--\r\n' % boundary).encode('utf-8')
+        content_length = sum(len(e) for e in entetes) + sum(f - d + 2 for d, f in ranges) + len(fermeture)
+
+        response = web.StreamResponse(status=206, headers=headers_reponse)
+        response.headers['Content-Type'] = 'multipart/byteranges; boundary=%s' % boundary
+        response.content_length = content_length
+        writer = await response.prepare(request)
+        if envoyer_body:
+            for entete, (debut, fin) in zip(entetes, ranges):
+                await response.write(entete)
+                await envoyer_contenu(request, response, writer, source, debut, fin)
+                await response.write(b'\r\n')
+            await response.write(fermeture)
+
+    await response.write_eof()
+    return response
+
+
+async def envoyer_contenu(request: Request, response: web.StreamResponse, writer, source: SourceFichier,
+                          debut: int, fin: int):
+    """
+    Envoie les bytes [debut, fin) de la source. Comme web.FileResponse : le StreamWriter est vide (headers,
+    boundaries) puis loop.sendfile transmet le contenu (zero-copy, ou fallback d'asyncio pour TLS).
+    response.write est utilise si la reponse est compressee ou chunked, ou si sendfile n'est pas disponible.
+    :param writer: StreamWriter retourne par response.prepare().
+    """
+    loop = asyncio.get_running_loop()
+    zero_copy = response.compression is False and response.chunked is False and \
+        not os.environ.get('AIOHTTP_NOSENDFILE')
+
+    for path_segment, offset, count in source.decouper(debut, fin):
+        fichier = await asyncio.to_thread(open, path_segment, 'rb')
+        try:
+            if zero_copy:
+                transport = request.transport
+                if transport is None:
+                    raise ConnectionResetError('Connexion fermee')
+                await writer.drain()
+                try:
+                    await loop.sendfile(transport, fichier, offset, count)
+                    continue
+                except NotImplementedError:
+                    zero_copy = False  # Loop sans sendfile (e.g. uvloop)
+            await envoyer_par_blocs(response, fichier, path_segment, offset, count)
+        finally:
+            await asyncio.to_thread(fichier.close)
+
+
+async def envoyer_par_blocs(response: web.StreamResponse, fichier, path_segment: pathlib.Path, offset: int, count: int):
+    """ Envoi par response.write. La lecture du bloc suivant se fait dans un thread pendant l'envoi du bloc courant. """
+    await asyncio.to_thread(fichier.seek, offset)
+    restant = count
+    lecture = asyncio.create_task(asyncio.to_thread(fichier.read, min(TAILLE_BLOC_ENVOI, restant)))
+    try:
+        while restant > 0:
+            bloc = await lecture
+            if not bloc:
+                raise EOFError('Fichier %s tronque' % path_segment)
+            restant -= len(bloc)
+            if restant > 0:
+                lecture = asyncio.create_task(asyncio.to_thread(fichier.read, min(TAILLE_BLOC_ENVOI, restant)))
+            await response.write(bloc)
+    finally:
+        if lecture.done() is False:
+            await asyncio.wait([lecture])  # Laisser terminer la lecture en cours avant de fermer le fichier
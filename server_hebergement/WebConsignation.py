@@ -1,10 +1,15 @@
 import asyncio
 import aioredis
 import datetime
+import errno
 import json
+import itertools
 import logging
+import os
 import pathlib
 import shutil
+import time
+import uuid
 
 from typing import Optional
 
@@ -18,41 +23,142 @@ from millegrilles_web.JwtUtils import get_headers, verify
 from millegrilles_messages.messages.Hachage import VerificateurHachage, ErreurHachage
 
 from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.Backup import IndexBackup, get_path_backup, valider_nom
+from server_hebergement.Cache import CacheJwt
+from server_hebergement.Certificats import CacheCertificats
+from server_hebergement.EcritureFichiers import PoolEcriture, EcrivainFichier, creer_repertoire, get_taille_fichier, \
+    supprimer_fichier, supprimer_repertoire, preallouer_fichier, assembler_parts, lister_parts
+from server_hebergement.HachageFichiers import MOTEUR_HACHAGE, ResultatHachage
+from server_hebergement.JournalSessions import JournalSessions
+from server_hebergement.Metriques import MetriquesHebergement, Compteur, mesurer_handler
+from server_hebergement.NettoyageStaging import NettoyageStaging, get_budget, get_expiration_staging, \
+    lister_repertoires
+from server_hebergement.Ordonnanceur import Ordonnanceur
+from server_hebergement.ReferencesFuuid import ReferencesFuuid
+from server_hebergement.SessionsUpload import SessionsUpload, SessionUpload, ETAT_UPLOAD, ETAT_VERIFICATION, \
+    finaliser_fichier_upload
+from server_hebergement.Telechargement import SourceFichier, preparer_reponse
+
+
+EXPIRATION_SESSION_UPLOAD = 6 * 3600  # Secondes d'inactivite avant de retirer une session en memoire
+DEBIT_REFERENCE_VERIFICATION = 200 * 1024 * 1024  # Octets/sec, estimation pour la priorite des jobs
+MAX_FUUIDS_JOBS = 1000  # Nombre maximal de fuuids par requete de statut en lot
+MAX_FICHIERS_LOT = 1000  # Nombre maximal de fichiers par upload en lot
+TAILLE_MAX_FICHIER_LOT = 5 * 1024 * 1024  # Upload en lot reserve aux petits fichiers (e.g. image small)
+MARGE_ESPACE_LIBRE = 1024 * 1024 * 1024  # Octets toujours laisses libres sur le volume de staging
+RETRY_AFTER_ESPACE = 300  # Secondes, delai suggere lorsque l'espace de staging est insuffisant
+TAILLE_QUEUE_VERIFICATION = 20
 
 
 class JobVerifierParts:
 
-    def __init__(self, transaction, path_upload: pathlib.Path, hachage: str, cles: Optional[dict] = None):
+    def __init__(self, transaction, path_upload: pathlib.Path, hachage: str, cles: Optional[dict] = None,
+                 session: Optional[SessionUpload] = None):
         self.transaction = transaction
         self.path_upload = path_upload
         self.hachage = hachage
         self.cles = cles
+        self.session = session
+        self.taille: Optional[int] = None
+        self.debut = time.monotonic()
         self.done = asyncio.Event()
         self.valide: Optional[bool] = None
         self.exception: Optional[Exception] = None
 
 
+class WorkerVerification:
+
+    def __init__(self, numero: int):
+        self.numero = numero
+        self.debut = time.monotonic()
+        self.jobs = 0
+        self.octets = 0
+        self.temps_occupe = 0.0
+
+    def ajouter_job(self, duree: float, taille: Optional[int]):
+        self.jobs += 1
+        self.octets += taille or 0
+        self.temps_occupe += duree
+
+    def get_stats(self) -> dict:
+        return {
+            'worker': self.numero,
+            'jobs': self.jobs,
+            'octets': self.octets,
+            'utilisation': self.temps_occupe / max(time.monotonic() - self.debut, 1e-6),
+        }
+
+
 class ConsignationHandler:
 
-    def __init__(self, stop_event: Optional[asyncio.Event], etat):
+    def __init__(self, stop_event: Optional[asyncio.Event], etat, cache_jwt: Optional[CacheJwt] = None,
+                 metriques: Optional[MetriquesHebergement] = None, intake: Optional[IntakeFichiers] = None,
+                 cache_certificats: Optional[CacheCertificats] = None):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
-        self._semaphore_threads = BoundedSemaphore(value=5)
+        # Slots de traitement par idmg : metadata (job, post) et transfert (body des PUT)
+        self._ordonnanceur = Ordonnanceur()
         self.__stop_event = stop_event
         self.__etat = etat
-        self.__queue_verifier_parts: Optional[asyncio.Queue] = None
-        self.__intake = IntakeFichiers(stop_event, etat)
+        self.__cache_jwt = cache_jwt or CacheJwt()
+        self.__cache_certificats = cache_certificats or etat  # Interface charger_certificat(kid)
+        self.__metriques = metriques or MetriquesHebergement()
+        self.__metriques.ajouter_collecteur(self.collecter_metriques)
+        self.__queue_verifier_parts: Optional[asyncio.PriorityQueue] = None
+        self.__workers_verification: list[WorkerVerification] = list()
+        self.__sequence_jobs = itertools.count()
+        self.__taches_rattrapage: set[asyncio.Task] = set()  # Rattrapage du hachage des parts differees
+        self.__verifications_en_cours: set[tuple[str, str]] = set()  # (idmg, fuuid) en verification/assemblage
+        self.__intake = intake or IntakeFichiers(stop_event, etat)
+        self.__journal_sessions: Optional[JournalSessions] = None
+        self.__sessions = SessionsUpload()  # Remplace dans setup() avec le journal
+        self.__pool_ecriture = PoolEcriture()
+        self.__index_backup: Optional[IndexBackup] = None
+        self.__references: Optional[ReferencesFuuid] = None
+        self.__nettoyage_staging: Optional[NettoyageStaging] = None
+        self.__event_nettoyage_staging = asyncio.Event()
+        self.__mode_upload = os.environ.get(ConstantesHebergement.ENV_MODE_UPLOAD) or ConstantesHebergement.MODE_UPLOAD_PARTS
+        self.__budget_staging = get_budget(ConstantesHebergement.ENV_STAGING_BUDGET)
+        self.__budget_staging_idmg = get_budget(ConstantesHebergement.ENV_STAGING_BUDGET_IDMG)
 
     async def setup(self):
         await self.__intake.configurer()
+        self.__index_backup = IndexBackup(self.__etat.configuration.dir_staging)
+        self.__references = ReferencesFuuid(
+            pathlib.Path(self.__etat.configuration.dir_staging, ConstantesHebergement.FICHIER_REFERENCES))
+        await asyncio.to_thread(self.__references.charger)
+
+        # Reconstruire l'index des uploads a partir du journal des sessions (ou du staging)
+        dir_staging = self.__etat.configuration.dir_staging
+        path_staging_upload = pathlib.Path(dir_staging, ConstantesHebergement.DIR_STAGING_UPLOAD)
+        path_staging_intake = pathlib.Path(dir_staging, ConstantesHebergement.DIR_STAGING_INTAKE)
+        self.__journal_sessions = JournalSessions(
+            pathlib.Path(dir_staging, ConstantesHebergement.FICHIER_JOURNAL_SESSIONS))
+        self.__sessions = SessionsUpload(self.__journal_sessions)
+        await asyncio.to_thread(self.__sessions.charger, path_staging_upload, path_staging_intake)
+
+        # Queue creee avant run() : la recuperation des uploads peut y ajouter des jobs des le demarrage
+        self.__queue_verifier_parts = asyncio.PriorityQueue(maxsize=TAILLE_QUEUE_VERIFICATION)
+
+        self.__nettoyage_staging = NettoyageStaging(
+            path_staging_upload, self.__sessions, self.__pool_ecriture,
+            expiration=get_expiration_staging(),
+            budget_global=self.__budget_staging, budget_idmg=self.__budget_staging_idmg)
 
     def get_routes(self, app_path):
         path_base_fichiers = f'{app_path}/fichiers'
+        duree_requetes = self.__metriques.duree_requetes
         return [
             # /fichiers_transfert
             web.get('%s/job/{fuuid}' % path_base_fichiers, self.handle_get_job_fuuid),
+            web.post('%s/job' % path_base_fichiers, self.handle_post_jobs),  # Avant POST {fuuid}
+            web.post('%s/lot' % path_base_fichiers,
+                     mesurer_handler(duree_requetes, 'post_lot', self.handle_post_lot)),  # Avant POST {fuuid}
             web.get('%s/{fuuid}' % path_base_fichiers, self.handle_get_fuuid),
-            web.put('%s/{fuuid}/{position}' % path_base_fichiers, self.handle_put_fuuid),
-            web.post('%s/{fuuid}' % path_base_fichiers, self.handle_post_fuuid),
+            web.post('%s/session/{fuuid}' % path_base_fichiers, self.handle_post_session_fuuid),
+            web.put('%s/{fuuid}/{position}' % path_base_fichiers,
+                    mesurer_handler(duree_requetes, 'put_fuuid', self.handle_put_fuuid)),
+            web.post('%s/{fuuid}' % path_base_fichiers,
+                     mesurer_handler(duree_requetes, 'post_fuuid', self.handle_post_fuuid)),
             web.delete('%s/{fuuid}' % path_base_fichiers, self.handle_delete_fuuid),
 
             # /sync
@@ -68,23 +174,48 @@ class ConsignationHandler:
         return pathlib.Path(self.__etat.configuration.dir_staging, ConstantesHebergement.DIR_STAGING_UPLOAD, cn, fuuid)
 
     async def handle_get_fuuid(self, request: Request):
-        async with self._semaphore_threads:
-            raise NotImplementedError("todo")
+        fuuid = request.match_info['fuuid']
+        self.__logger.debug("handle_get_fuuid fuuid %s, range %s" % (fuuid, request.headers.get('Range')))
 
-    async def handle_get_job_fuuid(self, request: Request):
-        async with self._semaphore_threads:
-            fuuid = request.match_info['fuuid']
-            method = request.method
-            self.__logger.debug("handle_get_fuuid method %s, fuuid %s" % (method, fuuid))
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        # Seul un idmg qui detient une reference sur le fuuid peut le lire (404 : ne pas reveler son existence)
+        idmgs = self.__references.get_idmgs(fuuid)
+        if idmgs is None or idmg not in idmgs:
+            return web.HTTPNotFound()
 
-            # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
-            try:
-                jwt_contenu = await parse_jwt(self.__etat, request.headers['X-jwt'])
-                idmg = jwt_contenu['sub']
-            except:
-                self.__logger.exception("Erreur verification JWT")
-                return web.HTTPForbidden()
+        async with self._ordonnanceur.transfert.slot(idmg):
+            # Le fichier est disponible localement tant qu'il est dans l'intake (deja verifie)
+            path_intake = self.__intake.get_path_intake_fuuid(fuuid)
+            source = await self.__pool_ecriture.executer(SourceFichier.charger, path_intake)
+            if source is None:
+                return web.HTTPNotFound()
+
+            # Le contenu d'un fuuid est immuable (hachage), le fuuid est un ETag fort
+            return await preparer_reponse(request, source, '"%s"' % fuuid)
 
+    async def handle_get_job_fuuid(self, request: Request):
+        fuuid = request.match_info['fuuid']
+        method = request.method
+        self.__logger.debug("handle_get_fuuid method %s, fuuid %s" % (method, fuuid))
+
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        async with self._ordonnanceur.metadata.slot(idmg):
             # TODO Verifier si le fichier existe dans la consignation (destination)
             # try:
             #     info = await self.__consignation.get_info_fichier(fuuid)
@@ -94,67 +225,227 @@ class ConsignationHandler:
             # except (TypeError, AttributeError, KeyError):
             #     pass  # OK, le fichier n'existe pas
 
-            # Verifier si le fichier est dans l'intake
-            path_intake = self.__intake.get_path_intake_fuuid(fuuid)
-            if path_intake.exists():
-                return web.json_response({'complet': False, 'en_traitement': True}, status=201)
+            status, reponse = await self.get_statut_job(idmg, fuuid)
+            if reponse is None:
+                # Ok, le fichier et la job n'existent pas
+                return web.HTTPNotFound()
+            return web.json_response(reponse, status=status)
+
+    async def handle_post_jobs(self, request: Request):
+        """
+        Statut de plusieurs jobs dans une seule requete. Body : {fuuids: [fuuid, ...]}
+        Accessible sans readwrite (WebJwt) : ne doit rien modifier (get_statut_job en lecture seulement).
+        """
+        # Lire JWT pour recuperer le idmg (sub), une seule fois pour le lot
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        async with self._ordonnanceur.metadata.slot(idmg):
+            try:
+                requete = await request.json()
+                fuuids = [str(f) for f in requete['fuuids']]
+            except Exception:
+                self.__logger.exception("handle_post_jobs Requete invalide")
+                return web.HTTPBadRequest()
+            if len(fuuids) > MAX_FUUIDS_JOBS:
+                return web.HTTPRequestEntityTooLarge(max_size=MAX_FUUIDS_JOBS, actual_size=len(fuuids))
+
+            # Resolution en memoire (intake, references et sessions de staging), sans acces disque.
+            # Le status correspond a la reponse de GET job/{fuuid} pour chaque fuuid.
+            jobs = dict()
+            for fuuid in fuuids:
+                status, reponse = await self.get_statut_job(idmg, fuuid)
+                if reponse is None:
+                    jobs[fuuid] = {'status': 404, 'complet': False}
+                else:
+                    reponse['status'] = status
+                    jobs[fuuid] = reponse
+
+            return web.json_response({'ok': True, 'jobs': jobs})
+
+    async def get_statut_job(self, idmg: str, fuuid: str) -> tuple[int, Optional[dict]]:
+        """
+        Statut d'un upload a partir de l'index en memoire (maintenu par PUT, POST et la remise a l'intake).
+        Aucun effet de bord (requete de statut, aussi utilisee par POST job avec un token en lecture seulement).
+        :return: (status http, reponse). La reponse est None si le fichier et la job n'existent pas.
+        """
+        # Seules les references de ce idmg sont considerees : ne pas reveler les fuuids des autres idmg
+        idmgs = self.__references.get_idmgs(fuuid)
+        reference = idmgs is not None and idmg in idmgs
+
+        # Verifier si le fichier est dans l'intake
+        if self.__sessions.est_intake(fuuid) and reference:
+            return 201, {'complet': False, 'en_traitement': True}
+
+        session = self.__sessions.get_session(idmg, fuuid)
+
+        # Contenu deja recu et verifie pour ce idmg
+        if session is None and reference:
+            return 200, {'complet': True}
+
+        # Verifier si la job existe
+        if session is not None:
+            # La job existe, retourner a quelle position du fichier on est rendu.
+            reponse = {'complet': False, 'position': session.position}
+            if session.mode == ConstantesHebergement.MODE_UPLOAD_FICHIER:
+                reponse['manquants'] = session.manquants
+            return 200, reponse
+
+        return 404, None
+
+    async def handle_post_session_fuuid(self, request: Request):
+        """
+        Ouverture d'une session d'upload avec la taille du fichier (body : {taille}). L'espace est reserve
+        (fallocate) dans un fichier unique et les PUT suivants sont ecrits en mode fichier.
+        Refus : 413 si le fichier ne peut jamais etre accepte, 503 si le budget du idmg ou du staging est
+        temporairement plein, 507 si l'espace disque est insuffisant (avec Retry-After).
+        """
+        fuuid = request.match_info['fuuid']
+
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        async with self._ordonnanceur.metadata.slot(idmg):
+            try:
+                valider_nom(fuuid)
+                requete = await request.json()
+                taille = int(requete['taille'])
+                if taille <= 0:
+                    raise ValueError('taille doit etre > 0')
+            except Exception:
+                self.__logger.exception("handle_post_session_fuuid Requete invalide")
+                return web.HTTPBadRequest()
+
+            if await self.dedupliquer(idmg, fuuid):
+                return web.json_response({'complet': True})
+
+            session = self.__sessions.get_session(idmg, fuuid)
+            if session is not None:
+                if session.taille_declaree != taille:
+                    # Upload deja commence sans declaration ou avec une autre taille
+                    return web.json_response({'complet': False, 'position': session.position}, status=409)
+                # Reprise d'une session existante
+                return web.json_response(
+                    {'complet': False, 'position': session.position, 'manquants': session.manquants})
+
+            # Controle d'admission des budgets et reservation (declaration de la session) sans await depuis la
+            # lecture de la session existante : des ouvertures concurrentes ne peuvent pas toutes passer le controle.
+            headers_retry = {'Retry-After': str(RETRY_AFTER_ESPACE)}
+            if (self.__budget_staging is not None and taille > self.__budget_staging) or \
+                    (self.__budget_staging_idmg is not None and taille > self.__budget_staging_idmg):
+                return web.HTTPRequestEntityTooLarge(
+                    max_size=min(b for b in [self.__budget_staging, self.__budget_staging_idmg] if b is not None),
+                    actual_size=taille)
+            if self.__budget_staging_idmg is not None and \
+                    self.__sessions.get_taille_staging(idmg) + taille > self.__budget_staging_idmg:
+                return web.HTTPServiceUnavailable(headers=headers_retry)
+            if self.__budget_staging is not None and \
+                    self.__sessions.get_taille_staging() + taille > self.__budget_staging:
+                return web.HTTPServiceUnavailable(headers=headers_retry)
+            session = self.__sessions.declarer_session(idmg, fuuid, taille)
 
-            # Verifier si la job existe
             path_upload = self.get_path_upload_fuuid(idmg, fuuid)
-            if path_upload.exists():
-                # La job existe, trouver a quelle position du fichier on est rendu.
-                part_max = 0
-                position_courante = 0
-                for fichier in path_upload.iterdir():
-                    if fichier.name.endswith('.part'):
-                        part_position = int(fichier.name.split('.')[0])
-                        if part_position >= part_max:
-                            part_max = part_position
-                            stat_fichier = fichier.stat()
-                            position_courante = part_position + stat_fichier.st_size
-
-                return web.json_response({'complet': False, 'position': position_courante})
-
-            # Ok, le fichier et la job n'existent pas
-            return web.HTTPNotFound()
+            repertoire_cree = False
+            try:
+                dir_staging = self.__etat.configuration.dir_staging
+                espace = await self.__pool_ecriture.executer(shutil.disk_usage, dir_staging)
+                if taille + MARGE_ESPACE_LIBRE > espace.total:
+                    self.__sessions.retirer_session(idmg, fuuid)
+                    return web.HTTPRequestEntityTooLarge(
+                        max_size=max(0, espace.total - MARGE_ESPACE_LIBRE), actual_size=taille)
+                if espace.free - MARGE_ESPACE_LIBRE < taille:
+                    self.__sessions.retirer_session(idmg, fuuid)
+                    return web.Response(status=507, headers=headers_retry)
+
+                repertoire_cree = await self.__pool_ecriture.executer(creer_repertoire, path_upload)
+                if repertoire_cree is False:
+                    self.__sessions.retirer_session(idmg, fuuid)
+                    return web.HTTPConflict()  # Upload en cours sans session (e.g. upload en lot)
+
+                path_donnees = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_DONNEES)
+                await self.__pool_ecriture.executer(preallouer_fichier, path_donnees, taille)
+                await self.__sessions.persister_recus(session, path_upload, self.__pool_ecriture.executer)
+            except BaseException as e:
+                # Liberer la reservation
+                self.__sessions.retirer_session(idmg, fuuid)
+                if repertoire_cree:
+                    await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+                if isinstance(e, OSError) and e.errno == errno.ENOSPC:
+                    return web.Response(status=507, headers=headers_retry)
+                raise
+
+            return web.json_response(
+                {'complet': False, 'position': 0, 'manquants': session.manquants}, status=201)
 
     async def handle_put_fuuid(self, request: Request):
-        async with self._semaphore_threads:
-            fuuid = request.match_info['fuuid']
-            position = request.match_info['position']
-            headers = request.headers
-
-            # Afficher info (debug)
-            self.__logger.debug("handle_put_fuuid fuuid: %s position: %s" % (fuuid, position))
-            for key, value in headers.items():
-                self.__logger.debug('handle_put_fuuid key: %s, value: %s' % (key, value))
+        fuuid = request.match_info['fuuid']
+        position = request.match_info['position']
+        headers = request.headers
 
-            # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
-            try:
-                jwt_contenu = await parse_jwt(self.__etat, request.headers['X-jwt'])
-                idmg = jwt_contenu['sub']
-            except:
-                self.__logger.exception("Erreur verification JWT")
-                return web.HTTPForbidden()
+        # Afficher info (debug)
+        self.__logger.debug("handle_put_fuuid fuuid: %s position: %s" % (fuuid, position))
+        for key, value in headers.items():
+            self.__logger.debug('handle_put_fuuid key: %s, value: %s' % (key, value))
 
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        if await self.dedupliquer(idmg, fuuid):
+            # Contenu deja detenu, le body n'est pas conserve
+            return web.json_response({'complet': True})
+
+        async with self._ordonnanceur.transfert.slot(idmg):
             content_hash = headers.get('x-content-hash')
             try:
                 content_length = int(headers['Content-Length'])
             except KeyError:
                 content_length = None
 
+            try:
+                position_int = int(position)
+            except ValueError:
+                return web.HTTPBadRequest()
+
             # Creer repertoire pour sauvegader la partie de fichier
             path_upload = self.get_path_upload_fuuid(idmg, fuuid)
-            path_upload.mkdir(parents=True, exist_ok=True)
+            repertoire_cree = await self.__pool_ecriture.executer(creer_repertoire, path_upload)
+            session = self.__sessions.ouvrir_session(idmg, fuuid, repertoire_cree, self.__mode_upload)
+            mode_fichier = session.mode == ConstantesHebergement.MODE_UPLOAD_FICHIER
+
+            if session.taille_declaree is not None and content_length is not None and \
+                    position_int + content_length > session.taille_declaree:
+                self.__logger.info("handle_put_fuuid Part %d (%d octets) depasse la taille declaree %d" % (
+                    position_int, content_length, session.taille_declaree))
+                return web.HTTPBadRequest()
 
             path_fichier = pathlib.Path(path_upload, '%s.part' % position)
-            # S'assurer que le fichier .part n'existe pas deja (on serait en mode resume)
-            try:
-                stat_fichier = path_fichier.stat()
-                if content_length == stat_fichier.st_size:
+            if mode_fichier:
+                # S'assurer que l'intervalle n'a pas deja ete recu (on serait en mode resume)
+                if content_length is not None and session.contient(position_int, content_length):
+                    return web.HTTPOk()
+            else:
+                # S'assurer que le fichier .part n'existe pas deja (on serait en mode resume)
+                taille_existante = await self.__pool_ecriture.executer(get_taille_fichier, path_fichier)
+                if taille_existante is not None and content_length == taille_existante:
+                    session.ajouter_part(position_int, taille_existante)
                     return web.HTTPOk()  # On a deja ce .part de fichier, il a la meme longueur
-            except FileNotFoundError:
-                pass  # Fichier absent ou taille differente
 
             path_fichier_work = pathlib.Path(path_upload, '%s.part.work' % position)
             self.__logger.debug("handle_put_fuuid Conserver part %s" % path_fichier)
@@ -163,96 +454,171 @@ class ConsignationHandler:
                 verificateur = VerificateurHachage(content_hash)
             else:
                 verificateur = None
-            with open(path_fichier_work, 'wb', buffering=1024 * 1024) as fichier:
-                async for chunk in request.content.iter_chunked(64 * 1024):
-                    if verificateur:
-                        verificateur.update(chunk)
-                    fichier.write(chunk)
 
-            # Verifier hachage de la partie
-            if verificateur:
+            # Hacher le fichier complet pendant la reception si cette part est la prochaine dans l'ordre
+            hachee = session.debuter_part(position_int)
+            hacheurs = [verificateur]
+            if hachee:
+                hacheurs.append(session.verificateur)
+
+            part_ok = False
+            if mode_fichier:
+                # Ecriture positionnelle dans le fichier unique de l'upload
+                path_donnees = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_UPLOAD_DONNEES)
+                ecrivain = EcrivainFichier(self.__pool_ecriture, path_donnees, hacheurs,
+                                           offset=position_int, preallocation=content_length)
+            else:
+                ecrivain = EcrivainFichier(self.__pool_ecriture, path_fichier_work, hacheurs)
+            try:
+                await ecrivain.ouvrir()
                 try:
-                    verificateur.verify()
-                except ErreurHachage as e:
-                    self.__logger.info("handle_put_fuuid Erreur verification hachage : %s" % str(e))
-                    # Effacer le repertoire pour permettre un re-upload
-                    shutil.rmtree(path_upload)
+                    async for chunk in request.content.iter_chunked(64 * 1024):
+                        await ecrivain.write(chunk)
+                    await ecrivain.fermer()
+                except BaseException:
+                    await ecrivain.abandonner()
+                    raise
+                finally:
+                    self.__metriques.upload_octets.inc(idmg, 'fichier', valeur=ecrivain.taille)
+
+                # Verifier hachage de la partie
+                if verificateur:
+                    try:
+                        verificateur.verify()
+                    except ErreurHachage as e:
+                        self.__logger.info("handle_put_fuuid Erreur verification hachage : %s" % str(e))
+                        # Effacer le repertoire pour permettre un re-upload
+                        await self.__pool_ecriture.executer(shutil.rmtree, path_upload)
+                        self.__sessions.retirer_session(idmg, fuuid)
+                        return web.HTTPBadRequest()
+
+                # Verifier que la taille sur disque correspond a la taille attendue
+                # Meme si le hachage est OK, s'assurer d'avoir conserve tous les bytes
+                if mode_fichier:
+                    taille_fichier = ecrivain.taille
+                else:
+                    taille_fichier = await self.__pool_ecriture.executer(get_taille_fichier, path_fichier_work)
+                if content_length is not None and taille_fichier != content_length:
+                    self.__logger.info("handle_put_fuuid Erreur verification taille, sauvegarde %s, attendu %d" % (
+                    taille_fichier, content_length))
+                    if mode_fichier is False:
+                        await self.__pool_ecriture.executer(supprimer_fichier, path_fichier_work)
                     return web.HTTPBadRequest()
 
-            # Verifier que la taille sur disque correspond a la taille attendue
-            # Meme si le hachage est OK, s'assurer d'avoir conserve tous les bytes
-            stat = path_fichier_work.stat()
-            if content_length is not None and stat.st_size != content_length:
-                self.__logger.info("handle_put_fuuid Erreur verification taille, sauvegarde %d, attendu %d" % (
-                stat.st_size, content_length))
-                path_fichier_work.unlink(missing_ok=True)
-                return web.HTTPBadRequest()
+                if mode_fichier is False:
+                    # Retirer le .work du fichier
+                    await self.__pool_ecriture.executer(path_fichier_work.rename, path_fichier)
+                part_ok = True
+            finally:
+                if part_ok:
+                    session.terminer_part(position_int, taille_fichier, hachee)
+                    self.__sessions.enregistrer_part(session, position_int, taille_fichier)
+                else:
+                    session.abandonner_part(hachee)
+
+            if mode_fichier:
+                await self.__sessions.persister_recus(session, path_upload, self.__pool_ecriture.executer)
 
-            # Retirer le .work du fichier
-            path_fichier_work.rename(path_fichier)
+        # Hacher les parts recues hors ordre qui suivent maintenant. Peut relire plusieurs Go : en arriere-plan
+        # dans le pool, hors du slot de transfert et sans retarder la reponse.
+        if len(session.parts_differees) > 0:
+            tache = asyncio.create_task(
+                self.__sessions.rattraper_hachage(session, path_upload, self.__pool_ecriture.executer))
+            self.__taches_rattrapage.add(tache)
+            tache.add_done_callback(self.__taches_rattrapage.discard)
 
         self.__logger.debug("handle_put_fuuid fuuid: %s position: %s recu OK" % (fuuid, position))
         return web.HTTPOk()
 
     async def handle_post_fuuid(self, request: Request):
-        async with self._semaphore_threads:
-            fuuid = request.match_info['fuuid']
-            self.__logger.debug("handle_post_fuuid %s" % fuuid)
-
-            headers = request.headers
-            if request.body_exists:
-                body = await request.json()
-                self.__logger.debug("handle_post_fuuid body\n%s" % json.dumps(body, indent=2))
-            else:
-                # Aucun body - transferer le contenu du fichier sans transactions (e.g. image small)
-                body = None
+        fuuid = request.match_info['fuuid']
+        self.__logger.debug("handle_post_fuuid %s" % fuuid)
 
-            # Afficher info (debug)
-            self.__logger.debug("handle_post_fuuid fuuid: %s" % fuuid)
-            for key, value in headers.items():
-                self.__logger.debug('handle_post_fuuid key: %s, value: %s' % (key, value))
-
-            # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
-            try:
-                jwt_contenu = await parse_jwt(self.__etat, request.headers['X-jwt'])
-                idmg = jwt_contenu['sub']
-            except:
-                self.__logger.exception("Erreur verification JWT")
-                return web.HTTPForbidden()
-
-            path_upload = self.get_path_upload_fuuid(idmg, fuuid)
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        cle = (idmg, fuuid)
+        if cle in self.__verifications_en_cours:
+            # POST repete (ou recuperation au demarrage) pendant la verification du fichier
+            return web.HTTPCreated()
+        # Aucun await entre la verification et l'ajout : un seul job de verification/assemblage par upload
+        self.__verifications_en_cours.add(cle)
+        session = self.__sessions.get_session(idmg, fuuid)
+        if session is not None:
+            session.etat = ETAT_VERIFICATION
+        job_ajoute = False
+        try:
+            if session is None and await self.dedupliquer(idmg, fuuid):
+                return web.HTTPAccepted()  # Contenu deja detenu et verifie
+
+            async with self._ordonnanceur.metadata.slot(idmg):
+                headers = request.headers
+                if request.body_exists:
+                    body = await request.json()
+                    self.__logger.debug("handle_post_fuuid body\n%s" % json.dumps(body, indent=2))
+                else:
+                    # Aucun body - transferer le contenu du fichier sans transactions (e.g. image small)
+                    body = None
+
+                # Afficher info (debug)
+                self.__logger.debug("handle_post_fuuid fuuid: %s" % fuuid)
+                for key, value in headers.items():
+                    self.__logger.debug('handle_post_fuuid key: %s, value: %s' % (key, value))
+
+                path_upload = self.get_path_upload_fuuid(idmg, fuuid)
+
+                taille_finalisee = None
+                if session is not None and session.mode == ConstantesHebergement.MODE_UPLOAD_FICHIER:
+                    # Le fichier doit etre complet (un seul intervalle a partir de 0) pour etre verifie
+                    if len(session.recus) != 1 or session.recus[0][0] != 0 or \
+                            (session.taille_declaree is not None and session.recus[0][1] != session.taille_declaree):
+                        return web.json_response({'complet': False, 'manquants': session.manquants}, status=409)
+                    taille = session.recus[0][1]
+                    await self.__pool_ecriture.executer(finaliser_fichier_upload, path_upload, taille)
+                    session.mode = ConstantesHebergement.MODE_UPLOAD_PARTS
+                    session.parts = {0: taille}
+                    taille_finalisee = taille
+                    if len(session.parts_differees) > 0:
+                        session.invalider_hachage()
+
+                # Creer commande d'hebergement de fichier
+                contenu_commande = {'idmg': idmg, 'fuuid': fuuid}
+                formatteur_message = self.__etat.formatteur_message
+                transaction, message_id = formatteur_message.signer_message(
+                    Constantes.KIND_COMMANDE, contenu_commande, 'Hebergement', action='ajouterFichier')
+
+                cles = None
+
+                if body is not None:
+                    # Valider body, conserver json sur disque
+                    etat = body['etat']
+                    hachage = etat['hachage']
+                else:
+                    # Sauvegarder etat.json sans body
+                    etat = {'hachage': fuuid, 'retryCount': 0,
+                            'created': int(datetime.datetime.utcnow().timestamp() * 1000)}
+                    hachage = fuuid
 
-            # Creer commande d'hebergement de fichier
-            contenu_commande = {'idmg': idmg, 'fuuid': fuuid}
-            formatteur_message = self.__etat.formatteur_message
-            transaction, message_id = formatteur_message.signer_message(
-                Constantes.KIND_COMMANDE, contenu_commande, 'Hebergement', action='ajouterFichier')
-            path_transaction = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_TRANSACTION)
-            with open(path_transaction, 'wt') as fichier:
-                json.dump(transaction, fichier)
-
-            cles = None
-
-            path_etat = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_ETAT)
-            if body is not None:
-                # Valider body, conserver json sur disque
-                etat = body['etat']
-                hachage = etat['hachage']
-                with open(path_etat, 'wt') as fichier:
-                    json.dump(etat, fichier)
+                # transaction.json et etat.json sont ecrits dans le pool (hors de la loop)
+                await self.__pool_ecriture.executer(ecrire_transaction_upload, path_upload, transaction, etat)
+                await self.__sessions.enregistrer_post(idmg, fuuid, hachage, taille_finalisee)
 
-            else:
-                # Sauvegarder etat.json sans body
-                etat = {'hachage': fuuid, 'retryCount': 0,
-                        'created': int(datetime.datetime.utcnow().timestamp() * 1000)}
-                hachage = fuuid
-                with open(path_etat, 'wt') as fichier:
-                    json.dump(etat, fichier)
-
-            # Valider hachage du fichier complet (parties assemblees)
+            # Valider hachage du fichier complet (parties assemblees). L'attente se fait hors du slot.
             try:
-                job_valider = JobVerifierParts(transaction, path_upload, hachage, cles)
-                await self.__queue_verifier_parts.put(job_valider)
+                session = self.__sessions.get_session(idmg, fuuid)
+                job_valider = JobVerifierParts(transaction, path_upload, hachage, cles, session)
+                if session is not None and session.hachage_complet(hachage):
+                    job_valider.taille = session.position_hachage
+                else:
+                    job_valider.taille = await self.__pool_ecriture.executer(calculer_taille_upload, path_upload)
+                await self.ajouter_job_verifier_parts(job_valider)
+                job_ajoute = True  # Le worker libere la verification en cours
                 await asyncio.wait_for(job_valider.done.wait(), timeout=20)
                 if job_valider.exception is not None:
                     raise job_valider.exception
@@ -263,116 +629,523 @@ class ConsignationHandler:
             except Exception as e:
                 self.__logger.exception(
                     'handle_post_fuuid Erreur verification hachage fichier %s assemble : %s' % (fuuid, e))
-                shutil.rmtree(path_upload)
+                await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+                self.__sessions.retirer_session(idmg, fuuid)
                 return web.HTTPFailedDependency()
 
-        return web.HTTPAccepted()
+            return web.HTTPAccepted()
+        finally:
+            if job_ajoute is False:
+                # Fichier incomplet ou erreur avant la verification : l'upload peut continuer
+                self.__verifications_en_cours.discard(cle)
+                if session is not None and session.etat == ETAT_VERIFICATION:
+                    session.etat = ETAT_UPLOAD
+
+    async def handle_post_lot(self, request: Request):
+        """
+        Upload en lot de petits fichiers complets (multipart, une part par fichier, nom de la part : fuuid).
+        Remplace PUT + POST par fichier. Chaque fichier est hache pendant la reception et remis a l'intake des
+        qu'il est valide (une deconnexion ne laisse pas de repertoire orphelin). Les references sont ecrites
+        en une seule operation a la fin de la requete.
+        """
+        # Lire JWT pour recuperer le idmg (sub), une seule fois pour le lot
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        try:
+            reader = await request.multipart()
+        except Exception:
+            self.__logger.exception("handle_post_lot Requete multipart invalide")
+            return web.HTTPBadRequest()
+
+        resultats = dict()
+        recus = list()
+        operations = list()
+        async with self._ordonnanceur.transfert.slot(idmg):
+            try:
+                while True:
+                    part = await reader.next()  # Le reste de la part precedente est ignore
+                    if part is None:
+                        break
+                    fuuid = part.filename or part.name
+                    if fuuid is None or fuuid in resultats:
+                        continue
+                    if len(resultats) >= MAX_FICHIERS_LOT:
+                        resultats[fuuid] = {'status': 413}
+                        continue
+                    resultats[fuuid] = await self.recevoir_fichier_lot(idmg, fuuid, part, recus)
+                    # Remise a l'intake immediate
+                    await self.remettre_intake_lot(idmg, recus, resultats, operations)
+                    recus.clear()
+            finally:
+                # Une seule ecriture du journal de references pour le lot, meme si la requete est interrompue
+                if len(operations) > 0:
+                    await self.__pool_ecriture.executer(self.__references.sauvegarder_lot, operations)
+
+        self.__logger.debug("handle_post_lot %d fichiers, %d references ajoutees" % (len(resultats), len(operations)))
+        return web.json_response({'ok': True, 'fichiers': resultats})
+
+    async def recevoir_fichier_lot(self, idmg: str, fuuid: str, part, recus: list) -> dict:
+        try:
+            valider_nom(fuuid)
+            verificateur = VerificateurHachage(fuuid)
+        except Exception:
+            return {'status': 400}
+
+        if await self.dedupliquer(idmg, fuuid):
+            return {'status': 200, 'complet': True}
+
+        path_upload = self.get_path_upload_fuuid(idmg, fuuid)
+        if await self.__pool_ecriture.executer(creer_repertoire, path_upload) is False:
+            return {'status': 409}  # Upload deja en cours pour ce fuuid (PUT/POST)
+
+        # Le fichier complet est conserve comme une seule part
+        ecrivain = EcrivainFichier(self.__pool_ecriture, pathlib.Path(path_upload, '0.part'), [verificateur])
+        trop_gros = False
+        await ecrivain.ouvrir()
+        try:
+            while True:
+                chunk = await part.read_chunk(64 * 1024)
+                if not chunk:
+                    break
+                if ecrivain.taille + len(chunk) > TAILLE_MAX_FICHIER_LOT:
+                    trop_gros = True
+                    break
+                await ecrivain.write(chunk)
+            if trop_gros:
+                await ecrivain.abandonner()
+            else:
+                await ecrivain.fermer()
+        except BaseException:
+            await ecrivain.abandonner()
+            await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+            raise
+        finally:
+            self.__metriques.upload_octets.inc(idmg, 'lot', valeur=ecrivain.taille)
+
+        if trop_gros:
+            await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+            return {'status': 413}
+
+        try:
+            verificateur.verify()
+        except ErreurHachage as e:
+            self.__logger.info("recevoir_fichier_lot Erreur verification hachage %s : %s" % (fuuid, str(e)))
+            await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+            return {'status': 400}
+
+        # Meme contenu que le POST sans body (transaction.json et etat.json)
+        try:
+            contenu_commande = {'idmg': idmg, 'fuuid': fuuid}
+            transaction, message_id = self.__etat.formatteur_message.signer_message(
+                Constantes.KIND_COMMANDE, contenu_commande, ConstantesHebergement.NOM_DOMAINE, action='ajouterFichier')
+            etat = {'hachage': fuuid, 'retryCount': 0, 'created': int(datetime.datetime.utcnow().timestamp() * 1000)}
+            await self.__pool_ecriture.executer(ecrire_transaction_upload, path_upload, transaction, etat)
+        except BaseException:
+            await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+            raise
+
+        recus.append((fuuid, path_upload))
+        return {'status': 202}
+
+    async def remettre_intake_lot(self, idmg: str, recus: list, resultats: dict, operations: list):
+        """ :param operations: Operations du journal de references a ecrire par l'appelant. """
+        for fuuid, path_upload in recus:
+            try:
+                await self.__intake.ajouter_upload(path_upload)
+            except Exception:
+                self.__logger.exception('remettre_intake_lot Erreur ajout fichier %s au intake' % path_upload)
+                await self.__pool_ecriture.executer(supprimer_repertoire, path_upload)
+                resultats[fuuid] = {'status': 500}
+                continue
+            self.__sessions.ajouter_intake(idmg, fuuid)
+            if self.__references.ajouter(fuuid, idmg):
+                operations.append(('+', fuuid, idmg))
 
     async def handle_delete_fuuid(self, request: Request):
-        async with self._semaphore_threads:
-            raise NotImplementedError("todo")
+        raise NotImplementedError("todo")
 
     async def handle_post_backup_verifierfichiers(self, request: Request):
-        async with self._semaphore_threads:
-            raise NotImplementedError("todo")
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        async with self._ordonnanceur.metadata.slot(idmg):
+            # Format : {uuid_backup, domaine, fichiers: [nomfichier, ...]}. Un fichier peut aussi etre un
+            # dict {uuid_backup, domaine, nomfichier} pour verifier plusieurs backups/domaines dans la meme requete.
+            try:
+                requete = await request.json()
+                uuid_backup = requete.get('uuid_backup')
+                domaine = requete.get('domaine')
+                fichiers = requete['fichiers']
+                cles = list()
+                for fichier in fichiers:
+                    if isinstance(fichier, str):
+                        cles.append(IndexBackup.cle(uuid_backup, domaine, fichier))
+                    else:
+                        cles.append(IndexBackup.cle(fichier['uuid_backup'], fichier['domaine'], fichier['nomfichier']))
+            except Exception:
+                self.__logger.exception("handle_post_backup_verifierfichiers Requete invalide")
+                return web.HTTPBadRequest()
+
+            presents = await self.__index_backup.verifier(idmg, cles, self.__pool_ecriture.executer)
+
+            # Reponse compacte : seulement les fichiers manquants
+            manquants = [f for f, present in zip(fichiers, presents) if present is False]
+            return web.json_response({'ok': True, 'nombre': len(fichiers), 'manquants': manquants})
+
+    def get_path_backup(self, idmg: str, request: Request) -> pathlib.Path:
+        uuid_backup = request.match_info['uuid_backup']
+        domaine = request.match_info['domaine']
+        nomfichier = request.match_info['nomfichier']
+        return get_path_backup(self.__etat.configuration.dir_staging, idmg, uuid_backup, domaine, nomfichier)
 
     async def handle_put_backup(self, request: Request):
-        async with self._semaphore_threads:
-            raise NotImplementedError("todo")
+        headers = request.headers
+
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        try:
+            path_fichier = self.get_path_backup(idmg, request)
+        except ValueError:
+            return web.HTTPBadRequest()
+
+        self.__logger.debug("handle_put_backup Conserver %s" % path_fichier)
+
+        async with self._ordonnanceur.transfert.slot(idmg):
+            content_hash = headers.get('x-content-hash')
+            try:
+                content_length = int(headers['Content-Length'])
+            except KeyError:
+                content_length = None
+
+            if content_hash:
+                verificateur = VerificateurHachage(content_hash)
+            else:
+                verificateur = None
+
+            await self.__pool_ecriture.executer(creer_repertoire, path_fichier.parent)
+
+            # Recevoir dans un fichier .work, memoire bornee peu importe la taille de l'archive.
+            # Nom unique : des PUT concurrents du meme fichier ont chacun leur .work (le dernier rename gagne).
+            path_fichier_work = pathlib.Path(path_fichier.parent, '%s.%s.work' % (path_fichier.name, uuid.uuid4().hex))
+            ecrivain = EcrivainFichier(self.__pool_ecriture, path_fichier_work, [verificateur])
+            await ecrivain.ouvrir()
+            try:
+                async for chunk in request.content.iter_chunked(64 * 1024):
+                    await ecrivain.write(chunk)
+                await ecrivain.fermer()
+            except BaseException:
+                await ecrivain.abandonner()
+                await self.__pool_ecriture.executer(supprimer_fichier, path_fichier_work)
+                raise
+            finally:
+                self.__metriques.upload_octets.inc(idmg, 'backup', valeur=ecrivain.taille)
+
+            if verificateur:
+                try:
+                    verificateur.verify()
+                except ErreurHachage as e:
+                    self.__logger.info("handle_put_backup Erreur verification hachage : %s" % str(e))
+                    await self.__pool_ecriture.executer(supprimer_fichier, path_fichier_work)
+                    return web.HTTPBadRequest()
+
+            if content_length is not None and ecrivain.taille != content_length:
+                self.__logger.info("handle_put_backup Erreur verification taille, recu %d, attendu %d" % (
+                    ecrivain.taille, content_length))
+                await self.__pool_ecriture.executer(supprimer_fichier, path_fichier_work)
+                return web.HTTPBadRequest()
+
+            # Publier le fichier de maniere atomique
+            await self.__pool_ecriture.executer(path_fichier_work.rename, path_fichier)
+            await self.__index_backup.ajouter(
+                idmg, request.match_info['uuid_backup'], request.match_info['domaine'],
+                request.match_info['nomfichier'], self.__pool_ecriture.executer)
+
+        return web.HTTPOk()
 
     async def handle_get_backup(self, request: Request):
-        async with self._semaphore_threads:
-            raise NotImplementedError("todo")
+        # Lire JWT pour recuperer le idmg (sub). C'est aussi une revalidation.
+        try:
+            jwt_contenu = await parse_jwt(self.__cache_certificats, request.headers['X-jwt'], self.__cache_jwt,
+                                          self.__metriques.jwt_verifications)
+            idmg = jwt_contenu['sub']
+        except:
+            self.__logger.exception("Erreur verification JWT")
+            return web.HTTPForbidden()
+
+        try:
+            path_fichier = self.get_path_backup(idmg, request)
+        except ValueError:
+            return web.HTTPBadRequest()
+
+        async with self._ordonnanceur.transfert.slot(idmg):
+            try:
+                stat_fichier = await self.__pool_ecriture.executer(path_fichier.stat)
+            except FileNotFoundError:
+                return web.HTTPNotFound()
+
+            # Un fichier de backup peut etre remplace, l'ETag depend de la version sur disque
+            source = SourceFichier([(path_fichier, stat_fichier.st_size)])
+            etag = '"%x-%x"' % (stat_fichier.st_mtime_ns, stat_fichier.st_size)
+            return await preparer_reponse(request, source, etag, immuable=False)
 
     async def thread_verifier_parts(self):
-        self.__queue_verifier_parts = asyncio.Queue(maxsize=20)
-        pending = [
-            asyncio.create_task(self.__stop_event.wait()),
-            asyncio.create_task(self.__queue_verifier_parts.get())
-        ]
-        while self.__stop_event.is_set() is False:
-            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        nombre_workers = get_nombre_workers_verification()
+        self.__workers_verification = [WorkerVerification(i) for i in range(0, nombre_workers)]
+        self.__logger.info("thread_verifier_parts Demarrage de %d workers de verification" % nombre_workers)
 
-            # Conditions de fin de thread
-            if self.__stop_event.is_set() is True:
-                for p in pending:
-                    p.cancel()
-                    try:
-                        await p
-                    except asyncio.CancelledError:
-                        pass  # OK
-                    except AttributeError:
-                        pass  # Pas une task
-                for d in done:
-                    if d.exception():
-                        raise d.exception()
-                return  # Stopped
-
-            for t in done:
-                if t.exception():
-                    for p in pending:
-                        try:
-                            p.cancel()
-                            await p
-                        except asyncio.CancelledError:
-                            pass  # OK
-                        except AttributeError:
-                            pass  # Pas une task
-
-                    raise t.exception()
+        pending = [asyncio.create_task(self.__stop_event.wait())]
+        pending.extend([asyncio.create_task(self.worker_verifier_parts(w)) for w in self.__workers_verification])
+
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
 
+        for p in pending:
+            p.cancel()
+            try:
+                await p
+            except asyncio.CancelledError:
+                pass  # OK
+
+        if self.__stop_event.is_set() is False:
             for d in done:
                 if d.exception():
-                    self.__logger.error("thread_verifier_parts Erreur traitement message : %s" % d.exception())
-                else:
-                    job_verifier_parts: JobVerifierParts = d.result()
-                    try:
-                        await self.traiter_job_verifier_parts(job_verifier_parts)
-                    except Exception as e:
-                        self.__logger.exception("thread_verifier_parts Erreur verification hachage %s" % job_verifier_parts.hachage)
-                        job_verifier_parts.exception = e
-                    finally:
-                        # Liberer job
-                        job_verifier_parts.done.set()
+                    raise d.exception()
+            raise Exception('arrete indirectement (worker verification termine)')
 
-            if len(pending) == 0:
-                raise Exception('arrete indirectement (pending vide)')
+    async def ajouter_job_verifier_parts(self, job: JobVerifierParts):
+        # Ordonnancement selon la taille : un petit fichier passe devant un gros fichier deja en attente, mais
+        # la priorite vieillit avec le temps d'attente (pas de famine pour les gros fichiers).
+        priorite = time.monotonic() + (job.taille or 0) / DEBIT_REFERENCE_VERIFICATION
+        await self.__queue_verifier_parts.put((priorite, next(self.__sequence_jobs), job))
 
-            pending.add(asyncio.create_task(self.__queue_verifier_parts.get()))
+    async def worker_verifier_parts(self, worker: WorkerVerification):
+        while self.__stop_event.is_set() is False:
+            _priorite, _sequence, job_verifier_parts = await self.__queue_verifier_parts.get()
+            debut = time.monotonic()
+            try:
+                await self.traiter_job_verifier_parts(job_verifier_parts)
+            except Exception as e:
+                self.__logger.exception("thread_verifier_parts Erreur verification hachage %s" % job_verifier_parts.hachage)
+                job_verifier_parts.exception = e
+            finally:
+                path_upload = job_verifier_parts.path_upload
+                self.__verifications_en_cours.discard((path_upload.parent.name, path_upload.name))
+                duree = time.monotonic() - debut
+                worker.ajouter_job(duree, job_verifier_parts.taille)
+                # Liberer job
+                job_verifier_parts.done.set()
 
     async def traiter_job_verifier_parts(self, job: JobVerifierParts):
+        # Structure staging/upload/{idmg}/{fuuid}
+        idmg, fuuid = job.path_upload.parent.name, job.path_upload.name
         try:
             path_upload = job.path_upload
             hachage = job.hachage
-            args = [path_upload, hachage]
-            # Utiliser thread pool pour validation
-            await asyncio.to_thread(valider_hachage_upload_parts, *args)
+            session = job.session
+            if session is not None and session.hachage_complet(hachage):
+                # Toutes les parts ont ete hachees dans l'ordre pendant l'upload
+                session.verificateur.verify()  # Lance une exception si le hachage est incorrect
+            else:
+                # Relire toutes les parts (redemarrage, trou ou part remplacee)
+                args = [path_upload, hachage]
+                # Utiliser thread pool pour validation
+                resultat = await asyncio.to_thread(valider_hachage_upload_parts, *args)
+                self.__logger.info("traiter_job_verifier_parts Verification %s : %s" % (fuuid, resultat))
+                self.__metriques.verification_octets.inc(valeur=resultat.octets)
+                self.__metriques.verification_secondes.inc(valeur=resultat.duree)
+            self.__sessions.enregistrer_verifie(idmg, fuuid)
         except Exception as e:
             self.__logger.exception(
                 'traiter_job_verifier_parts Erreur verification hachage fichier %s assemble : %s' % (job.path_upload, e))
-            shutil.rmtree(job.path_upload, ignore_errors=True)
+            await self.__pool_ecriture.executer(supprimer_repertoire, job.path_upload)
+            self.__sessions.retirer_session(idmg, fuuid)
             # return web.HTTPFailedDependency()
             raise e
 
+        # Assembler les parts en un seul fichier (copie dans le noyau) avant le transfert vers intake
+        try:
+            resultat_assemblage = await self.__pool_ecriture.executer(assembler_parts, path_upload)
+            if resultat_assemblage is not None:
+                taille, methode = resultat_assemblage
+                self.__logger.debug("traiter_job_verifier_parts Parts de %s assemblees (%d octets, %s)" % (
+                    fuuid, taille, methode))
+                if session is not None:
+                    session.parts = {0: taille}
+        except Exception:
+            # Les parts sont intactes, l'intake les recoit separement
+            self.__logger.exception("traiter_job_verifier_parts Erreur assemblage des parts de %s" % fuuid)
+
         # Transferer vers intake
         try:
             await self.__intake.ajouter_upload(path_upload)
         except Exception as e:
             self.__logger.exception(
                 'handle_post Erreur ajout fichier %s assemble au intake : %s' % (path_upload, e))
+            if job.session is not None:
+                job.session.etat = ETAT_UPLOAD  # Permettre un nouveau POST
             raise e
 
+        self.__metriques.intake_remise.observe(time.monotonic() - job.debut)
+        self.__sessions.ajouter_intake(idmg, fuuid)
+        if self.__references.ajouter(fuuid, idmg):
+            await self.__pool_ecriture.executer(self.__references.sauvegarder, '+', fuuid, idmg)
+
+    async def dedupliquer(self, idmg: str, fuuid: str) -> bool:
+        """
+        Verifie si ce idmg detient deja le contenu du fuuid (recu et verifie).
+        Limite au meme idmg : connaitre un fuuid ne prouve pas la possession du contenu, une reference n'est
+        jamais ajoutee pour le fuuid d'un autre idmg sans recevoir (et verifier) le fichier.
+        :return: True si le contenu n'a pas a etre recu de nouveau.
+        """
+        idmgs = self.__references.get_idmgs(fuuid)
+        if idmgs is None or idmg not in idmgs:
+            return False
+        if self.__sessions.get_session(idmg, fuuid) is not None:
+            return False  # Upload recommence par ce idmg, le completer normalement
+        return True
+
+    async def thread_recuperation_uploads(self):
+        """
+        Demarrage : remet en verification les uploads termines par POST (transaction.json et etat.json presents)
+        qui n'ont pas ete remis a l'intake avant l'arret (job perdu avec la queue en memoire).
+        """
+        try:
+            await self.recuperer_uploads()
+        except Exception:
+            self.__logger.exception("thread_recuperation_uploads Erreur recuperation des uploads")
+
+    async def recuperer_uploads(self):
+        debut = time.monotonic()
+        path_staging_upload = pathlib.Path(
+            self.__etat.configuration.dir_staging, ConstantesHebergement.DIR_STAGING_UPLOAD)
+        try:
+            repertoires_idmg = await self.__pool_ecriture.executer(lister_repertoires, path_staging_upload)
+        except FileNotFoundError:
+            return
+
+        # Scan en parallele (un idmg par thread du pool)
+        resultats = await asyncio.gather(
+            *[self.__pool_ecriture.executer(scanner_uploads_postes, p) for p in repertoires_idmg],
+            return_exceptions=True)
+        uploads = list()
+        for resultat in resultats:
+            if isinstance(resultat, Exception):
+                self.__logger.warning("recuperer_uploads Erreur scan staging : %s" % resultat)
+            else:
+                uploads.extend(resultat)
+
+        semaphore = asyncio.BoundedSemaphore(get_nombre_workers_verification())  # Jobs en attente a la fois
+        rapport = {'trouves': len(uploads), 'recuperes': 0, 'erreurs': 0}
+
+        async def recuperer(upload: UploadPoste):
+            idmg, fuuid = upload.path_upload.parent.name, upload.path_upload.name
+            async with semaphore:
+                cle = (idmg, fuuid)
+                if self.__sessions.est_intake(fuuid) or cle in self.__verifications_en_cours:
+                    return  # Deja remis a l'intake ou POST recu de nouveau depuis le demarrage
+                self.__verifications_en_cours.add(cle)
+                session = self.__sessions.get_session(idmg, fuuid)
+                if session is not None:
+                    session.etat = ETAT_VERIFICATION
+                job = JobVerifierParts(upload.transaction, upload.path_upload, upload.hachage, None, session)
+                job.taille = upload.taille
+                try:
+                    await self.ajouter_job_verifier_parts(job)
+                except BaseException:
+                    self.__verifications_en_cours.discard(cle)
+                    raise
+                await job.done.wait()
+                if job.exception is None:
+                    rapport['recuperes'] += 1
+                else:
+                    rapport['erreurs'] += 1
+
+        await asyncio.gather(*[recuperer(u) for u in uploads])
+        rapport['duree'] = time.monotonic() - debut
+        self.__logger.info("recuperer_uploads Uploads recuperes : %s" % rapport)
+
+    async def thread_entretien(self):
+        while self.__stop_event.is_set() is False:
+            self.__cache_jwt.purger()
+            self.__sessions.purger(EXPIRATION_SESSION_UPLOAD)
+            self.__logger.info("thread_entretien Cache JWT : %s" % self.__cache_jwt.get_stats())
+            self.__logger.info("thread_entretien Ordonnanceur : %s" % self._ordonnanceur.get_stats())
+            self.__logger.info("thread_entretien Workers verification : %s" % [
+                w.get_stats() for w in self.__workers_verification])
+            self.__logger.info("thread_entretien Journal sessions : %s" % self.__journal_sessions.get_stats())
+            try:
+                await asyncio.wait_for(self.__stop_event.wait(), timeout=300)
+            except asyncio.TimeoutError:
+                pass  # OK
+
+    def collecter_metriques(self):
+        for pool in [self._ordonnanceur.transfert, self._ordonnanceur.metadata]:
+            self.__metriques.collecter_pool(pool.nom, pool.get_stats())
+        if self.__queue_verifier_parts is not None:
+            self.__metriques.verification_queue.set(valeur=self.__queue_verifier_parts.qsize())
+
+    def declencher_nettoyage_staging(self):
+        """ Demande un nettoyage du staging (cedule). Sans effet si un nettoyage est deja demande. """
+        self.__event_nettoyage_staging.set()
+
+    async def thread_nettoyage_staging(self):
+        while self.__stop_event.is_set() is False:
+            wait_stop = asyncio.create_task(self.__stop_event.wait())
+            wait_nettoyage = asyncio.create_task(self.__event_nettoyage_staging.wait())
+            await asyncio.wait([wait_stop, wait_nettoyage], return_when=asyncio.FIRST_COMPLETED)
+            wait_stop.cancel()
+            wait_nettoyage.cancel()
+            if self.__stop_event.is_set():
+                return
+
+            self.__event_nettoyage_staging.clear()
+            try:
+                await self.__nettoyage_staging.executer()
+            except Exception:
+                self.__logger.exception("thread_nettoyage_staging Erreur nettoyage")
+
     async def run(self):
         self.__logger.info("WebConsignation.run Debug")
 
+        # Tache ponctuelle, hors de l'ensemble attendu : sa fin ne doit pas arreter les autres threads
+        recuperation = asyncio.create_task(self.thread_recuperation_uploads())
+
         pending = [
             asyncio.create_task(self.__stop_event.wait()),
             asyncio.create_task(self.thread_verifier_parts()),
+            asyncio.create_task(self.thread_entretien()),
+            asyncio.create_task(self.thread_nettoyage_staging()),
             asyncio.create_task(self.__intake.run(self.__stop_event)),
+            asyncio.create_task(self.__journal_sessions.run(self.__stop_event, self.__pool_ecriture.executer)),
         ]
 
         await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
 
+        if recuperation.done() is False:
+            recuperation.cancel()
+            try:
+                await recuperation
+            except asyncio.CancelledError:
+                pass  # OK
+
         self.__logger.info("WebConsignation.run Fin")
 
     # async def handle_get_consignation(self, request: Request):
@@ -421,35 +1194,86 @@ class Forbidden(Exception):
     pass
 
 
-async def parse_jwt(etat, jwt):
-    jwt_headers = get_headers(jwt)
-    kid = jwt_headers['kid']
-    enveloppe = await etat.charger_certificat(kid)
-    jwt_contenu = verify(enveloppe, jwt)
+async def parse_jwt(etat, jwt, cache: Optional[CacheJwt] = None, compteur: Optional[Compteur] = None):
+    """
+    :param etat: Objet avec charger_certificat(kid), EtatWeb ou CacheCertificats.
+    """
+    if cache is not None:
+        jwt_contenu = cache.get(jwt)
+        if jwt_contenu is not None:
+            if compteur is not None:
+                compteur.inc('cache')
+            return jwt_contenu  # Token deja verifie, pas encore expire
+
+    try:
+        jwt_headers = get_headers(jwt)
+        kid = jwt_headers['kid']
+        enveloppe = await etat.charger_certificat(kid)
+        jwt_contenu = verify(enveloppe, jwt)
+    except Exception:
+        if compteur is not None:
+            compteur.inc('erreur')
+        raise
+
+    if compteur is not None:
+        compteur.inc('verifie')
+
+    if cache is not None:
+        cache.put(jwt, kid, jwt_contenu)
+
     return jwt_contenu
 
 
-def valider_hachage_upload_parts(path_upload: pathlib.Path, hachage: str):
-    positions = list()
-    for item in path_upload.iterdir():
-        if item.is_file():
-            nom_fichier = str(item)
-            if nom_fichier.endswith('.part'):
-                position = int(item.name.split('.')[0])
-                positions.append(position)
-    positions = sorted(positions)
+def ecrire_transaction_upload(path_upload: pathlib.Path, transaction: dict, etat: dict):
+    with open(pathlib.Path(path_upload, ConstantesHebergement.FICHIER_TRANSACTION), 'wt') as fichier:
+        json.dump(transaction, fichier)
+    with open(pathlib.Path(path_upload, ConstantesHebergement.FICHIER_ETAT), 'wt') as fichier:
+        json.dump(etat, fichier)
 
-    verificateur = VerificateurHachage(hachage)
 
-    for position in positions:
-        path_fichier = pathlib.Path(path_upload, '%d.part' % position)
+class UploadPoste:
+    """ Upload termine par POST trouve dans le staging au demarrage. """
 
-        with open(path_fichier, 'rb') as fichier:
-            while True:
-                chunk = fichier.read(64*1024)
-                if not chunk:
-                    break
-                verificateur.update(chunk)
+    def __init__(self, path_upload: pathlib.Path, transaction: dict, hachage: str, taille: int):
+        self.path_upload = path_upload
+        self.transaction = transaction
+        self.hachage = hachage
+        self.taille = taille
 
-    verificateur.verify()  # Lance une exception si le hachage est incorrect
+
+def scanner_uploads_postes(path_idmg: pathlib.Path) -> list[UploadPoste]:
+    """ Uploads d'un idmg avec transaction.json et etat.json. Bloquant, utiliser un thread. """
+    uploads = list()
+    for path_upload in path_idmg.iterdir():
+        path_transaction = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_TRANSACTION)
+        path_etat = pathlib.Path(path_upload, ConstantesHebergement.FICHIER_ETAT)
+        try:
+            with open(path_transaction, 'rt') as fichier:
+                transaction = json.load(fichier)
+            with open(path_etat, 'rt') as fichier:
+                hachage = json.load(fichier)['hachage']
+            taille = calculer_taille_upload(path_upload)
+        except (FileNotFoundError, NotADirectoryError):
+            continue  # Upload pas encore termine par POST
+        except (KeyError, ValueError, TypeError):
+            continue  # Fichier incomplet (arret pendant l'ecriture), le client doit refaire le POST
+        uploads.append(UploadPoste(path_upload, transaction, hachage, taille))
+    return uploads
+
+
+def get_nombre_workers_verification() -> int:
+    try:
+        return int(os.environ[ConstantesHebergement.ENV_VERIFIER_WORKERS])
+    except (KeyError, ValueError):
+        return min(4, os.cpu_count() or 1)
+
+
+def calculer_taille_upload(path_upload: pathlib.Path) -> int:
+    parts, _couvertes = lister_parts(path_upload)
+    return sum(stat_part.st_size for _position, _path, stat_part in parts)
+
+
+def valider_hachage_upload_parts(path_upload: pathlib.Path, hachage: str) -> ResultatHachage:
+    """ :raises ErreurHachage: Hachage du fichier assemble incorrect. """
+    return MOTEUR_HACHAGE.verifier_upload_parts(path_upload, hachage)
 
@@ -1,113 +1,237 @@
 import aioredis
 import asyncio
+import json
 import logging
+import os
+import time
 
 from aiohttp import web
+from typing import Optional
 from aiohttp.web_request import Request
 from asyncio import Event, BoundedSemaphore
 
 from millegrilles_messages.messages import Constantes
-from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
-from millegrilles_messages.messages.ValidateurCertificats import valider_certificat_tiers
 from millegrilles_messages.messages.ValidateurMessage import verifier_signature
 
 from millegrilles_web.EtatWeb import EtatWeb
-from millegrilles_web.JwtUtils import get_headers, verify
 from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.Cache import CacheExpiration, CacheJwt
+from server_hebergement.Certificats import CacheCertificats, CacheChaines
+from server_hebergement.Metriques import MetriquesHebergement
+from server_hebergement.WebConsignation import parse_jwt
+
+PATH_FICHIERS = '%s/fichiers' % ConstantesHebergement.WEBAPP_PATH
+PATH_FICHIERS_JOBS = '%s/job' % PATH_FICHIERS  # POST de statut en lot, sans effet de bord (readwrite non requis)
+PREFIXE_REDIS_JWT = 'hebergement:jwt'
+TTL_JWT_REDIS = 600  # Secondes. La reponse est chiffree pour le client, l'expiration du JWT n'est pas lisible.
 
 
 class JwtHandler:
 
-    def __init__(self, etat: EtatWeb, redis_session: aioredis.Redis):
+    def __init__(self, etat: EtatWeb, redis_session: aioredis.Redis, cache_jwt: Optional[CacheJwt] = None,
+                 metriques: Optional[MetriquesHebergement] = None,
+                 cache_certificats: Optional[CacheCertificats] = None):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         self.__etat = etat
         self._redis_session = redis_session
         self._semaphore_threads = BoundedSemaphore(value=20)
+        self.__metriques = metriques or MetriquesHebergement()
+        self.__metriques.slots_capacite.set('jwt', valeur=20)
+        self.__cache_jwt = cache_jwt or CacheJwt()
+        self.__cache_certificats = cache_certificats or etat  # Interface charger_certificat(kid)
+        self.__ttl_jwt_redis = get_ttl_jwt_redis()
+        self.__cache_chaines = CacheChaines()
+        # Decisions allow/deny par (token, methode, classe de path), expirent avec le token
+        self.__cache_decisions = CacheExpiration(taille_max=20000)
+
+    def retirer_certificat(self, fingerprint: str):
+        """ Callback de retrait de CacheCertificats : invalide les JWT (partages avec la consignation). """
+        nombre = self.__cache_jwt.retirer_certificat(fingerprint)
+        self.__cache_decisions.clear()  # Les cles de decision ne contiennent pas le kid
+        self.__logger.info("retirer_certificat %s, %d JWT retires du cache" % (fingerprint, nombre))
+
+    def get_stats(self) -> dict:
+        return {'decisions': self.__cache_decisions.get_stats(), 'jwt': self.__cache_jwt.get_stats(),
+                'chaines': self.__cache_chaines.get_stats()}
 
     async def handle_auth(self, request: Request):
-        async with self._semaphore_threads:
-            path_request = request.headers['X-Original-URI']
-            methode = request.headers['X-Original-Method']
-            self.__logger.debug("headers : %s" % [h for h in request.headers.items()])
+        # Traitement CPU seulement (caches en memoire), pas de semaphore sur ce path
+        path_request = request.headers['X-Original-URI']
+        methode = request.headers['X-Original-Method']
+        self.__logger.debug("headers : %s" % [h for h in request.headers.items()])
+
+        try:
+            jwt = request.headers[ConstantesHebergement.HEADER_JWT]
+        except KeyError:
+            self.__logger.info("handle_auth JWT manquant")
+            return web.HTTPForbidden()
 
+        cle_decision = (CacheJwt.digest(jwt), methode, classe_path(path_request))
+        decision = self.__cache_decisions.get(cle_decision)
+        if decision is None:
+            jwt_contenu = await parse_jwt(
+                self.__cache_certificats, jwt, self.__cache_jwt, self.__metriques.jwt_verifications)
+            decision = self.verifier_autorisation(jwt_contenu, methode, path_request)
             try:
-                jwt = request.headers[ConstantesHebergement.HEADER_JWT]
-            except KeyError:
-                self.__logger.info("handle_auth JWT manquant")
-                return web.HTTPForbidden()
+                expiration = float(jwt_contenu['exp'])
+            except (KeyError, TypeError, ValueError):
+                expiration = None  # Sans expiration valide, la decision n'est pas conservee
+            if expiration is not None:
+                self.__cache_decisions.put(cle_decision, decision, expiration)
 
-            jwt_headers = get_headers(jwt)
-            kid = jwt_headers['kid']
-            enveloppe = await self.__etat.charger_certificat(kid)
-            jwt_contenu = verify(enveloppe, jwt)
+        if decision is True:
+            return web.HTTPOk()
 
-            if jwt_contenu['iss'] != 'Hebergement':
-                self.__logger.error("handle_auth Domaine (iss) doit etre hebergement")
-                return web.HTTPForbidden()
+        return web.HTTPForbidden()
 
-            readwrite = jwt_contenu.get('readwrite') is True
-            if methode in ['PUT']:
-                if readwrite is False:
-                    self.__logger.error("handle_auth Methode %s requiere readwrite = True dans JWT" % methode)
-                    return web.HTTPForbidden()
+    def verifier_autorisation(self, jwt_contenu: dict, methode: str, path_request: str) -> bool:
+        if jwt_contenu['iss'] != 'Hebergement':
+            self.__logger.error("handle_auth Domaine (iss) doit etre hebergement")
+            return False
 
-            # Verifier autorisation par path
-            if path_request.startswith('/hebergement/fichiers'):
-                if methode in ['POST'] and readwrite is False:
-                    self.__logger.error("handle_auth Methode %s sur fichiers requiere readwrite = True dans JWT" % methode)
-                    return web.HTTPForbidden()
+        readwrite = jwt_contenu.get('readwrite') is True
+        if methode in ['PUT']:
+            if readwrite is False:
+                self.__logger.error("handle_auth Methode %s requiere readwrite = True dans JWT" % methode)
+                return False
 
-                if 'fichiers' in jwt_contenu['roles']:
-                    return web.HTTPOk()
-                else:
-                    self.__logger.error("handle_auth Path /hebergement/fichiers requiert role fichiers dans JWT")
+        # Verifier autorisation par path
+        if path_request.startswith(PATH_FICHIERS):
+            if methode in ['POST'] and readwrite is False and path_request != PATH_FICHIERS_JOBS:
+                self.__logger.error("handle_auth Methode %s sur fichiers requiere readwrite = True dans JWT" % methode)
+                return False
 
-            return web.HTTPForbidden()
+            if 'fichiers' in jwt_contenu['roles']:
+                return True
+            else:
+                self.__logger.error("handle_auth Path /hebergement/fichiers requiert role fichiers dans JWT")
 
-    async def handle_get_jwt(self, request: Request):
-        async with self._semaphore_threads:
+        return False
 
-            # Verifier le certificat de la millegrille tierce. S'assurer que le message est bien forme et
-            # que le certificat est valide.
-            try:
-                requete = await request.json()
-                certificat_pem = requete['certificat']
-                certificat_millegrille = requete['millegrille']
-
-                # Valider le certificat
-                enveloppe_millegrille = EnveloppeCertificat.from_pem(certificat_millegrille)
-                enveloppe_certificat = valider_certificat_tiers(enveloppe_millegrille, certificat_pem)
-                idmg = enveloppe_millegrille.idmg
-                if Constantes.SECURITE_SECURE not in enveloppe_certificat.get_exchanges:
-                    self.__logger.error("handle_get_jwt Acces refuse : certificat tiers pour JWT doit etre 4.secure")
-                    return web.HTTPForbidden()
-            except:
-                self.__logger.exception("handle_get_jwt Erreur chargement request")
-                return web.HTTPBadRequest()
-
-            # Verifier le message. Le certificat a deja ete verifie.
-            try:
-                await self.__etat.validateur_message.verifier(requete, verifier_certificat=False)
-            except:
-                self.__logger.exception("handle_get_jwt Erreur verification signature")
-                return web.HTTPBadRequest()
-
-            # Transmettre requete au domaine hebergement
-            try:
-                producer = await asyncio.wait_for(self.__etat.producer_wait(), 3)
-            except asyncio.TimeoutError:
-                self.__logger.error("handle_get_jwt Timeout producer_wait")
-                return web.HTTPServerError()
-
-            requete_hebergement = {
-                'requete': requete,
-                'idmg': idmg,
-            }
-            try:
-                reponse = await producer.executer_requete(
-                    requete_hebergement, ConstantesHebergement.NOM_DOMAINE, 'getTokenJwt', exchange=Constantes.SECURITE_PUBLIC)
-                reponse = reponse.original
-                return web.json_response(reponse)
-            except asyncio.TimeoutError:
-                self.__logger.error("handle_get_jwt Timeout executer_requete")
-                return web.HTTPServerError()
+    async def handle_get_jwt(self, request: Request):
+        metriques = self.__metriques
+        debut = time.monotonic()
+        metriques.slots_en_attente.inc('jwt')
+        try:
+            await self._semaphore_threads.acquire()
+        finally:
+            metriques.slots_en_attente.dec('jwt')
+        metriques.slots_acquisitions.inc('jwt')
+        metriques.slots_attente.inc('jwt', valeur=time.monotonic() - debut)
+        metriques.slots_actifs.inc('jwt')
+        try:
+            return await self.__traiter_get_jwt(request)
+        finally:
+            metriques.slots_actifs.dec('jwt')
+            self._semaphore_threads.release()
+
+    async def __traiter_get_jwt(self, request: Request):
+        # Verifier le certificat de la millegrille tierce. S'assurer que le message est bien forme et
+        # que le certificat est valide.
+        try:
+            requete = await request.json()
+            certificat_pem = requete['certificat']
+            certificat_millegrille = requete['millegrille']
+
+            # Valider le certificat (parsing et validation de chaine conserves jusqu'au notAfter)
+            enveloppe_millegrille, enveloppe_certificat = self.__cache_chaines.valider(
+                certificat_millegrille, certificat_pem)
+            idmg = enveloppe_millegrille.idmg
+            cle_redis = get_cle_redis_jwt(idmg, enveloppe_certificat.fingerprint, get_roles_requete(requete))
+            if Constantes.SECURITE_SECURE not in enveloppe_certificat.get_exchanges:
+                self.__logger.error("handle_get_jwt Acces refuse : certificat tiers pour JWT doit etre 4.secure")
+                return web.HTTPForbidden()
+        except:
+            self.__logger.exception("handle_get_jwt Erreur chargement request")
+            return web.HTTPBadRequest()
+
+        # Verifier le message. Le certificat a deja ete verifie.
+        try:
+            await self.__etat.validateur_message.verifier(requete, verifier_certificat=False)
+        except:
+            self.__logger.exception("handle_get_jwt Erreur verification signature")
+            return web.HTTPBadRequest()
+
+        # Reponse deja emise pour ce certificat et ces roles (chiffree pour le certificat du client)
+        reponse_cache = await self.__get_reponse_redis(cle_redis)
+        if reponse_cache is not None:
+            return web.Response(body=reponse_cache, content_type='application/json')
+
+        # Transmettre requete au domaine hebergement
+        try:
+            producer = await asyncio.wait_for(self.__etat.producer_wait(), 3)
+        except asyncio.TimeoutError:
+            self.__logger.error("handle_get_jwt Timeout producer_wait")
+            return web.HTTPServerError()
+
+        requete_hebergement = {
+            'requete': requete,
+            'idmg': idmg,
+        }
+        try:
+            reponse = await producer.executer_requete(
+                requete_hebergement, ConstantesHebergement.NOM_DOMAINE, 'getTokenJwt', exchange=Constantes.SECURITE_PUBLIC)
+            reponse_parsed = reponse.parsed or dict()
+            reponse = reponse.original
+            if reponse_parsed.get('ok') is not False:  # Ne pas conserver un refus
+                await self.__set_reponse_redis(cle_redis, reponse)
+            return web.json_response(reponse)
+        except asyncio.TimeoutError:
+            self.__logger.error("handle_get_jwt Timeout executer_requete")
+            return web.HTTPServerError()
+
+    async def __get_reponse_redis(self, cle: str) -> Optional[bytes]:
+        if self.__ttl_jwt_redis <= 0:
+            return None
+        try:
+            return await self._redis_session.get(cle)
+        except Exception as e:
+            self.__logger.warning("handle_get_jwt Erreur lecture redis : %s" % e)
+            return None
+
+    async def __set_reponse_redis(self, cle: str, reponse: dict):
+        if self.__ttl_jwt_redis <= 0:
+            return
+        ttl = self.__ttl_jwt_redis
+        try:
+            # Compter l'age de la reponse (estampille du message) dans la duree de conservation
+            ttl -= max(0, int(time.time()) - int(reponse['estampille']))
+        except (KeyError, TypeError, ValueError):
+            pass
+        if ttl <= 0:
+            return
+        try:
+            await self._redis_session.set(cle, json.dumps(reponse).encode('utf-8'), ex=ttl)
+        except Exception as e:
+            self.__logger.warning("handle_get_jwt Erreur sauvegarde redis : %s" % e)
+
+
+def get_roles_requete(requete: dict) -> list:
+    """ Roles demandes dans la requete getTokenJwt (contenu du message). """
+    try:
+        contenu = json.loads(requete['contenu'])
+    except (KeyError, TypeError, ValueError):
+        contenu = requete
+    roles = contenu.get('roles') or list()
+    return sorted(str(r) for r in roles)
+
+
+def get_cle_redis_jwt(idmg: str, fingerprint: str, roles: list) -> str:
+    return '%s:%s:%s:%s' % (PREFIXE_REDIS_JWT, idmg, fingerprint, ','.join(roles))
+
+
+def get_ttl_jwt_redis() -> int:
+    """ 0 desactive le cache redis des JWT emis. """
+    try:
+        return int(os.environ[ConstantesHebergement.ENV_JWT_CACHE_TTL])
+    except (KeyError, ValueError):
+        return TTL_JWT_REDIS
+
+
+def classe_path(path_request: str) -> str:
+    """ Classe de path utilisee par les regles d'autorisation de handle_auth. """
+    if path_request == PATH_FICHIERS_JOBS:
+        return 'jobs'
+    if path_request.startswith(PATH_FICHIERS):
+        return 'fichiers'
+    return 'autre'
@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import os
+import pathlib
 
 from aiohttp import web
 from typing import Optional
@@ -11,6 +13,9 @@ from millegrilles_web.WebServer import WebServer
 from millegrilles_web import Constantes as ConstantesWeb
 
 from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.Cache import CacheJwt
+from server_hebergement.Certificats import CacheCertificats
+from server_hebergement.Metriques import MetriquesHebergement, mesurer_handler
 from server_hebergement.SocketIoHebergementHandler import SocketIoHebergementHandler
 from server_hebergement.WebJwt import JwtHandler
 from server_hebergement.WebConsignation import ConsignationHandler
@@ -24,15 +29,23 @@ class WebServerHebergement(WebServer):
         self.__jwt_handler: Optional[JwtHandler] = None
         self.__redis_session: Optional[redis.Redis] = None
         self.__consignation: Optional[ConsignationHandler] = None
+        self.__cache_jwt = CacheJwt()
+        self.__cache_certificats: Optional[CacheCertificats] = None
+        self.__metriques = MetriquesHebergement(os.environ.get(ConstantesHebergement.ENV_METRICS_TOKEN))
 
     def get_nom_app(self) -> str:
         return ConstantesHebergement.APP_NAME
 
     async def setup(self, configuration: Optional[dict] = None, stop_event: Optional[asyncio.Event] = None):
         self.__redis_session = await self._connect_redis(ConstantesWeb.REDIS_DB_TOKENS)
-        self.__jwt_handler = JwtHandler(self.etat, self.__redis_session)
-        self.__consignation = ConsignationHandler(stop_event, self.etat)
+        self.__cache_certificats = CacheCertificats(self.etat, pathlib.Path(
+            self.etat.configuration.dir_staging, ConstantesHebergement.FICHIER_CERTIFICATS))
+        self.__jwt_handler = JwtHandler(self.etat, self.__redis_session, self.__cache_jwt, self.__metriques,
+                                        self.__cache_certificats)
+        self.__consignation = ConsignationHandler(stop_event, self.etat, self.__cache_jwt, self.__metriques,
+                                                  cache_certificats=self.__cache_certificats)
         await self.__consignation.setup()
+        self.__cache_certificats.ajouter_callback_retrait(self.__jwt_handler.retirer_certificat)
 
         await super().setup(configuration, stop_event)
 
@@ -46,16 +59,23 @@ class WebServerHebergement(WebServer):
         self.__logger.info("Preparer routes %s sous /%s" % (self.__class__.__name__, self.get_nom_app()))
         await super()._preparer_routes()
         self._app.add_routes([
-            web.get(f'{self.app_path}/auth', self.__jwt_handler.handle_auth),
+            web.get(f'{self.app_path}/auth', mesurer_handler(
+                self.__metriques.duree_requetes, 'auth', self.__jwt_handler.handle_auth)),
             web.get(f'{self.app_path}/jwt', self.__jwt_handler.handle_get_jwt),
+            web.get(f'{self.app_path}/metrics', self.__metriques.handle_metrics),
         ])
         self._app.add_routes(self.__consignation.get_routes(self.app_path))
 
+    @property
+    def consignation(self) -> Optional[ConsignationHandler]:
+        return self.__consignation
+
     async def run(self):
         self.__logger.info("WebServeurHebergement.run Debut")
         tasks = [
             super().run(),
-            self.__consignation.run()
+            self.__consignation.run(),
+            self.__cache_certificats.run(self._stop_event),
         ]
         await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
         self.__logger.info("WebServeurHebergement.run Fin")
@@ -31,6 +31,10 @@ class MessagesAppMain(WebAppMain):
         self._web_server = WebServerHebergement(self.etat, self._commandes_handler)
         await self._web_server.setup(stop_event=self._stop_event)
 
+    @property
+    def web_server(self) -> WebServerHebergement:
+        return self._web_server
+
     def exit_gracefully(self, signum=None, frame=None):
         self.__logger.info("Fermer application, signal: %d" % signum)
         self._stop_event.set()
@@ -29,5 +29,8 @@ setup(
     author='Mathieu Dugre',
     author_email='mathieu.dugre@mdugre.info',
     description="Serveur pour hebergement inter-millegrilles",
-    install_requires=[]
+    install_requires=[],
+    extras_require={
+        'bench': ['PyJWT[crypto]'],  # test/BenchConsignation.py : signature EdDSA des JWT
+    }
 )
@@ -0,0 +1,331 @@
+"""
+Micro-benchmarks hors ligne des chemins critiques de la consignation.
+
+Aucun serveur, MQ ou fichier PKI requis : etat et certificat sont des substituts generes au demarrage.
+Dependance supplementaire (signature des JWT) : pip install -e .[bench]
+
+Les resultats sont ecrits en JSON pour comparer deux versions :
+
+    python test/BenchConsignation.py --sortie avant.json
+    python test/BenchConsignation.py --sortie apres.json --comparer avant.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import pathlib
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import jwt as pyjwt
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.x509.oid import NameOID
+
+from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
+from millegrilles_messages.messages.Hachage import Hacheur
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.Cache import CacheJwt
+from server_hebergement.SessionsUpload import SessionsUpload
+from server_hebergement.WebConsignation import ConsignationHandler, parse_jwt, valider_hachage_upload_parts, \
+    calculer_taille_upload
+
+IDMG = 'zBenchIdmgConsignation'
+KIB = 1024
+MIB = 1024 * 1024
+
+
+class ConfigurationBench:
+
+    def __init__(self, dir_staging: str):
+        self.dir_staging = dir_staging
+
+
+class EtatBench:
+    """ Substitut de EtatWeb : configuration et chargement du certificat des JWT. """
+
+    def __init__(self, dir_staging: str, enveloppe: EnveloppeCertificat):
+        self.configuration = ConfigurationBench(dir_staging)
+        self.__enveloppe = enveloppe
+
+    async def charger_certificat(self, fingerprint: str) -> EnveloppeCertificat:
+        return self.__enveloppe
+
+    async def producer_wait(self):
+        raise asyncio.TimeoutError('Pas de MQ pour le benchmark')
+
+
+class IntakeBench:
+    """ Substitut de IntakeFichiers : accepte les uploads sans traitement. """
+
+    async def configurer(self):
+        pass
+
+    async def ajouter_upload(self, path_upload: pathlib.Path):
+        pass
+
+    async def run(self, stop_event: asyncio.Event):
+        await stop_event.wait()
+
+
+class Resultats:
+
+    def __init__(self):
+        self.resultats = list()
+
+    def ajouter(self, nom: str, parametres: dict, iterations: int, duree: float, octets: int = 0):
+        resultat = {
+            'nom': nom,
+            'parametres': parametres,
+            'iterations': iterations,
+            'duree': duree,
+            'ops_s': iterations / duree if duree > 0 else None,
+        }
+        if octets:
+            resultat['octets'] = octets
+            resultat['mo_s'] = octets / MIB / duree if duree > 0 else None
+        self.resultats.append(resultat)
+        print('%-28s %-40s %10.1f ops/s %s' % (
+            nom, json.dumps(parametres, sort_keys=True), resultat['ops_s'] or 0,
+            '%8.1f Mo/s' % resultat['mo_s'] if octets else ''))
+
+
+def generer_certificat() -> tuple[Ed25519PrivateKey, EnveloppeCertificat]:
+    cle = Ed25519PrivateKey.generate()
+    nom = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'bench'),
+                     x509.NameAttribute(NameOID.ORGANIZATION_NAME, IDMG)])
+    maintenant = datetime.datetime.now(tz=datetime.timezone.utc)
+    certificat = x509.CertificateBuilder() \
+        .subject_name(nom).issuer_name(nom) \
+        .public_key(cle.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(maintenant - datetime.timedelta(minutes=5)) \
+        .not_valid_after(maintenant + datetime.timedelta(days=1)) \
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True) \
+        .sign(cle, None)
+    pem = certificat.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+    return cle, EnveloppeCertificat.from_pem(pem)
+
+
+def generer_jwt(cle: Ed25519PrivateKey, enveloppe: EnveloppeCertificat, sujet=IDMG) -> str:
+    contenu = {
+        'iss': ConstantesHebergement.NOM_DOMAINE,
+        'sub': sujet,
+        'exp': int(time.time()) + 3600,
+        'roles': ['fichiers'],
+        'readwrite': True,
+    }
+    return pyjwt.encode(contenu, cle, algorithm='EdDSA', headers={'kid': enveloppe.fingerprint})
+
+
+def generer_upload(path_upload: pathlib.Path, nombre_parts: int, taille_part: int) -> str:
+    """ Ecrit les parts {position}.part et retourne le fuuid (hachage du fichier complet). """
+    path_upload.mkdir(parents=True, exist_ok=True)
+    hacheur = Hacheur('blake2b-512', 'base58btc')
+    bloc = os.urandom(min(taille_part, MIB))
+    position = 0
+    for _ in range(0, nombre_parts):
+        with open(pathlib.Path(path_upload, '%d.part' % position), 'wb') as fichier:
+            restant = taille_part
+            while restant > 0:
+                donnees = bloc[:restant]
+                fichier.write(donnees)
+                hacheur.update(donnees)
+                restant -= len(donnees)
+        position += taille_part
+    return hacheur.finalize()
+
+
+def bench_valider_hachage(resultats: Resultats, path_tmp: pathlib.Path, rapide: bool):
+    configurations = [(1, MIB), (16, MIB), (128, 64 * KIB), (4, 16 * MIB)]
+    if rapide is False:
+        configurations.extend([(1, 128 * MIB), (64, 4 * MIB), (1024, 64 * KIB)])
+
+    for nombre_parts, taille_part in configurations:
+        path_upload = pathlib.Path(path_tmp, 'hachage', '%d_%d' % (nombre_parts, taille_part))
+        fuuid = generer_upload(path_upload, nombre_parts, taille_part)
+        valider_hachage_upload_parts(path_upload, fuuid)  # Rechauffer le cache de pages
+        iterations = 3
+        debut = time.perf_counter()
+        for _ in range(0, iterations):
+            valider_hachage_upload_parts(path_upload, fuuid)
+        duree = time.perf_counter() - debut
+        resultats.ajouter('valider_hachage_upload_parts', {'parts': nombre_parts, 'taille_part': taille_part},
+                          iterations, duree, nombre_parts * taille_part * iterations)
+
+
+def bench_scan_parts(resultats: Resultats, path_tmp: pathlib.Path, rapide: bool):
+    nombre_uploads = 200 if rapide else 2000
+    path_staging_upload = pathlib.Path(path_tmp, 'scan', ConstantesHebergement.DIR_STAGING_UPLOAD)
+    path_staging_intake = pathlib.Path(path_tmp, 'scan', ConstantesHebergement.DIR_STAGING_INTAKE)
+    path_staging_intake.mkdir(parents=True, exist_ok=True)
+    for i in range(0, nombre_uploads):
+        path_upload = pathlib.Path(path_staging_upload, IDMG, 'fuuid%06d' % i)
+        path_upload.mkdir(parents=True)
+        for position in range(0, 8):
+            pathlib.Path(path_upload, '%d.part' % (position * 1024)).write_bytes(b'\0' * 1024)
+
+    # Scan de toutes les parts d'un upload (calcul de taille au POST, ancien GET job)
+    path_upload = pathlib.Path(path_staging_upload, IDMG, 'fuuid%06d' % 0)
+    iterations = 2000
+    debut = time.perf_counter()
+    for _ in range(0, iterations):
+        calculer_taille_upload(path_upload)
+    resultats.ajouter('calculer_taille_upload', {'parts': 8}, iterations, time.perf_counter() - debut)
+
+    # Reconstruction de l'index au demarrage
+    debut = time.perf_counter()
+    SessionsUpload().charger(path_staging_upload, path_staging_intake)
+    resultats.ajouter('sessions_charger', {'uploads': nombre_uploads, 'parts': 8}, 1, time.perf_counter() - debut)
+
+
+async def bench_parse_jwt(resultats: Resultats, etat: EtatBench, token: str, rapide: bool):
+    iterations = 500 if rapide else 5000
+
+    debut = time.perf_counter()
+    for _ in range(0, iterations):
+        await parse_jwt(etat, token)
+    resultats.ajouter('parse_jwt', {'cache': False}, iterations, time.perf_counter() - debut)
+
+    cache = CacheJwt()
+    await parse_jwt(etat, token, cache)
+    debut = time.perf_counter()
+    for _ in range(0, iterations * 10):
+        await parse_jwt(etat, token, cache)
+    resultats.ajouter('parse_jwt', {'cache': True}, iterations * 10, time.perf_counter() - debut)
+
+
+async def bench_handlers(resultats: Resultats, path_tmp: pathlib.Path, etat: EtatBench, token: str, rapide: bool):
+    dir_staging = pathlib.Path(path_tmp, 'handlers')
+    dir_staging.mkdir()
+    etat.configuration.dir_staging = str(dir_staging)
+
+    stop_event = asyncio.Event()
+    handler = ConsignationHandler(stop_event, etat, intake=IntakeBench())
+    await handler.setup()
+    task_run = asyncio.create_task(handler.run())
+
+    app = web.Application(client_max_size=64 * MIB)
+    app.add_routes(handler.get_routes(ConstantesHebergement.WEBAPP_PATH))
+    headers = {ConstantesHebergement.HEADER_JWT: token}
+
+    async with TestClient(TestServer(app)) as client:
+        # Boucle d'ecriture de handle_put_fuuid
+        configurations = [(64 * KIB, 64), (MIB, 32), (8 * MIB, 8)]
+        if rapide is False:
+            configurations.append((32 * MIB, 8))
+        for taille_part, nombre_parts in configurations:
+            donnees = os.urandom(taille_part)
+            fuuid = 'fuuidput%d' % taille_part
+            debut = time.perf_counter()
+            for i in range(0, nombre_parts):
+                url = '%s/fichiers/%s/%d' % (ConstantesHebergement.WEBAPP_PATH, fuuid, i * taille_part)
+                async with client.put(url, data=donnees, headers=headers) as reponse:
+                    if reponse.status != 200:
+                        raise Exception('PUT status %d' % reponse.status)
+            resultats.ajouter('handle_put_fuuid', {'taille_part': taille_part}, nombre_parts,
+                              time.perf_counter() - debut, taille_part * nombre_parts)
+
+            # Meme volume en un seul PUT streame (handle_put_backup), comparaison de debit avec les parts
+            async def generer_body():
+                for _ in range(0, nombre_parts):
+                    yield donnees
+            url = '%s/fichiers/backup/upload/bench/domaine/fichier%d' % (ConstantesHebergement.WEBAPP_PATH, taille_part)
+            headers_backup = dict(headers)
+            headers_backup['Content-Length'] = str(taille_part * nombre_parts)
+            debut = time.perf_counter()
+            async with client.put(url, data=generer_body(), headers=headers_backup) as reponse:
+                if reponse.status != 200:
+                    raise Exception('PUT backup status %d' % reponse.status)
+            resultats.ajouter('handle_put_backup', {'taille_part': taille_part}, 1,
+                              time.perf_counter() - debut, taille_part * nombre_parts)
+
+        # Statut de job (index en memoire)
+        url = '%s/fichiers/job/%s' % (ConstantesHebergement.WEBAPP_PATH, 'fuuidput%d' % MIB)
+        iterations = 200 if rapide else 2000
+        debut = time.perf_counter()
+        for _ in range(0, iterations):
+            async with client.get(url, headers=headers) as reponse:
+                await reponse.read()
+        resultats.ajouter('handle_get_job_fuuid', {'parts': 32}, iterations, time.perf_counter() - debut)
+
+    stop_event.set()
+    await task_run
+
+
+def get_version() -> str:
+    try:
+        resultat = subprocess.run(['git', 'describe', '--always', '--dirty'], stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, cwd=pathlib.Path(__file__).parent)
+        return resultat.stdout.decode('utf-8').strip()
+    except FileNotFoundError:
+        return 'inconnue'
+
+
+def comparer(resultats: list, path_reference: str):
+    with open(path_reference, 'rt') as fichier:
+        reference = json.load(fichier)
+    valeurs_reference = dict()
+    for r in reference['resultats']:
+        valeurs_reference[(r['nom'], json.dumps(r['parametres'], sort_keys=True))] = r
+
+    print('\nComparaison avec %s (%s)' % (path_reference, reference.get('version')))
+    for r in resultats:
+        cle = (r['nom'], json.dumps(r['parametres'], sort_keys=True))
+        r_ref = valeurs_reference.get(cle)
+        if r_ref is None or not r_ref.get('ops_s') or not r.get('ops_s'):
+            continue
+        ratio = r['ops_s'] / r_ref['ops_s']
+        print('%-28s %-40s %+7.1f%%' % (cle[0], cle[1], (ratio - 1) * 100))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmarks consignation hebergement')
+    parser.add_argument('--sortie', help='Fichier JSON des resultats')
+    parser.add_argument('--comparer', help='Fichier JSON de reference')
+    parser.add_argument('--rapide', action='store_true', help='Tailles reduites')
+    args = parser.parse_args()
+
+    cle, enveloppe = generer_certificat()
+    token = generer_jwt(cle, enveloppe)
+    resultats = Resultats()
+
+    with tempfile.TemporaryDirectory(prefix='bench_hebergement_') as dir_tmp:
+        path_tmp = pathlib.Path(dir_tmp)
+        etat = EtatBench(dir_tmp, enveloppe)
+        bench_valider_hachage(resultats, path_tmp, args.rapide)
+        bench_scan_parts(resultats, path_tmp, args.rapide)
+        await bench_parse_jwt(resultats, etat, token, args.rapide)
+        await bench_handlers(resultats, path_tmp, etat, token, args.rapide)
+
+    rapport = {
+        'version': get_version(),
+        'date': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'plateforme': platform.platform(),
+        'cpus': os.cpu_count(),
+        'rapide': args.rapide,
+        'resultats': resultats.resultats,
+    }
+
+    if args.sortie:
+        with open(args.sortie, 'wt') as fichier:
+            json.dump(rapport, fichier, indent=2)
+
+    if args.comparer:
+        comparer(resultats.resultats, args.comparer)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+import os
+import pathlib
+import tempfile
+import unittest
+
+from unittest import mock
+
+from server_hebergement import EcritureFichiers
+from server_hebergement.EcritureFichiers import assembler_parts, lister_parts, copier_fichier
+
+
+class AssemblerPartsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.path_upload = pathlib.Path(self.repertoire.name)
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    def ecrire_parts(self, parts: list[bytes]) -> bytes:
+        position = 0
+        for contenu in parts:
+            pathlib.Path(self.path_upload, '%d.part' % position).write_bytes(contenu)
+            position += len(contenu)
+        return b''.join(parts)
+
+    def noms(self) -> list[str]:
+        return sorted(p.name for p in self.path_upload.iterdir())
+
+    def test_assembler(self):
+        contenu = self.ecrire_parts([os.urandom(1000), os.urandom(1), os.urandom(70000)])
+        taille, methode = assembler_parts(self.path_upload)
+        self.assertEqual(len(contenu), taille)
+        self.assertIn(methode, ['copy_file_range', 'sendfile', 'tampon'])
+        self.assertEqual(['0.part'], self.noms())
+        self.assertEqual(contenu, pathlib.Path(self.path_upload, '0.part').read_bytes())
+
+    def test_une_seule_part(self):
+        self.ecrire_parts([b'abc'])
+        self.assertIsNone(assembler_parts(self.path_upload))
+        self.assertEqual(['0.part'], self.noms())
+
+    def test_upload_incomplet(self):
+        pathlib.Path(self.path_upload, '0.part').write_bytes(b'abc')
+        pathlib.Path(self.path_upload, '10.part').write_bytes(b'def')
+        with self.assertRaises(ValueError):
+            assembler_parts(self.path_upload)
+        self.assertEqual(['0.part', '10.part'], self.noms())  # Parts intactes, fichier de travail retire
+
+    def test_reprise_apres_interruption(self):
+        # Arret apres le rename vers 0.part, avant le retrait des autres parts
+        contenu = self.ecrire_parts([b'a' * 10, b'b' * 5, b'c' * 7])
+        pathlib.Path(self.path_upload, '0.part').write_bytes(contenu)
+
+        parts, couvertes = lister_parts(self.path_upload)
+        self.assertEqual([0], [p[0] for p in parts])
+        self.assertEqual(['10.part', '15.part'], sorted(p.name for p in couvertes))
+
+        self.assertIsNone(assembler_parts(self.path_upload))
+        self.assertEqual(['0.part'], self.noms())
+        self.assertEqual(contenu, pathlib.Path(self.path_upload, '0.part').read_bytes())
+
+    def test_part_partiellement_couverte_conservee(self):
+        pathlib.Path(self.path_upload, '0.part').write_bytes(b'a' * 10)
+        pathlib.Path(self.path_upload, '5.part').write_bytes(b'b' * 10)
+        parts, couvertes = lister_parts(self.path_upload)
+        self.assertEqual([0, 5], [p[0] for p in parts])
+        self.assertEqual([], couvertes)
+
+    def test_fichier_assemblage_unique(self):
+        self.ecrire_parts([b'abc', b'def'])
+        with mock.patch.object(EcritureFichiers.uuid, 'uuid4') as uuid4:
+            uuid4.return_value.hex = 'fixe'
+            pathlib.Path(self.path_upload, EcritureFichiers.FICHIER_ASSEMBLAGE % 'fixe').write_bytes(b'autre')
+            with self.assertRaises(FileExistsError):
+                assembler_parts(self.path_upload)  # O_EXCL : ne reecrit pas l'assemblage d'un autre job
+        self.assertEqual(b'autre', pathlib.Path(
+            self.path_upload, EcritureFichiers.FICHIER_ASSEMBLAGE % 'fixe').read_bytes())
+
+
+class CopierFichierTest(unittest.TestCase):
+
+    def test_methodes(self):
+        contenu = os.urandom(100000)
+        with tempfile.TemporaryDirectory() as repertoire:
+            path_source = pathlib.Path(repertoire, 'source')
+            path_source.write_bytes(contenu)
+            for methode in ['copy_file_range', 'sendfile', 'tampon']:
+                path_destination = pathlib.Path(repertoire, methode)
+                with open(path_source, 'rb') as source, open(path_destination, 'wb') as destination:
+                    destination.write(b'x' * 10)
+                    destination.flush()
+                    copie, _methode = copier_fichier(source.fileno(), destination.fileno(), 10, methode)
+                self.assertEqual(len(contenu), copie)
+                self.assertEqual(b'x' * 10 + contenu, path_destination.read_bytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
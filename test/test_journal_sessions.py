@@ -0,0 +1,180 @@
+import asyncio
+import json
+import pathlib
+import tempfile
+import unittest
+
+from unittest import mock
+
+from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement import JournalSessions as ModuleJournal
+from server_hebergement.JournalSessions import JournalSessions, appliquer_evenement, OP_OUVRIR, OP_PART, OP_POST, \
+    OP_VERIFIE, OP_INTAKE, OP_RETIRER
+
+IDMG = 'zIdmgTest'
+FUUID = 'zFuuidTest'
+
+
+def evenement(op: str, fuuid=FUUID, **donnees) -> dict:
+    return dict(donnees, op=op, idmg=IDMG, fuuid=fuuid, date=1.0)
+
+
+async def executer(fn, *args):
+    return await asyncio.to_thread(fn, *args)
+
+
+class AppliquerEvenementTest(unittest.TestCase):
+
+    def test_sequence_complete(self):
+        etats = dict()
+        appliquer_evenement(etats, evenement(OP_OUVRIR, mode=ConstantesHebergement.MODE_UPLOAD_PARTS, taille=30))
+        appliquer_evenement(etats, evenement(OP_PART, position=0, taille=10))
+        appliquer_evenement(etats, evenement(OP_PART, position=10, taille=20))
+        appliquer_evenement(etats, evenement(OP_POST, hachage='h'))
+        appliquer_evenement(etats, evenement(OP_VERIFIE))
+
+        etat = etats[(IDMG, FUUID)]
+        self.assertEqual({0: 10, 10: 20}, etat.parts)
+        self.assertEqual('h', etat.hachage)
+        self.assertTrue(etat.verifie)
+        self.assertEqual(30, etat.taille_declaree)
+
+        appliquer_evenement(etats, evenement(OP_INTAKE))
+        self.assertEqual(dict(), etats)
+
+    def test_rejouer_est_idempotent(self):
+        evenements = [
+            evenement(OP_OUVRIR, mode=ConstantesHebergement.MODE_UPLOAD_PARTS),
+            evenement(OP_PART, position=0, taille=10),
+            evenement(OP_POST, hachage='h'),
+        ]
+        etats = dict()
+        for e in evenements + evenements[1:]:
+            appliquer_evenement(etats, e)
+        self.assertEqual({0: 10}, etats[(IDMG, FUUID)].parts)
+
+    def test_post_mode_fichier_finalise(self):
+        etats = dict()
+        appliquer_evenement(etats, evenement(OP_OUVRIR, mode=ConstantesHebergement.MODE_UPLOAD_FICHIER))
+        appliquer_evenement(etats, evenement(OP_PART, position=0, taille=5))
+        appliquer_evenement(etats, evenement(OP_PART, position=5, taille=5))
+        appliquer_evenement(etats, evenement(OP_POST, hachage='h', taille=10))
+        etat = etats[(IDMG, FUUID)]
+        self.assertEqual(ConstantesHebergement.MODE_UPLOAD_PARTS, etat.mode)
+        self.assertEqual({0: 10}, etat.parts)
+
+    def test_evenement_apres_retrait_ignore(self):
+        etats = dict()
+        appliquer_evenement(etats, evenement(OP_OUVRIR, mode=ConstantesHebergement.MODE_UPLOAD_PARTS))
+        appliquer_evenement(etats, evenement(OP_RETIRER))
+        appliquer_evenement(etats, evenement(OP_PART, position=0, taille=10))
+        self.assertEqual(dict(), etats)
+
+
+class JournalSessionsTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.path_journal = pathlib.Path(self.repertoire.name, 'journal_sessions.jsonl')
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    async def ecrire(self, journal: JournalSessions, evenements: list[tuple]):
+        stop_event = asyncio.Event()
+        tache = asyncio.create_task(journal.run(stop_event, executer))
+        for op, fuuid, donnees in evenements:
+            journal.ajouter(op, IDMG, fuuid, **donnees)
+        await journal.synchroniser()
+        stop_event.set()
+        await tache
+        journal.fermer()
+
+    def test_premier_demarrage(self):
+        journal = JournalSessions(self.path_journal)
+        self.assertIsNone(journal.charger())
+        journal.fermer()
+        self.assertTrue(self.path_journal.exists())
+
+    async def test_rejouer_apres_redemarrage(self):
+        journal = JournalSessions(self.path_journal)
+        journal.charger()
+        await self.ecrire(journal, [
+            (OP_OUVRIR, 'a', {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS}),
+            (OP_PART, 'a', {'position': 0, 'taille': 10}),
+            (OP_OUVRIR, 'b', {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS}),
+            (OP_POST, 'a', {'hachage': 'h'}),
+            (OP_INTAKE, 'b', {}),
+        ])
+
+        journal = JournalSessions(self.path_journal)
+        etats = journal.charger()
+        journal.fermer()
+        self.assertEqual(['a'], [e.fuuid for e in etats])
+        self.assertEqual({0: 10}, etats[0].parts)
+        self.assertEqual('h', etats[0].hachage)
+
+    async def test_ligne_incomplete_ignoree(self):
+        journal = JournalSessions(self.path_journal)
+        journal.charger()
+        await self.ecrire(journal, [
+            (OP_OUVRIR, 'a', {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS}),
+            (OP_PART, 'a', {'position': 0, 'taille': 10}),
+        ])
+        with open(self.path_journal, 'at') as fichier:
+            fichier.write('{"op": "part", "idmg": "%s", "fuu' % IDMG)  # Arret pendant une ecriture
+
+        journal = JournalSessions(self.path_journal)
+        etats = journal.charger()
+        journal.fermer()
+        self.assertEqual({0: 10}, etats[0].parts)
+
+    async def test_charger_compacte(self):
+        journal = JournalSessions(self.path_journal)
+        journal.charger()
+        evenements = [(OP_OUVRIR, 'a', {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS})]
+        for i in range(0, 20):
+            evenements.append((OP_OUVRIR, 'x%d' % i, {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS}))
+            evenements.append((OP_RETIRER, 'x%d' % i, {}))
+        await self.ecrire(journal, evenements)
+
+        journal = JournalSessions(self.path_journal)
+        journal.charger()
+        journal.fermer()
+        with open(self.path_journal, 'rt') as fichier:
+            lignes = [json.loads(l) for l in fichier]
+        self.assertEqual([(OP_OUVRIR, 'a')], [(l['op'], l['fuuid']) for l in lignes])
+
+    async def test_compaction_pendant_run(self):
+        journal = JournalSessions(self.path_journal)
+        journal.charger()
+        evenements = [
+            (OP_OUVRIR, 'a', {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS}),
+            (OP_PART, 'a', {'position': 0, 'taille': 10}),
+        ]
+        for i in range(0, 10):
+            evenements.append((OP_OUVRIR, 'x%d' % i, {'mode': ConstantesHebergement.MODE_UPLOAD_PARTS}))
+            evenements.append((OP_RETIRER, 'x%d' % i, {}))
+
+        with mock.patch.object(ModuleJournal, 'SEUIL_COMPACTION', 5):
+            await self.ecrire(journal, evenements)
+        self.assertEqual(2, journal.compactions)  # charger() puis run()
+
+        with open(self.path_journal, 'rt') as fichier:
+            self.assertEqual(2, len(fichier.readlines()))
+
+        journal = JournalSessions(self.path_journal)
+        etats = journal.charger()
+        journal.fermer()
+        self.assertEqual(['a'], [e.fuuid for e in etats])
+        self.assertEqual({0: 10}, etats[0].parts)
+
+    async def test_synchroniser_sans_evenement(self):
+        journal = JournalSessions(self.path_journal)
+        journal.charger()
+        await asyncio.wait_for(journal.synchroniser(), 1)
+        journal.fermer()
+
+
+if __name__ == '__main__':
+    unittest.main()
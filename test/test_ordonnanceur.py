@@ -0,0 +1,107 @@
+import asyncio
+import unittest
+
+from server_hebergement.Ordonnanceur import PoolEquitable
+
+
+async def laisser_tourner():
+    for _ in range(0, 5):
+        await asyncio.sleep(0)
+
+
+class PoolEquitableTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_acquisition_immediate(self):
+        pool = PoolEquitable('test', 2, 2)
+        async with pool.slot('a'):
+            self.assertEqual(1, pool.actifs_total)
+        self.assertEqual(0, pool.actifs_total)
+        self.assertEqual(1, pool.get_stats()['acquisitions'])
+
+    async def test_limite_idmg(self):
+        pool = PoolEquitable('test', 4, 1)
+        await pool.acquerir('a')
+        attente = asyncio.create_task(pool.acquerir('a'))
+        await laisser_tourner()
+        self.assertFalse(attente.done())
+
+        await pool.acquerir('b')  # Un autre idmg n'est pas bloque par la limite de a
+        self.assertEqual(2, pool.actifs_total)
+
+        pool.liberer('a')
+        await attente
+        self.assertEqual(2, pool.actifs_total)
+
+    async def test_equitable_entre_idmg(self):
+        pool = PoolEquitable('test', 1, 1)
+        await pool.acquerir('a')
+        ordre = list()
+
+        async def tache(idmg: str):
+            async with pool.slot(idmg):
+                ordre.append(idmg)
+                await asyncio.sleep(0)
+
+        taches = [asyncio.create_task(tache('a')) for _ in range(0, 3)]
+        await laisser_tourner()
+        taches.append(asyncio.create_task(tache('b')))
+        await laisser_tourner()
+        pool.liberer('a')
+        await asyncio.gather(*taches)
+
+        # b passe devant les requetes de a deja en attente
+        self.assertEqual(['b', 'a', 'a', 'a'], ordre)
+
+    async def test_annulation_en_attente(self):
+        pool = PoolEquitable('test', 1, 1)
+        await pool.acquerir('a')
+        attente = asyncio.create_task(pool.acquerir('b'))
+        await laisser_tourner()
+        self.assertEqual(1, pool.en_attente)
+
+        attente.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await attente
+        self.assertEqual(0, pool.en_attente)
+
+        pool.liberer('a')
+        self.assertEqual(0, pool.actifs_total)
+        await pool.acquerir('c')  # Le slot n'a pas ete perdu
+        self.assertEqual(1, pool.actifs_total)
+
+    async def test_annulation_apres_attribution(self):
+        pool = PoolEquitable('test', 1, 1)
+        await pool.acquerir('a')
+        attente = asyncio.create_task(pool.acquerir('b'))
+        await laisser_tourner()
+
+        # Le slot est attribue a b (future resolue) mais la tache est annulee avant de reprendre
+        pool.liberer('a')
+        attente.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await attente
+
+        self.assertEqual(0, pool.actifs_total)  # Slot libere par acquerir
+        self.assertEqual(0, pool.en_attente)
+        await asyncio.wait_for(pool.acquerir('c'), 1)
+
+    async def test_annulation_reveille_suivant(self):
+        pool = PoolEquitable('test', 1, 1)
+        await pool.acquerir('a')
+        annulee = asyncio.create_task(pool.acquerir('b'))
+        await laisser_tourner()
+        suivante = asyncio.create_task(pool.acquerir('c'))
+        await laisser_tourner()
+
+        pool.liberer('a')
+        annulee.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await annulee
+
+        await asyncio.wait_for(suivante, 1)
+        self.assertEqual(1, pool.actifs_total)
+        self.assertEqual(0, pool.en_attente)
+
+
+if __name__ == '__main__':
+    unittest.main()
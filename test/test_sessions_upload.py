@@ -0,0 +1,59 @@
+import unittest
+
+from server_hebergement import Constantes as ConstantesHebergement
+from server_hebergement.SessionsUpload import SessionUpload, ajouter_intervalle
+
+
+class AjouterIntervalleTest(unittest.TestCase):
+
+    def test_liste_vide(self):
+        self.assertEqual([[0, 10]], ajouter_intervalle([], 0, 10))
+
+    def test_disjoints_tries(self):
+        intervalles = ajouter_intervalle([[20, 30]], 0, 10)
+        self.assertEqual([[0, 10], [20, 30]], intervalles)
+        self.assertEqual([[0, 10], [20, 30], [40, 50]], ajouter_intervalle(intervalles, 40, 50))
+
+    def test_fusion_contigus(self):
+        self.assertEqual([[0, 20]], ajouter_intervalle([[0, 10]], 10, 20))
+        self.assertEqual([[0, 20]], ajouter_intervalle([[10, 20]], 0, 10))
+
+    def test_fusion_chevauchement(self):
+        self.assertEqual([[0, 25]], ajouter_intervalle([[0, 10], [20, 25]], 5, 22))
+        self.assertEqual([[0, 30]], ajouter_intervalle([[5, 10], [15, 20]], 0, 30))
+
+    def test_comble_un_trou(self):
+        self.assertEqual([[0, 30]], ajouter_intervalle([[0, 10], [20, 30]], 10, 20))
+
+    def test_deja_recu(self):
+        self.assertEqual([[0, 30]], ajouter_intervalle([[0, 30]], 5, 10))
+
+
+class SessionUploadFichierTest(unittest.TestCase):
+
+    def session(self, parts: dict, taille_declaree=None) -> SessionUpload:
+        return SessionUpload('zIdmg', 'zFuuid', False, parts, ConstantesHebergement.MODE_UPLOAD_FICHIER,
+                             taille_declaree)
+
+    def test_manquants(self):
+        session = self.session({0: 10, 20: 10}, taille_declaree=40)
+        self.assertEqual([[0, 10], [20, 30]], session.recus)
+        self.assertEqual([[10, 20], [30, 40]], session.manquants)
+        self.assertEqual(10, session.position)
+
+    def test_ajouter_part_comble(self):
+        session = self.session({0: 10, 20: 10}, taille_declaree=30)
+        session.ajouter_part(10, 10)
+        self.assertEqual([[0, 30]], session.recus)
+        self.assertEqual([], session.manquants)
+        self.assertEqual(30, session.position)
+
+    def test_contient(self):
+        session = self.session({0: 10, 20: 10})
+        self.assertTrue(session.contient(2, 5))
+        self.assertFalse(session.contient(8, 5))
+        self.assertFalse(session.contient(10, 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import pathlib
+import tempfile
+import unittest
+
+from server_hebergement.Telechargement import SourceFichier, RangeNonSatisfaisable, parse_range, etag_correspond, \
+    etag_correspond_fort, MAX_RANGES
+
+
+class ParseRangeTest(unittest.TestCase):
+
+    def test_range_simple(self):
+        self.assertEqual([(0, 100)], parse_range('bytes=0-99', 1000))
+        self.assertEqual([(500, 1000)], parse_range('bytes=500-', 1000))
+        self.assertEqual([(900, 1000)], parse_range('bytes=-100', 1000))
+
+    def test_fin_tronquee_a_la_taille(self):
+        self.assertEqual([(990, 1000)], parse_range('bytes=990-5000', 1000))
+        self.assertEqual([(0, 1000)], parse_range('bytes=-5000', 1000))
+
+    def test_fusion(self):
+        # Chevauchement, ranges contigus et ordre quelconque
+        self.assertEqual([(0, 300)], parse_range('bytes=100-299, 0-149', 1000))
+        self.assertEqual([(0, 200)], parse_range('bytes=0-99,100-199', 1000))
+        self.assertEqual([(0, 10), (20, 30)], parse_range('bytes=20-29,0-9', 1000))
+        self.assertEqual([(0, 10), (990, 1000)], parse_range('bytes=0-9,-10', 1000))
+
+    def test_invalide_ignore(self):
+        self.assertIsNone(parse_range('items=0-9', 1000))
+        self.assertIsNone(parse_range('bytes', 1000))
+        self.assertIsNone(parse_range('bytes=a-b', 1000))
+        self.assertIsNone(parse_range('bytes=20-10', 1000))
+        self.assertIsNone(parse_range('bytes=--5', 1000))
+
+    def test_non_satisfaisable(self):
+        with self.assertRaises(RangeNonSatisfaisable):
+            parse_range('bytes=1000-', 1000)
+        with self.assertRaises(RangeNonSatisfaisable):
+            parse_range('bytes=-0', 1000)
+
+    def test_range_hors_fichier_ignore_si_autre_valide(self):
+        self.assertEqual([(0, 10)], parse_range('bytes=0-9,2000-3000', 1000))
+
+    def test_trop_de_ranges(self):
+        valeur = 'bytes=' + ','.join('%d-%d' % (i * 10, i * 10) for i in range(0, MAX_RANGES + 1))
+        self.assertIsNone(parse_range(valeur, 100000))
+
+
+class EtagTest(unittest.TestCase):
+
+    def test_faible(self):
+        self.assertTrue(etag_correspond('"abc"', '"abc"'))
+        self.assertTrue(etag_correspond('W/"abc"', '"abc"'))
+        self.assertTrue(etag_correspond('"x", "abc"', '"abc"'))
+        self.assertTrue(etag_correspond('*', '"abc"'))
+        self.assertFalse(etag_correspond('"x"', '"abc"'))
+
+    def test_fort(self):
+        self.assertTrue(etag_correspond_fort('"abc"', '"abc"'))
+        self.assertTrue(etag_correspond_fort('*', '"abc"'))
+        self.assertFalse(etag_correspond_fort('W/"abc"', '"abc"'))
+        self.assertFalse(etag_correspond_fort('"x"', '"abc"'))
+
+
+class SourceFichierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repertoire = tempfile.TemporaryDirectory()
+        self.path_upload = pathlib.Path(self.repertoire.name)
+
+    def tearDown(self):
+        self.repertoire.cleanup()
+
+    def test_decouper(self):
+        pathlib.Path(self.path_upload, '0.part').write_bytes(b'a' * 10)
+        pathlib.Path(self.path_upload, '10.part').write_bytes(b'b' * 10)
+        source = SourceFichier.charger(self.path_upload)
+        self.assertEqual(20, source.taille)
+
+        segments = [(p.name, offset, count) for p, offset, count in source.decouper(5, 15)]
+        self.assertEqual([('0.part', 5, 5), ('10.part', 0, 5)], segments)
+        segments = [(p.name, offset, count) for p, offset, count in source.decouper(12, 20)]
+        self.assertEqual([('10.part', 2, 8)], segments)
+
+    def test_incomplet(self):
+        pathlib.Path(self.path_upload, '0.part').write_bytes(b'a' * 10)
+        pathlib.Path(self.path_upload, '20.part').write_bytes(b'b' * 10)
+        self.assertIsNone(SourceFichier.charger(self.path_upload))
+
+    def test_inexistant(self):
+        self.assertIsNone(SourceFichier.charger(pathlib.Path(self.path_upload, 'absent')))
+
+
+if __name__ == '__main__':
+    unittest.main()